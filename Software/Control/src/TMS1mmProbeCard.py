@@ -6,127 +6,85 @@
 #
 
 from __future__ import print_function
-import copy
 from command import *
+from TMS1mmReg import *
 import socket
+import os
 import time
 import sys
 import argparse
-
-## Manage Topmetal-S 1mm chip's internal register map.
-# Allow combining and disassembling individual registers
-# to/from long integer for I/O
-#
-class TMS1mmReg(object):
-    ## @var _defaultRegMap default register values
-    _defaultRegMap = {
-        'DAC'    : [0x75c3, 0x8444, 0x7bbb, 0x7375, 0x86d4, 0xe4b2], # from DAC1 to DAC6
-        'PD'     : [1, 1, 1, 1], # from PD1 to PD4, 1 means powered down
-        'K'      : [1, 0, 1, 0, 1, 0, 0, 0, 0, 0], # from K1 to K10, 1 means closed (conducting)
-        'vref'   : 0x8,
-        'vcasp'  : 0x8,
-        'vcasn'  : 0x8,
-        'vbiasp' : 0x8,
-        'vbiasn' : 0x8
-    }
-    ## @var register map local to the class
-    _regMap = {}
-
-    def __init__(self):
-        self._regMap = copy.deepcopy(self._defaultRegMap)
-
-    def set_dac(self, i, val):
-        self._regMap['DAC'][i] = 0xffff & val
-
-    def set_power_down(self, i, onoff):
-        self._regMap['PD'][i] = 0x1 & onoff
-
-    def set_k(self, i, onoff):
-        self._regMap['K'][i] = 0x1 & onoff
-
-    def set_vref(self, val):
-        self._regMap['vref'] = val & 0xf
-
-    def set_vcasp(self, val):
-        self._regMap['vcasp'] = val & 0xf
-
-    def set_vcasn(self, val):
-        self._regMap['vcasn'] = val & 0xf
-
-    def set_vbiasp(self, val):
-        self._regMap['vbiasp'] = val & 0xf
-
-    def set_vbiasn(self, val):
-        self._regMap['vbiasn'] = val & 0xf
-
-    ## Get long-integer variable
-    def get_config_vector(self):
-        ret = ( self._regMap['vbiasn'] << 126 |
-                self._regMap['vbiasp'] << 122 |
-                self._regMap['vcasn']  << 118 |
-                self._regMap['vcasp']  << 114 |
-                self._regMap['vref']   << 110 )
-        for i in xrange(len(self._regMap['K'])):
-            ret |= self._regMap['K'][i] << (len(self._regMap['K']) - i) + 99
-        for i in xrange(len(self._regMap['PD'])):
-            ret |= self._regMap['PD'][i] << (len(self._regMap['PD']) - i) + 95
-        for i in xrange(len(self._regMap['DAC'])):
-            ret |= self._regMap['DAC'][i] << (len(self._regMap['DAC'])-1 - i)*16
-        return ret
-
-    dac_fit_a = 4.35861E-5
-    dac_fit_b = 0.0349427
-    def dac_volt2code(self, v):
-
-        c = int((v - self.dac_fit_b) / self.dac_fit_a)
-        if c < 0:     c = 0
-        if c > 65535: c = 65535
-        return c
-
-    def dac_code2volt(self, c):
-        v = c * self.dac_fit_a + self.dac_fit_b
-        return v
-
-## Command generator for controlling DAC8568
-#
-class DAC8568(object):
- 
-    def __init__(self, cmd, pulseId=1):
-        self._pulseId = pulseId
-        self.cmd = cmd
-    def DACVolt(self, x):
-        return int(x / 2.5 * 65536.0)    #calculation
-    def write_spi(self, val):
-        ret = ""          # 32 bits 
-        ret += self.cmd.write_register(0, (val >> 16) & 0xffff)
-        ret += self.cmd.send_pulse(1<<self._pulseId)
-        ret += self.cmd.write_register(0, val & 0xffff)
-        ret += self.cmd.send_pulse(1<<self._pulseId)
-        return ret
-    def turn_on_2V5_ref(self):
-        return self.write_spi(0x08000001)
-    def set_voltage(self, ch, v):
-        return self.write_spi((0x03 << 24) | (ch << 20) | (self.DACVolt(v) << 4))
+from board_registry import *
+import timing
+from timing import profiler
+from shift_register import *
+from dac_calib import *
+from TMS1mmSingle import DAC8568
+from running_stats import RunningStats
+from scan_file import *
+from scpi import SCPIInstrument, SocketTransport
 
 ## Command generator for controlling ADS124S0X
 #
 class ADS124S0X(object):
 
-    def __init__(self, cmd, pulseId=2, configRegId=0, statusRegId0=9, acqDelay=0.2):
+    ## @var dataRates data rate [SPS] -> DR[3:0] of the DATARATE register
+    dataRates = {2.5 : 0x0, 5 : 0x1, 10 : 0x2, 16.6 : 0x3, 20 : 0x4, 50 : 0x5, 60 : 0x6,
+                 100 : 0x7, 200 : 0x8, 400 : 0x9, 800 : 0xa, 1000 : 0xb, 2000 : 0xc, 4000 : 0xd}
+    ## @var filterPeriods conversion periods until the first settled result
+    filterPeriods = {"sinc3" : 3, "low-latency" : 1}
+    ## @var tDelay conversion start delay after a mux change, 14 tMOD at 4.096MHz
+    tDelay = 14 * 16 / 4.096e6
+    ## @var settleMargin safety factor on the computed settling time
+    settleMargin = 1.1
+    ## @var scanChannels channels recorded by the probe card scan, -1 is the temperature sensor
+    scanChannels = tuple(range(-1, 7))
+    ## @var tempVolt25, tempSlope internal temperature sensor: volts at 25C, volts per C
+    tempVolt25 = 0.129
+    tempSlope = 0.000403
+
+    ## @param[in] acqDelay fixed wait used by recv_ callers that do not
+    #            use scan(), which computes the settling time itself.
+    # @param[in] dataRate, filt, gain, pga ADC settings, see configure().
+    def __init__(self, cmd, pulseId=2, configRegId=0, statusRegId0=9, acqDelay=0.2, regShadow=None,
+                 dataRate=20, filt="low-latency", gain=1, pga=False):
         self._pulseId = pulseId
         self._configRegId = configRegId
         self._statusRegId0 = 9
         # time to wait for ADC to finish a sample
         self.acqDelay = acqDelay
         self.cmd = cmd
+        self.regShadow = regShadow
+        self.configure(dataRate, filt, gain, pga)
+
+    ## Set the conversion settings used by initialize(), select_channel()
+    # and scan().
+    # @param[in] dataRate one of dataRates.
+    # @param[in] filt "low-latency" or "sinc3".
+    # @param[in] gain PGA gain, 1, 2, 4, ... 128; gains above 1 need pga.
+    # @param[in] pga enable the PGA for the AIN channels.
+    def configure(self, dataRate=20, filt="low-latency", gain=1, pga=False):
+        if dataRate not in self.dataRates:
+            raise ValueError("unsupported data rate {0}".format(dataRate))
+        if filt not in self.filterPeriods:
+            raise ValueError("unknown filter {0}".format(filt))
+        if gain not in [1 << i for i in range(8)] or (gain > 1 and not pga):
+            raise ValueError("unsupported gain {0}, pga {1}".format(gain, pga))
+        self.dataRate = dataRate
+        self.filt = filt
+        self.gain = gain
+        self.pga = pga
+
+    ## Time from a mux change to the first settled conversion
+    def settling_time(self):
+        return self.settleMargin * (self.filterPeriods[self.filt] / float(self.dataRate) + self.tDelay)
 
     def write_spi(self, val):
-        ret = "" # 32 bits
-        ret += self.cmd.write_register(self._configRegId, (val >> 16) & 0xffff)
-        ret += self.cmd.send_pulse(1<<self._pulseId)
-        ret += self.cmd.write_register(self._configRegId, val & 0xffff)
-        ret += self.cmd.send_pulse(1<<self._pulseId)
-        return ret
+        if self.regShadow is not None:
+            self.regShadow.record(self._configRegId, val)
+        # 32 bits, as two 16-bit words each followed by a pulse
+        return self.cmd.encode([OP_WRITE_REGISTER, OP_SEND_PULSE, OP_WRITE_REGISTER, OP_SEND_PULSE],
+                               [self._configRegId, 0, self._configRegId, 0],
+                               [(val >> 16) & 0xffff, 1<<self._pulseId, val & 0xffff, 1<<self._pulseId])
 
     def read_reg(self, addr, n=2):
         rreg = (1<<5) | (0x1f & addr)
@@ -144,15 +102,17 @@ class ADS124S0X(object):
         return self.write_spi(val)
 
     def initialize(self):
-        cmdstr  = ""
-        cmdstr += self.write_reg(0x04, 0x14, # Low-latency filter, 20SPS
+        cmdstr  = b""
+        # continuous conversion, FILTER bit 4, DR[3:0]
+        datarate = (0x10 if self.filt == "low-latency" else 0x00) | self.dataRates[self.dataRate]
+        cmdstr += self.write_reg(0x04, datarate,
                                        0x3a, # Internal 2.5V reference
                                  n=2)
         cmdstr += self.write_spi(0x08<<24) # START
         return cmdstr
 
     def select_channel(self, ch):
-        cmdstr = ""
+        cmdstr = b""
         if ch == -1: # temperature sensor or internal check sources
             cmdstr += self.write_reg(0x09, 0x50) # SYS_MON, temperature, 129mV @25C
             #cmdstr += self.write_reg(0x09, 0x90) # SYS_MON, DVDD/4.0
@@ -160,7 +120,9 @@ class ADS124S0X(object):
             cmdstr += self.write_reg(0x03, 0x08) # PGA_EN, GAIN 1
         else:
             cmdstr += self.write_reg(0x09, 0x10) # SYS_MON, disable
-            cmdstr += self.write_reg(0x03, 0x00) # PGA_EN, PGA disabled.
+            # PGA_EN, GAIN[2:0] = log2(gain); PGA disabled by default
+            pga = (0x08 | (self.gain.bit_length() - 1)) if self.pga else 0x00
+            cmdstr += self.write_reg(0x03, pga)
             cmdstr += self.write_reg(0x02, ((0x0f & ch)<<4) | 0x0c) # tie MUXP=AIN[ch], MUXN=AINCOM
         return cmdstr
 
@@ -173,23 +135,134 @@ class ADS124S0X(object):
     # Read captured din from status_reg
     #
     def recv_din(self, s, n16=2, delay=0.001):
-        cmdstr = ""
-        for i in xrange(n16):
-            cmdstr += self.cmd.read_status(self._statusRegId0+i)
-        time.sleep(delay) # wait for status_reg to be ready
-        s.sendall(cmdstr)
-        retw = s.recv(4*n16)
+        trans = CmdTransaction(self.cmd)
+        self.queue_din(trans, n16)
+        with profiler.timed("wait"):
+            time.sleep(delay) # wait for status_reg to be ready
+        return self.decode_din(trans.commit(s)[0])
+
+    ## Queue the status_reg reads of captured din into a CmdTransaction
+    # @return index of the result, to be decoded by decode_din()
+    def queue_din(self, trans, n16=2):
+        return trans.read_statuses([self._statusRegId0+i for i in xrange(n16)])
+
+    def decode_din(self, retw):
         ret = 0
-        for i in xrange(n16):
-            ret |= (ord(retw[i*4+2]) << (i*16 + 8)) | (ord(retw[i*4+3]) << i*16)
+        for i in xrange(len(retw)):
+            ret |= int(retw[i]) << i*16
         return ret
 
     def recv_data(self, s):
         rdata = 0x12
         val = rdata << 24
-        s.sendall(self.write_spi(val))
+        with profiler.timed("send"):
+            s.sendall(self.write_spi(val))
         return self.recv_din(s)
 
+    ## Convert the conversions of a set of channels.
+    #
+    # Each mux switch goes out in the same transaction as the read-out of
+    # the previous channel's RDATA, and the wait before each RDATA is the
+    # settling time of the configured filter and data rate.  The ADC is
+    # expected to be converting continuously, see initialize().
+    #
+    # @param[in] s Socket that is already open and connected to the FPGA board.
+    # @param[in] channels AIN channels, -1 for the temperature sensor.
+    # @param[in] diag read back INPMUX after each switch (debug level 2).
+    # @param[in] spiDelay wait for the RDATA SPI transfer to complete.
+    # @return float array of volts, one per channel; the raw conversions
+    #         are kept in lastCodes.
+    def scan(self, s, channels, diag=False, spiDelay=0.001):
+        channels = list(channels)
+        codes = np.zeros(len(channels), dtype=np.uint32)
+        settle = self.settling_time()
+        rdata = self.write_spi(0x12 << 24)
+        trans = CmdTransaction(self.cmd)
+        if channels:
+            with profiler.timed("send"):
+                s.sendall(self.select_channel(channels[0]))
+        for i, ch in enumerate(channels):
+            if diag:
+                with profiler.timed("send"):
+                    s.sendall(self.read_reg(0x02))
+                timing.debug(2, "ch={0:2d} 0x{1:08x}".format, ch, self.recv_din(s))
+            with profiler.timed("wait"):
+                time.sleep(settle)
+            with profiler.timed("send"):
+                s.sendall(rdata)
+            with profiler.timed("wait"):
+                time.sleep(spiDelay)
+            # read this channel and switch to the next one at once
+            idx = self.queue_din(trans)
+            if i + 1 < len(channels):
+                trans.append(self.select_channel(channels[i + 1]))
+            codes[i] = self.decode_din(trans.commit(s)[idx])
+        self.lastCodes = codes
+        vn = np.zeros(len(channels))
+        gain = np.array([1 if ch == -1 else self.gain for ch in channels])
+        return self.adcvolts(codes, vn, gain)
+
+    ## Take n conversions of each channel in continuous-conversion mode.
+    #
+    # Each RDATA goes out together with the read-out of the previous
+    # conversion, one conversion period apart, and the last read-out of a
+    # channel together with the switch to the next one, so a channel
+    # costs about oversample_time() and n+1 round trips.  The conversions
+    # are decoded in bulk and folded into per-channel running statistics.
+    #
+    # @param[in] channels AIN channels, -1 for the temperature sensor.
+    # @param[in] n conversions per channel.
+    # @param[in] stats RunningStats to add to, a new one if None.
+    # @param[in] keep keep the volts, (channels, n), in lastSamples.
+    # @param[in] spiDelay wait for the last RDATA SPI transfer to complete.
+    # @return RunningStats of the volts, one entry per channel
+    def oversample(self, s, channels, n, stats=None, keep=False, spiDelay=0.001):
+        channels = list(channels)
+        if stats is None:
+            stats = RunningStats(len(channels))
+        self.lastSamples = np.zeros((len(channels), n)) if keep else None
+        if not channels or n <= 0:
+            return stats
+        settle = self.settling_time()
+        period = 1.0 / self.dataRate
+        rdata = self.write_spi(0x12 << 24)
+        trans = CmdTransaction(self.cmd)
+        codes = np.zeros(n, dtype=np.uint32)
+        with profiler.timed("send"):
+            s.sendall(self.select_channel(channels[0]))
+        for j, ch in enumerate(channels):
+            with profiler.timed("wait"):
+                time.sleep(settle)
+            for k in range(n):
+                idx = self.queue_din(trans) if k > 0 else None
+                trans.append(rdata)
+                ret = trans.commit(s)
+                if idx is not None:
+                    codes[k - 1] = self.decode_din(ret[idx])
+                with profiler.timed("wait"):
+                    time.sleep(period if k + 1 < n else spiDelay)
+            idx = self.queue_din(trans)
+            if j + 1 < len(channels):
+                trans.append(self.select_channel(channels[j + 1]))
+            codes[n - 1] = self.decode_din(trans.commit(s)[idx])
+            with profiler.timed("decode"):
+                volts = self.adcvolts(codes, 0.0, 1 if ch == -1 else self.gain)
+            stats.add(j, volts)
+            if keep:
+                self.lastSamples[j] = volts
+        return stats
+
+    ## Expected duration of oversample() of nChannels channels
+    def oversample_time(self, nChannels, n):
+        return nChannels * (self.settling_time() + max(n - 1, 0) / float(self.dataRate))
+
+    ## Vectorized adcvolt() of an array of conversions
+    def adcvolts(self, data, vn=0.0, gain=1, vref=2.5, mode="single"):
+        adcint = ((np.asarray(data, dtype=np.int64) & 0xffffff) ^ 0x800000) - 0x800000
+        if mode == "single":
+            gain = np.asarray(gain) * 0.5
+        return adcint * vref / float(1<<24) / gain + vn
+
     ## Convert received adc data to voltage
     #
     def adcvolt(self, data, vn=0.0, gain=1, vref=2.5, mode="single"):
@@ -204,111 +277,191 @@ class ADS124S0X(object):
         volt = adcint * vref / (1<<24) / gain + vn
         return volt
 
+    ## Convert the internal sensor voltage to temperature [C]
+    @classmethod
+    def volt2temp(cls, v):
+        return 25.0 + (v - cls.tempVolt25) / cls.tempSlope
+
     ## Convert received adc data to internal sensor temperature
     #
     def adctemp(self, data):
-        v = self.adcvolt(data)
-        c = 25.0 + (v - 0.129) / 0.000403
-        return c
+        return self.volt2temp(self.adcvolt(data))
 
 ## Class for controlling Keithley 2450 SMU
 #
-class SMU2450(object):
+# One SCPI connection is kept open for the whole session.  While the
+# output is on, the SMU's trigger model measures the supply current
+# continuously into defbuffer1; fetch() collects the new readings in
+# bulk into trace, with their times relative to volt_on().
+#
+class SMU2450(SCPIInstrument):
 
-    def __init__(self, ipaddr="192.168.2.100", ipport=5025):
+    ## @param[in] bufferSize readings defbuffer1 holds, readings beyond it
+    #            are not fetched.
+    def __init__(self, ipaddr="192.168.2.100", ipport=5025, timeout=5.0, nplc=1.0, bufferSize=1000000):
+        SCPIInstrument.__init__(self, SocketTransport(ipaddr, ipport, timeout))
         self._ipaddr = ipaddr
         self._ipport = ipport
+        self.timeout = timeout
+        self.nplc = nplc
+        self.bufferSize = bufferSize
+        self._clear_trace()
 
-    def volt_on(self, v=7.0, iLimit=0.2):
-        s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        s.connect((self._ipaddr, self._ipport))
-        s.sendall(":ABORT\n:TRIG:LOAD \"EMPTY\"\n")
-        s.sendall(":SENS:FUNC \"CURR:DC\"\n:SENS:CURR:RANG:AUTO ON\n:SENS:CURR:RSEN OFF\n")
-        s.sendall(":SOUR:FUNC VOLT\n:SOUR:VOLT {0:f}\n:SOUR:VOLT:ILIM {1:f}\n".format(v, iLimit))
-        s.sendall(":OUTP ON\n:TRIG:LOAD \"LoopUntilEvent\", COMM, 100\n:INIT\n")
-        s.close()
-    def volt_off(self):
-        s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        s.connect((self._ipaddr, self._ipport))
-        s.sendall(":ABORT\n:TRIG:LOAD \"EMPTY\"\n")
-        s.sendall(":OUTP OFF\n:TRIG:LOAD \"LoopUntilEvent\", COMM, 100\n:INIT\n")
-        s.close()
+    def _clear_trace(self):
+        self._nFetched = 0
+        self._times = []
+        self._currents = []
+        ## @var t0 host time of volt_on(), trace times are relative to it
+        self.t0 = None
 
- ## Shift_register write and read function.
-#
-# @param[in] s Socket that is already open and connected to the FPGA board.
-# @param[in] data_to_send 130-bit value to be sent to the external SR.
-# @param[in] clk_div Clock frequency division factor: (/2**clk_div).  6-bit wide.
-# @return Value stored in the external SR that is read back.
-# @return valid signal shows that the value stored in external SR is read back.
-def shift_register_rw(s, data_to_send, clk_div):
-    div_reg = (clk_div & 0x3f) << 130
-    data_reg = data_to_send & 0x3ffffffffffffffffffffffffffffffff
-
-    cmd = Cmd()
-
-    val = div_reg | data_reg
-    cmdstr = ""
-    for i in xrange(9):
-        cmdstr += cmd.write_register(i, (val >> i*16) & 0xffff)
-
-    cmdstr += cmd.send_pulse(0x01)
-
-#    print([hex(ord(w)) for w in cmdstr])
-
-    s.sendall(cmdstr)
-
-    time.sleep(0.2)
-
-    # read back
-    cmdstr = ""
-    for i in xrange(9):
-        cmdstr += cmd.read_status(8-i)
-    s.sendall(cmdstr)
-    retw = s.recv(4*9)
-#    print([hex(ord(w)) for w in retw])
-    ret_all = 0
-    for i in xrange(9):
-        ret_all = ret_all | ( int(ord(retw[i*4+2])) << ((8-i) * 16 + 8) |
-                              int(ord(retw[i*4+3])) << ((8-i) * 16))
-    ret = ret_all & 0x3ffffffffffffffffffffffffffffffff
-    valid = (ret_all & (1 << 130)) >> 130
-    print("Return: 0x%0x, valid: %d" % (ret, valid))
-    return ret
+    def __repr__(self):
+        return "SMU2450({0}:{1})".format(self._ipaddr, self._ipport)
 
-if __name__ == "__main__":
+    def connect(self):
+        self.transport.connect()
+        return self
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-m", "--smu-ip-port", type=str, default="192.168.2.100:5025", help="SMU 2450 ipaddr and port")
-    parser.add_argument("-c", "--control-ip-port", type=str, default="192.168.2.3:1024", help="main control system ipaddr and port")
-    parser.add_argument("-l", "--code-lower", type=int, default=0, help="Code scan lower limit")
-    parser.add_argument("-u", "--code-upper", type=int, default=58000, help="Code scan upper limit")
-    parser.add_argument("-s", "--code-step", type=int, default=2000, help="Code scan step size")
-    parser.add_argument("-p", "--prefix", type=str, default="data/", help="Data file prefix, can be used to put files under directories")
-    parser.add_argument("x", type=int, default=0, help="Chip location x")
-    parser.add_argument("y", type=int, default=0, help="Chip location y")
-
-    args = parser.parse_args()
-
-    datafname = args.prefix + "x{0:04d}y{1:04d}.dat".format(args.x, args.y)
-    print("Writing data to {0:s}".format(datafname))
-    fp = open(datafname, "a+")
-    fp.write("\n\n# Chip {0:d} {1:d}\n".format(args.x, args.y))
-
-    smuipport = args.smu_ip_port.split(':')
-    smu = SMU2450(smuipport[0], int(smuipport[1]))
-    smu.volt_on()
-    time.sleep(2)
-#    smu.volt_off()
-
-    ctrlipport = args.control_ip_port.split(':')
-    s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-    s.connect((ctrlipport[0],int(ctrlipport[1])))
+    def volt_on(self, v=7.0, iLimit=0.2):
+        with profiler.timed("instrument"):
+            self._volt_on(v, iLimit)
 
-    cmd = Cmd()
-    dac8568 = DAC8568(cmd)
-    s.sendall(dac8568.turn_on_2V5_ref())
-    s.sendall(dac8568.set_voltage(6, 1.2))
+    def volt_off(self):
+        with profiler.timed("instrument"):
+            self._volt_off()
+
+    def _volt_on(self, v, iLimit):
+        with self.lock:
+            with self.batch():
+                self.write(":ABORT", ":TRIG:LOAD \"EMPTY\"")
+                self.configure([(":SENS:FUNC", "\"CURR:DC\""), (":SENS:CURR:RANG:AUTO", "ON"),
+                                (":SENS:CURR:RSEN", "OFF"), (":SENS:CURR:NPLC", self.nplc),
+                                (":SOUR:FUNC", "VOLT"), (":SOUR:VOLT", float(v)),
+                                (":SOUR:VOLT:ILIM", float(iLimit)),
+                                (":TRAC:POIN", "{0:d}, \"defbuffer1\"".format(self.bufferSize))])
+                # a fresh buffer, so that reading indices start with this run
+                self.write(":TRAC:CLE \"defbuffer1\"")
+                self.write(":OUTP ON", ":TRIG:LOAD \"LoopUntilEvent\", COMM, 100", ":INIT")
+            self._clear_trace()
+            self.t0 = time.time()
+
+    def _volt_off(self):
+        with self.lock:
+            self.write(":ABORT", ":TRIG:LOAD \"EMPTY\"",
+                       ":OUTP OFF", ":TRIG:LOAD \"LoopUntilEvent\", COMM, 100", ":INIT")
+
+    ## Fetch the readings taken since the last fetch.
+    # @return (times, currents) arrays of the new readings
+    def fetch(self):
+        with self.lock, profiler.timed("instrument"):
+            n = int(self.query(":TRAC:ACT? \"defbuffer1\""))
+            if n <= self._nFetched:
+                return np.zeros(0), np.zeros(0)
+            reply = self.query(":TRAC:DATA? {0:d}, {1:d}, \"defbuffer1\", READ, REL".format(self._nFetched + 1, n))
+            self._nFetched = n
+        data = np.array(reply.split(","), dtype=float).reshape(-1, 2)
+        self._currents.append(data[:, 0])
+        self._times.append(data[:, 1])
+        return data[:, 1], data[:, 0]
+
+    ## All readings fetched so far, optionally those between host times
+    # tStart and tEnd only.
+    # @return (times relative to volt_on(), currents)
+    def trace(self, tStart=None, tEnd=None):
+        with self.lock:
+            t = np.concatenate(self._times) if self._times else np.zeros(0)
+            i = np.concatenate(self._currents) if self._currents else np.zeros(0)
+        sel = np.ones(t.size, dtype=bool)
+        if tStart is not None:
+            sel &= t >= tStart - self.t0
+        if tEnd is not None:
+            sel &= t <= tEnd - self.t0
+        return t[sel], i[sel]
+
+    ## Wait until the supply current is stable.
+    #
+    # Settled means the readings of the last window seconds spread by no
+    # more than tolerance and, when current is given, their mean is
+    # within tolerance of it.
+    #
+    # @param[in] current expected current [A], or None.
+    # @param[in] tolerance [A].
+    # @param[in] window [s], at least minReadings readings are required.
+    # @return (settled, seconds waited, mean current of the window)
+    def wait_until_settled(self, current=None, tolerance=1e-3, window=0.2, timeout=10.0,
+                           pollInterval=0.05, minReadings=3):
+        tStart = time.time()
+        mean = float('nan')
+        while True:
+            self.fetch()
+            t, i = self.trace()
+            if t.size >= minReadings:
+                w = i[t >= t[-1] - window]
+                if w.size < minReadings:
+                    w = i[-minReadings:]
+                mean = float(w.mean())
+                if (w.max() - w.min() <= tolerance and
+                    (current is None or abs(mean - current) <= tolerance)):
+                    return True, time.time() - tStart, mean
+            if time.time() - tStart >= timeout:
+                return False, time.time() - tStart, mean
+            with profiler.timed("wait"):
+                time.sleep(pollInterval)
+
+    ## Fetch and return the readings between host times tStart and
+    # tEnd, times relative to tStart.  Take it before the next volt_on(),
+    # which clears the buffer.
+    # @return (times, currents)
+    def snapshot(self, tStart=None, tEnd=None):
+        self.fetch()
+        t, i = self.trace(tStart, tEnd)
+        if tStart is not None:
+            t = t - (tStart - self.t0)
+        return t, i
+
+    ## Save the readings between host times tStart and tEnd, times
+    # relative to tStart.
+    def save_trace(self, fname, tStart=None, tEnd=None):
+        write_smu_trace(fname, *self.snapshot(tStart, tEnd))
+
+## Write an SMU current trace, see SMU2450.snapshot()
+def write_smu_trace(fname, t, i):
+    with open(fname, "w") as fp:
+        fp.write("# t[s] I[A]\n")
+        for x in zip(t, i):
+            fp.write("{0:12.6f} {1:14.7E}\n".format(*x))
+
+## Outcome of chip_scan(): the data rows and what goes with them into
+# a scan file
+#
+class ChipScan(object):
+
+    def __init__(self, rows, times, ok, meta):
+        ## @var rows [dacCode, volt(ch=-1), ..., volt(ch=6)(, sigmas)] per code
+        self.rows = rows
+        ## @var times host time each code was measured at
+        self.times = times
+        ## @var ok SR read-back flag of each code
+        self.ok = ok
+        ## @var meta register and instrument settings
+        self.meta = meta
+
+## DAC code scan of one chip: set all six DACs to each code, validate
+# the shift register read-back and record the ADC channels.
+#
+# @param[in] s Socket that is already open and connected to the FPGA board.
+# @param[in] cmd CmdBatch used for command encoding.
+# @param[in] regShadow ConfigRegShadow of the board, or None.
+# @param[in] codes sequence of DAC codes.
+# @param[in] name board name, prefixed to the timing phases.
+# @param[in] nSamples conversions averaged per channel; above 1 the
+#            standard deviations follow the volts in each row.
+# @return ChipScan
+def chip_scan(s, cmd, regShadow, codes, div=7, name=None, nSamples=1):
+    # phases are per board when several boards run in parallel
+    board_phase = name + ":" if name else ""
+    dac8568 = DAC8568(cmd, regShadow=regShadow)
+    with profiler.timed("send"):
+        s.sendall(dac8568.set_voltages({6 : 1.2}))
 
     # enable SDM clock
 #    s.sendall(cmd.write_register(9, 0x01))
@@ -318,74 +471,254 @@ if __name__ == "__main__":
     sdmTest = True
 
     tms1mmReg = TMS1mmReg()
-    tms1mmReg.set_power_down(0, 0)
-    tms1mmReg.set_power_down(3, 0)
-
-    if bufferTest:
-        tms1mmReg.set_k(0, 0) # 0 - K1 is open, disconnect CSA output
-        tms1mmReg.set_k(1, 1) # 1 - K2 is closed, allow BufferX2_testIN to inject signal
-        tms1mmReg.set_k(4, 0) # 0 - K5 is open, disconnect SDM loads
-        tms1mmReg.set_k(6, 1) # 1 - K7 is closed, BufferX2 output to AOUT_BufferX2
-    if x2gain == 2:
-        tms1mmReg.set_k(2, 1) # 1 - K3 is closed, K4 is open, setting gain to X2
-        tms1mmReg.set_k(3, 0)
+    tms1mmReg.set_test_mode(bufferTest, x2gain, sdmTest)
+    tms1mmReg.apply_preset('aout') # K7, K8 closed, BufferX2 and CSA out to AOUT
+
+    codes = list(codes)
+    # all six DACs (VBIASN R45, VBIASP R47, VCASN R29, VCASP R27,
+    # VDIS R16 (use external DAC), VREF R14) follow the code
+    with profiler.timed("encode"):
+        frames = SweepFrames(tms1mmReg.sweep_words(dict(("DAC{0:d}".format(i), codes)
+                                                        for i in range(tms1mmReg.nDAC))),
+                             div, cmd=cmd)
+
+    rows = []
+    adc = ADS124S0X(cmd, regShadow=regShadow)
+    channels = list(ADS124S0X.scanChannels)
+    with profiler.phase(board_phase + "adc"):
+        # reset
+        with profiler.timed("send"):
+            s.sendall(adc.write_spi(0x06<<24))
+        with profiler.timed("wait"):
+            time.sleep(0.005) # > 4096*(tCLK = 4.096MHz)
+        # initialize, converting continuously from here on
+        with profiler.timed("send"):
+            s.sendall(adc.initialize())
+    if nSamples > 1 and timing.verbosity >= 1:
+        print("{0:d} conversions per channel, {1:.2f}s per point".format(
+            nSamples, adc.oversample_time(len(channels), nSamples)))
+
+    # measure the ADC channels once the vector is in the SR
+    times = []
+    def measure(i, data_to_send):
+        timing.debug(1, "Sent:   0x{0:0x}".format, data_to_send)
+        times.append(time.time())
+        row = [codes[i]]
+        if nSamples > 1:
+            with profiler.phase(board_phase + "adc"):
+                stats = adc.oversample(s, channels, nSamples)
+            volts, sigmas = stats.mean, stats.std()
+            if timing.verbosity >= 1:
+                for ch, v, e in zip(channels, volts, sigmas):
+                    # volt2temp() is linear, so the sigma scales with the slope
+                    c = "{0:7.3f}+-{1:5.3f}C".format(adc.volt2temp(v), e / adc.tempSlope) if ch == -1 else ""
+                    print("ch={0:2d} {1:12.9f}+-{2:11.9f}V {3}".format(ch, v, e, c))
+            row.extend(volts.tolist() + sigmas.tolist())
+        else:
+            with profiler.phase(board_phase + "adc"):
+                volts = adc.scan(s, channels, diag=timing.verbosity >= 2)
+            if timing.verbosity >= 1:
+                for ch, val, v in zip(channels, adc.lastCodes, volts):
+                    c = "{0:7.3f}C".format(adc.adctemp(val)) if ch == -1 else ""
+                    print("0x{0:08x} {1:d} {2:12.9f}V {3}".format(val, val&0xffffff, v, c))
+            row.extend(volts.tolist())
+        rows.append(row)
+
+    # each vector is validated by the read-back of the next shift
+    with profiler.phase(board_phase + "sr"):
+        result = sr_sweep(s, frames, div, measure, regShadow=regShadow, cmd=cmd)
+    if result.ok:
+        if timing.verbosity >= 1:
+            print("Read-back successful.")
     else:
-        tms1mmReg.set_k(2, 0)
-        tms1mmReg.set_k(3, 1)
-    if sdmTest:
-        tms1mmReg.set_k(4, 0)
-        tms1mmReg.set_k(5, 1)
+        print("Read-back failed!")
+        print(result.report())
+    meta = {'register' : tms1mmReg.get_reg_map(), 'sweep' : ["DAC{0:d}".format(i) for i in range(tms1mmReg.nDAC)],
+            'div' : div, 'channels' : channels, 'nSamples' : nSamples,
+            'adc' : {'dataRate' : adc.dataRate, 'filter' : adc.filt, 'gain' : adc.gain, 'pga' : adc.pga},
+            'dac8568' : dac8568.codes}
+    bad = set(i for i, v, r in result.mismatches())
+    return ChipScan(rows, times, [i not in bad for i in range(len(rows))], meta)
+
+## DAC code scan of one chip, see chip_scan().
+#
+# @param[in] fp optional open data file, one line per code is appended.
+# @param[in] scanfname optional binary scan file (see scan_file) the
+#            points are appended to, as a new run.
+# @param[in] meta metadata for the header of a new scan file; the
+#            register and ADC settings are added to it.
+# @return list of rows [dacCode, volt(ch=-1), volt(ch=0), ..., volt(ch=6)
+#         (, sigma(ch=-1), ..., sigma(ch=6))]
+def dac_code_scan(s, cmd, regShadow, codes, fp=None, div=7, name=None, nSamples=1,
+                  scanfname=None, meta=None):
+    scan = chip_scan(s, cmd, regShadow, codes, div, name, nSamples)
+    if fp:
+        with profiler.timed("file write"):
+            write_text_rows(fp, scan.rows)
+    if scanfname and scan.rows:
+        meta = dict(meta or {})
+        meta.update(scan.meta)
+        with profiler.timed("file write"):
+            write_probe_scan(scanfname, scan.rows, scan.times, scan.ok, meta)
+    return scan.rows
+
+## Append rows of dac_code_scan() to an open text data file
+def write_text_rows(fp, rows):
+    for row in rows:
+        fp.write("{0:6d} ".format(int(row[0])))
+        fp.write("".join(" {0:12.9f}".format(v) for v in row[1:]))
+        fp.write("\n")
+    fp.flush()
+
+## Append the rows of dac_code_scan() to a binary scan file as a new run,
+# whose metadata goes to meta["runs"][run] of the file.  A file holding
+# records of another layout, e.g. from a scan with another number of
+# samples, is left alone and the run starts a new file.
+# @param[in] ok readback-OK flag of each row.
+# @return name of the file written
+def write_probe_scan(fname, rows, times, ok, meta=None):
+    vals = np.array(rows, dtype=float)
+    nCh = len(ADS124S0X.scanChannels)
+    dtype = probe_dtype(nCh, vals.shape[1] > 1 + nCh)
+    meta = dict(meta or {})
+    name = appendable_name(fname, dtype)
+    if name != fname:
+        print("{0:s} holds another record layout, writing {1:s}".format(fname, name))
+    run = 0
+    if os.path.exists(name) and os.path.getsize(name) > 0:
+        fileMeta, prev = read_scan(name)
+        if len(prev) > 0:
+            run = int(prev['run'][-1]) + 1
+        del prev
+        runs = fileMeta.setdefault('runs', [])
+        runs.extend([None] * (run - len(runs)))
+        runs[run:] = [meta]
+        write_meta(name, fileMeta)
     else:
-        tms1mmReg.set_k(5, 0)
-
-    for dacCode in xrange(args.code_lower, args.code_upper+1, args.code_step):
-        fp.write("{0:6d} ".format(dacCode))
-
-        tms1mmReg.set_k(6, 1) # 1 - K7 is closed, BufferX2 output to AOUT_BufferX2
-        tms1mmReg.set_k(7, 1) # 1 - K8 is closed, connect CSA out to AOUT1_CSA
-        tms1mmReg.set_dac(0, dacCode) # VBIASN R45
-        tms1mmReg.set_dac(1, dacCode) # VBIASP R47
-        tms1mmReg.set_dac(2, dacCode) # VCASN  R29
-        tms1mmReg.set_dac(3, dacCode) # VCASP  R27
-        tms1mmReg.set_dac(4, dacCode) # VDIS   R16, use external DAC
-        tms1mmReg.set_dac(5, dacCode) # VREF   R14
-
-        data_to_send = tms1mmReg.get_config_vector()
-        print("Sent:   0x{0:0x}".format(data_to_send))
-
-        div=7
-        # write/read twice for validation
-        shift_register_rw(s, (data_to_send), div)
-        ret = shift_register_rw(s, (data_to_send), div)
-        if data_to_send == ret:
-            print("Read-back successful.")
+        fileMeta = {'chip' : meta.get('chip'), 'runs' : [meta]}
+    data = np.zeros(len(vals), dtype=dtype)
+    data['run'] = run
+    data['code'] = vals[:, 0]
+    data['volt'] = vals[:, 1:1 + nCh]
+    if 'sigma' in dtype.names:
+        data['sigma'] = vals[:, 1 + nCh:1 + 2 * nCh]
+    data['time'] = times
+    data['readback_ok'] = ok
+    with ScanWriter(name, dtype, fileMeta, append=True) as w:
+        w.append_rows(data)
+    return name
+
+## Data file name of the chip at (x, y), without extension
+def chip_file_base(prefix, x, y):
+    return prefix + "x{0:04d}y{1:04d}".format(x, y)
+
+## Scan the chip under one board, see probe_chip() for board.info.
+# The SMU current trace of the scan is taken along, so the results can
+# be written with save_chip() while the next chip is powered up.
+# @return ChipScan with tStart, tEnd and smuTrace added
+def acquire_chip(board, codes, div=7, nSamples=1):
+    tStart = time.time()
+    with profiler.phase(board.name + ":chip"):
+        scan = chip_scan(board.s, board.cmd, board.regShadow, codes, div, board.name, nSamples)
+    scan.x, scan.y = board.info['x'], board.info['y']
+    scan.tStart, scan.tEnd = tStart, time.time()
+    scan.meta.update({'chip' : [scan.x, scan.y], 'board' : repr(board),
+                      'smu' : repr(board.info.get('smu')), 'start' : tStart})
+    scan.smuTrace = None
+    if board.info.get('smu') is not None:
+        scan.smuTrace = board.info['smu'].snapshot(scan.tStart, scan.tEnd)
+    return scan
+
+## Write the results of acquire_chip(): the data file, the SMU current
+# trace and the DAC calibration.
+def save_chip(board, scan):
+    base = chip_file_base(board.info['prefix'], scan.x, scan.y)
+    with profiler.timed("file write"):
+        if board.info.get('binary'):
+            # binary scan file instead of the text one
+            if scan.rows:
+                write_probe_scan(base + ".scan", scan.rows, scan.times, scan.ok, scan.meta)
         else:
-            print("Read-back failed!")
+            with open(base + ".dat", "a+") as fp:
+                fp.write("\n\n# Chip {0:d} {1:d}\n".format(scan.x, scan.y))
+                write_text_rows(fp, scan.rows)
+        if scan.smuTrace is not None:
+            write_smu_trace(base + "_smu.dat", *scan.smuTrace)
+    if board.info.get('calib') is not None and scan.rows:
+        board.info['calib'].put(scan.x, scan.y, DACCalibration.from_rows(scan.rows))
+
+## Probe the chip under one board: board.info holds the chip location
+# 'x', 'y', the data file prefix and optionally a DACCalibrationStore
+# 'calib' to keep the measured DAC curves in and the SMU2450 'smu'
+# powering the chip, whose current trace is saved next to the data.
+# With 'binary' set, the data go to a binary .scan file.
+# To be run through BoardRegistry.run().
+def probe_chip(board, codes, div=7, nSamples=1):
+    print("{0:s}: writing data to {1:s}{2:s}".format(
+        board.name, chip_file_base(board.info['prefix'], board.info['x'], board.info['y']),
+        ".scan" if board.info.get('binary') else ".dat"))
+    scan = acquire_chip(board, codes, div, nSamples)
+    save_chip(board, scan)
+    if profiler.enabled:
+        phases = [board.name + ":" + p for p in ("chip", "sr", "adc")]
+        print("{0:s}: timing of chip {1:d} {2:d}".format(board.name, scan.x, scan.y))
+        print(profiler.summary(phases))
+        profiler.reset(phases)
+    return scan.rows
 
-        adc = ADS124S0X(cmd)
-        # reset
-        s.sendall(adc.write_spi(0x06<<24))
-        time.sleep(0.005) # > 4096*(tCLK = 4.096MHz)
-        # initialize
-        s.sendall(adc.initialize())
-        # get data
-        for ch in xrange(-1, 7):
-            # select channel
-            s.sendall(adc.select_channel(ch))
-            time.sleep(adc.acqDelay)
-            # read reg
-            ret = adc.read_reg(0x02)
-            s.sendall(ret)
-            val = adc.recv_din(s)
-            print("ch={0:2d} 0x{1:08x}".format(ch, val))
-            # RDATA
-            val = adc.recv_data(s)
-            c = "{0:7.3f}C".format(adc.adctemp(val)) if ch == -1 else ""
-            print("0x{0:08x} {1:d} {2:12.9f}V {3}".format(val, val&0xffffff, adc.adcvolt(val), c))
-            fp.write(" {0:12.9f}".format(adc.adcvolt(val)))
-        fp.write("\n")
-        fp.flush()
+if __name__ == "__main__":
 
-    s.close()
-    smu.volt_off()
-    fp.close()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--smu-ip-port", type=str, action="append", help="SMU 2450 ipaddr and port, one per board or one shared [192.168.2.100:5025]")
+    parser.add_argument("-c", "--control-ip-port", type=str, action="append", help="main control system ipaddr and port, repeat for each board [192.168.2.3:1024]")
+    parser.add_argument("-l", "--code-lower", type=int, default=0, help="Code scan lower limit")
+    parser.add_argument("-u", "--code-upper", type=int, default=58000, help="Code scan upper limit")
+    parser.add_argument("-s", "--code-step", type=int, default=2000, help="Code scan step size")
+    parser.add_argument("-p", "--prefix", type=str, default="data/", help="Data file prefix, can be used to put files under directories")
+    parser.add_argument("-n", "--samples", type=int, default=1, help="ADC conversions averaged per channel, mean and sigma are recorded when > 1")
+    parser.add_argument("-e", "--settle-tolerance", type=float, default=1e-3, help="SMU current spread [A] taken as settled after power-on")
+    parser.add_argument("-b", "--binary", action="store_true", help="Write binary .scan files (see scan_file) instead of text .dat files")
+    parser.add_argument("-d", "--calib-dir", type=str, default=None, help="Store the per-chip DAC calibration tables under this directory")
+    parser.add_argument("-t", "--timing", action="store_true", help="Print per-operation latency statistics after each chip")
+    parser.add_argument("-v", "--verbose", action="count", default=1, help="Verbosity: -v adds command hex dumps")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print errors and the timing summary")
+    parser.add_argument("xy", type=int, nargs="+", help="Chip location x y, one pair per board")
+
+    args = parser.parse_args()
+    ctrlipports = args.control_ip_port or ["192.168.2.3:1024"]
+    smuipports = args.smu_ip_port or ["192.168.2.100:5025"]
+    if len(args.xy) != 2 * len(ctrlipports):
+        parser.error("need one chip location x y per board")
+    if len(smuipports) not in (1, len(ctrlipports)):
+        parser.error("need one SMU, or one SMU per board")
+    timing.enable(args.timing)
+    timing.set_verbosity(0 if args.quiet else args.verbose)
+
+    smus = []
+    for smuipport in smuipports:
+        smuipport = smuipport.split(':')
+        smus.append(SMU2450(smuipport[0], int(smuipport[1])))
+    for smu in smus:
+        smu.volt_on()
+    for smu in smus:
+        settled, dt, current = smu.wait_until_settled(tolerance=args.settle_tolerance)
+        print("{0} {1:s} after {2:.2f}s at {3:.6f}A".format(
+            smu, "settled" if settled else "NOT settled", dt, current))
+
+    calib = DACCalibrationStore(args.calib_dir) if args.calib_dir else None
+    boards = BoardRegistry()
+    for i, ctrlipport in enumerate(ctrlipports):
+        boards.add("board{0:d}".format(i), ctrlipport,
+                   {'x' : args.xy[2*i], 'y' : args.xy[2*i+1], 'prefix' : args.prefix,
+                    'calib' : calib, 'smu' : smus[i % len(smus)], 'binary' : args.binary})
+    results = boards.connect_all()
+    codes = xrange(args.code_lower, args.code_upper+1, args.code_step)
+    results.update(boards.run(probe_chip, codes, nSamples=args.samples, boards=BoardRegistry.succeeded(results)))
+    BoardRegistry.report(results)
+
+    boards.close_all()
+    for smu in smus:
+        smu.volt_off()
+        smu.close()
+    if profiler.enabled:
+        print(profiler.summary())
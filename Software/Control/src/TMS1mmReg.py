@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package TMS1mmReg
+# Register map of the Topmetal-S 1mm chip's 130-bit configuration
+# shift register, shared by the single-chip, probe card and scan
+# scripts.
+#
+
+from __future__ import print_function
+import numpy as np
+
+## Manage Topmetal-S 1mm chip's internal register map.
+# Allow combining and disassembling individual registers
+# to/from long integer for I/O
+#
+# The register map is held as the 130-bit config vector itself; every
+# set_* updates its field in place, so get_config_vector() costs
+# nothing.
+#
+# Bit layout, MSB first:
+#   vbiasn[129:126] vbiasp[125:122] vcasn[121:118] vcasp[117:114] vref[113:110]
+#   K1..K10[109:100] PD1..PD4[99:96] DAC1..DAC6[95:0], 16 bits each
+#
+class TMS1mmReg(object):
+    __slots__ = ('_vector',)
+
+    nBits = 130
+    nDAC = 6
+    nPD = 4
+    nK = 10
+    ## @var _scalarFields lsb of the 4-bit bias fields
+    _scalarFields = {'vbiasn' : 126, 'vbiasp' : 122, 'vcasn' : 118, 'vcasp' : 114, 'vref' : 110}
+
+    ## @var _defaultRegMap default register values
+    _defaultRegMap = {
+        'DAC'    : [0x75c3, 0x8444, 0x7bbb, 0x7375, 0x86d4, 0xe4b2], # from DAC1 to DAC6
+        'PD'     : [1, 1, 1, 1], # from PD1 to PD4, 1 means powered down
+        'K'      : [1, 0, 1, 0, 1, 0, 0, 0, 0, 0], # from K1 to K10, 1 means closed (conducting)
+        'vref'   : 0x8,
+        'vcasp'  : 0x8,
+        'vcasn'  : 0x8,
+        'vbiasp' : 0x8,
+        'vbiasn' : 0x8
+    }
+
+    dac_fit_a = 4.35861E-5
+    dac_fit_b = 0.0349427
+
+    ## @param[in] vector initial 130-bit config vector, the defaults if None.
+    def __init__(self, vector=None):
+        if vector is None:
+            vector = self._defaultVector
+        self._vector = vector & ((1 << self.nBits) - 1)
+
+    ## Decode a config vector, e.g. one read back from the SR
+    @classmethod
+    def from_config_vector(cls, vector):
+        return cls(vector)
+
+    ## Build a config vector from a register map dict (see _defaultRegMap)
+    @classmethod
+    def from_reg_map(cls, regMap):
+        reg = cls(0)
+        for i, v in enumerate(regMap['DAC']):
+            reg.set_dac(i, v)
+        for i, v in enumerate(regMap['PD']):
+            reg.set_power_down(i, v)
+        for i, v in enumerate(regMap['K']):
+            reg.set_k(i, v)
+        for name in cls._scalarFields:
+            reg._set_field(cls._scalarFields[name], 4, regMap[name])
+        return reg
+
+    def copy(self):
+        return TMS1mmReg(self._vector)
+
+    def __eq__(self, other):
+        return isinstance(other, TMS1mmReg) and self._vector == other._vector
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "TMS1mmReg(0x{0:0x})".format(self._vector)
+
+    def _set_field(self, lsb, width, val):
+        mask = ((1 << width) - 1) << lsb
+        self._vector = (self._vector & ~mask) | ((val << lsb) & mask)
+
+    def _get_field(self, lsb, width):
+        return (self._vector >> lsb) & ((1 << width) - 1)
+
+    def set_dac(self, i, val):
+        self._set_field((self.nDAC - 1 - i) * 16, 16, val)
+
+    def set_power_down(self, i, onoff):
+        self._set_field(99 - i, 1, onoff)
+
+    def set_k(self, i, onoff):
+        self._set_field(109 - i, 1, onoff)
+
+    def set_vref(self, val):
+        self._set_field(110, 4, val)
+
+    def set_vcasp(self, val):
+        self._set_field(114, 4, val)
+
+    def set_vcasn(self, val):
+        self._set_field(118, 4, val)
+
+    def set_vbiasp(self, val):
+        self._set_field(122, 4, val)
+
+    def set_vbiasn(self, val):
+        self._set_field(126, 4, val)
+
+    def get_dac(self, i):
+        return self._get_field((self.nDAC - 1 - i) * 16, 16)
+
+    def get_power_down(self, i):
+        return self._get_field(99 - i, 1)
+
+    def get_k(self, i):
+        return self._get_field(109 - i, 1)
+
+    def get_vref(self):
+        return self._get_field(110, 4)
+
+    def get_vcasp(self):
+        return self._get_field(114, 4)
+
+    def get_vcasn(self):
+        return self._get_field(118, 4)
+
+    def get_vbiasp(self):
+        return self._get_field(122, 4)
+
+    def get_vbiasn(self):
+        return self._get_field(126, 4)
+
+    ## Get long-integer variable
+    def get_config_vector(self):
+        return self._vector
+
+    ## Decode into a register map dict, in the form of _defaultRegMap
+    def get_reg_map(self):
+        regMap = {
+            'DAC' : [self.get_dac(i) for i in range(self.nDAC)],
+            'PD'  : [self.get_power_down(i) for i in range(self.nPD)],
+            'K'   : [self.get_k(i) for i in range(self.nK)]
+        }
+        for name, lsb in self._scalarFields.items():
+            regMap[name] = self._get_field(lsb, 4)
+        return regMap
+
+    ## Position of a named field, for sweep_words()
+    # @param[in] name 'DAC0'..'DAC5', 'K0'..'K9', 'PD0'..'PD3' (0-based, as
+    #            in set_dac() etc.), or 'vref', 'vcasp', 'vcasn', 'vbiasp', 'vbiasn'.
+    # @return (lsb, width)
+    @classmethod
+    def field_position(cls, name):
+        if name in cls._scalarFields:
+            return cls._scalarFields[name], 4
+        for prefix, n, pos in (('DAC', cls.nDAC, lambda i: ((cls.nDAC - 1 - i) * 16, 16)),
+                               ('PD',  cls.nPD,  lambda i: (99 - i, 1)),
+                               ('K',   cls.nK,   lambda i: (109 - i, 1))):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                i = int(name[len(prefix):])
+                if i < n:
+                    return pos(i)
+        raise KeyError(name)
+
+    ## Config vectors of a whole sweep, in one vectorized step.
+    # Starting from the current state, each named field takes its value
+    # from the corresponding array; scalars are broadcast.
+    # @param[in] fields dict field name -> array of values, see field_position().
+    # @return uint16 array (N, 9), row i holds the 16-bit words of vector i,
+    #         least significant first (config_reg order).
+    def sweep_words(self, fields):
+        nWords = (self.nBits + 15) // 16
+        names = list(fields)
+        vals = np.broadcast_arrays(*[np.asarray(fields[k], dtype=np.uint64) for k in names])
+        n = vals[0].size if vals else 1
+        base = [(self._vector >> (16 * w)) & 0xffff for w in range(nWords)]
+        words = np.tile(np.array(base, dtype=np.uint64), (n, 1))
+        for name, v in zip(names, vals):
+            lsb, width = self.field_position(name)
+            v = np.ravel(v) & np.uint64((1 << width) - 1)
+            for w in range(lsb // 16, (lsb + width - 1) // 16 + 1):
+                shift = lsb - 16 * w
+                if shift >= 0:
+                    part = v << np.uint64(shift)
+                    m = ((1 << width) - 1) << shift
+                else:
+                    part = v >> np.uint64(-shift)
+                    m = ((1 << width) - 1) >> -shift
+                m &= 0xffff
+                words[:, w] = (words[:, w] & np.uint64(~m & 0xffff)) | (part & np.uint64(m))
+        return words.astype(np.uint16)
+
+    ## @var presets name -> (mask, bits) of the switch settings of each
+    # test mode, applied in place by apply_preset()
+    presets = {}
+
+    ## Apply named presets in order, see presets
+    def apply_preset(self, *names):
+        for name in names:
+            mask, bits = self.presets[name]
+            self._vector = (self._vector & ~mask) | bits
+
+    ## Set up the usual test modes.
+    # @param[in] bufferTest inject through BufferX2_testIN, observe AOUT_BufferX2.
+    # @param[in] x2gain 2 or 1, BufferX2 gain.
+    # @param[in] sdmTest True/False to enable/disable the SDM test, None to leave it.
+    def set_test_mode(self, bufferTest=True, x2gain=2, sdmTest=None):
+        self.apply_preset('powerUp')
+        if bufferTest:
+            self.apply_preset('bufferTest')
+        self.apply_preset('x2gain' if x2gain == 2 else 'x1gain')
+        if sdmTest is not None:
+            self.apply_preset('sdmTest' if sdmTest else 'sdmOff')
+
+    ## DAC code of a voltage by the linear fit, scalar or array.
+    # See dac_calib for per-chip calibration tables.
+    def dac_volt2code(self, v):
+        c = np.trunc((np.asarray(v, dtype=float) - self.dac_fit_b) / self.dac_fit_a)
+        c = np.clip(c, 0, 65535).astype(int)
+        return int(c) if c.ndim == 0 else c
+
+    def dac_code2volt(self, c):
+        v = np.asarray(c, dtype=float) * self.dac_fit_a + self.dac_fit_b
+        return float(v) if v.ndim == 0 else v
+
+## (mask, bits) of a preset given as [(K index, onoff), ...] and [(PD index, onoff), ...]
+def _make_preset(k=(), pd=()):
+    mask = 0
+    bits = 0
+    for i, onoff in k:
+        mask |= 1 << (109 - i)
+        bits |= (onoff & 1) << (109 - i)
+    for i, onoff in pd:
+        mask |= 1 << (99 - i)
+        bits |= (onoff & 1) << (99 - i)
+    return mask, bits
+
+TMS1mmReg.presets = {
+    # power up PD1 and PD4
+    'powerUp'    : _make_preset(pd=[(0, 0), (3, 0)]),
+    # K1 open: disconnect CSA output, K2 closed: allow BufferX2_testIN to inject signal,
+    # K5 open: disconnect SDM loads, K7 closed: BufferX2 output to AOUT_BufferX2
+    'bufferTest' : _make_preset(k=[(0, 0), (1, 1), (4, 0), (6, 1)]),
+    # K3 closed, K4 open: BufferX2 gain X2
+    'x2gain'     : _make_preset(k=[(2, 1), (3, 0)]),
+    'x1gain'     : _make_preset(k=[(2, 0), (3, 1)]),
+    'sdmTest'    : _make_preset(k=[(4, 0), (5, 1)]),
+    'sdmOff'     : _make_preset(k=[(5, 0)]),
+    # K7 closed: BufferX2 output to AOUT_BufferX2, K8 closed: CSA out to AOUT1_CSA
+    'aout'       : _make_preset(k=[(6, 1), (7, 1)]),
+}
+TMS1mmReg._defaultVector = TMS1mmReg.from_reg_map(TMS1mmReg._defaultRegMap).get_config_vector()
@@ -12,10 +12,12 @@ import math,sys,time,os,shutil
 import socket
 from command import *
 import TMS1mmSingle
+from dac_calib import *
 
 class CommonData(object):
 
-    def __init__(self, tms1mmReg):
+    ## @param[in] calib DACCalibration of the chip, the linear fit if None.
+    def __init__(self, tms1mmReg, calib=None):
         # number of voltages to control
         self.nVolts = 7
         # update time interval (second)
@@ -33,6 +35,7 @@ class CommonData(object):
         self.inputIs = [0.0 for i in xrange(self.nVolts)]
 
         self.tms1mmReg = tms1mmReg
+        self.calib = calib if calib is not None else DACCalibration()
 
 class ControlPanelGUI(object):
 
@@ -113,7 +116,7 @@ class ControlPanelGUI(object):
         with self.cd.cv:
             for i in xrange(self.nVolts):
                 self.cd.inputVs[i] = self.voltsSetVars[i].get()
-                self.cd.inputVcodes[i] = self.cd.tms1mmReg.dac_volt2code(self.cd.inputVs[i])
+                self.cd.inputVcodes[i] = self.cd.calib.volt2code(i, self.cd.inputVs[i])
                 self.voltsSetCodeVars[i].set(self.cd.inputVcodes[i])
             self.cd.vUpdated = True
             print(self.cd.inputVs)
@@ -124,7 +127,7 @@ class ControlPanelGUI(object):
         with self.cd.cv:
             for i in xrange(self.nVolts):
                 self.cd.inputVcodes[i] = self.voltsSetCodeVars[i].get()
-                self.cd.inputVs[i] = self.cd.tms1mmReg.dac_code2volt(self.cd.inputVcodes[i])
+                self.cd.inputVs[i] = self.cd.calib.code2volt(i, self.cd.inputVcodes[i])
                 self.voltsSetVars[i].set(self.cd.inputVs[i])
             self.cd.vUpdated = True
             print(self.cd.inputVcodes)
@@ -140,7 +143,7 @@ class TMS1mmConfig(threading.Thread):
         threading.Thread.__init__(self)
         self.cd = cd
         self.s = s
-        self.cmd = Cmd()
+        self.cmd = CmdBatch()
         self.dac8568 = TMS1mmSingle.DAC8568(self.cmd)
         self.tms1mmReg = cd.tms1mmReg
 
@@ -158,45 +161,17 @@ class TMS1mmConfig(threading.Thread):
         bufferTest = True
         sdmTest = True
 
-        self.tms1mmReg.set_power_down(0, 0)
-        self.tms1mmReg.set_power_down(3, 0)
-
-        if bufferTest:
-            self.tms1mmReg.set_k(0, 0) # 0 - K1 is open, disconnect CSA output
-            self.tms1mmReg.set_k(1, 1) # 1 - K2 is closed, allow BufferX2_testIN to inject signal
-            self.tms1mmReg.set_k(4, 0) # 0 - K5 is open, disconnect SDM loads
-            self.tms1mmReg.set_k(6, 1) # 1 - K7 is closed, BufferX2 output to AOUT_BufferX2
-        if x2gain == 2:
-            self.tms1mmReg.set_k(2, 1) # 1 - K3 is closed, K4 is open, setting gain to X2
-            self.tms1mmReg.set_k(3, 0)
-        else:
-            self.tms1mmReg.set_k(2, 0)
-            self.tms1mmReg.set_k(3, 1)
-        if sdmTest:
-            self.tms1mmReg.set_k(4, 0)
-            self.tms1mmReg.set_k(5, 1)
-        else:
-            self.tms1mmReg.set_k(5, 0)
-
-        s.sendall(dac8568.turn_on_2V5_ref())
-        s.sendall(dac8568.set_voltage(7, 1.65)) # DAC_CH8 -> Ref2 1.65V
-
-        self.tms1mmReg.set_k(6, 1) # 1 - K7 is closed, BufferX2 output to AOUT_BufferX2
-        self.tms1mmReg.set_k(7, 1) # 1 - K8 is closed, connect CSA out to AOUT1_CSA
-        self.tms1mmReg.set_dac(0, self.cd.inputVcodes[0]) # VBIASN
-        s.sendall(dac8568.set_voltage(0, self.cd.inputVs[0]))
-        self.tms1mmReg.set_dac(1, self.cd.inputVcodes[1]) # VBIASP
-        s.sendall(dac8568.set_voltage(1, self.cd.inputVs[1]))
-        self.tms1mmReg.set_dac(2, self.cd.inputVcodes[2]) # VCASN
-        s.sendall(dac8568.set_voltage(2, self.cd.inputVs[2]))
-        self.tms1mmReg.set_dac(3, self.cd.inputVcodes[3]) # VCASP
-        s.sendall(dac8568.set_voltage(3, self.cd.inputVs[3]))
-        self.tms1mmReg.set_dac(4, self.cd.inputVcodes[4]) # VDIS
-        s.sendall(dac8568.set_voltage(4, self.cd.inputVs[4]))
-        self.tms1mmReg.set_dac(5, self.cd.inputVcodes[5]) # VREF
-        s.sendall(dac8568.set_voltage(5, self.cd.inputVs[5]))
-        #
-        s.sendall(dac8568.set_voltage(6, self.cd.inputVs[6])) # DAC_BufferX2_VREF
+        self.tms1mmReg.set_test_mode(bufferTest, x2gain, sdmTest)
+
+        self.tms1mmReg.apply_preset('aout') # K7, K8 closed, BufferX2 and CSA out to AOUT
+        # VBIASN, VBIASP, VCASN, VCASP, VDIS, VREF
+        for i in xrange(self.tms1mmReg.nDAC):
+            self.tms1mmReg.set_dac(i, self.cd.inputVcodes[i])
+        # the same on the external DAC, plus DAC_BufferX2_VREF and
+        # DAC_CH8 -> Ref2 1.65V, all updated at once; unchanged channels
+        # are not sent again
+        volts = self.cd.inputVs[:7] + [1.65]
+        self.s.sendall(self.dac8568.set_voltages(volts))
 
         data_to_send = self.tms1mmReg.get_config_vector()
         print("Sent:   0x%0x" % (data_to_send))
@@ -213,7 +188,7 @@ if __name__ == "__main__":
     s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
     s.connect((host,port))
 
-    cmd = Cmd()
+    cmd = CmdBatch()
     dac8568 = TMS1mmSingle.DAC8568(cmd)
     s.sendall(dac8568.turn_on_2V5_ref())
     s.sendall(dac8568.set_voltage(6, 1.2))
@@ -224,7 +199,11 @@ if __name__ == "__main__":
     root = tk.Tk()
     root.wm_title("Topmetal-S 1mm version Tuner")
 
-    cd = CommonData(TMS1mmSingle.TMS1mmReg())
+    # optional chip location x y: use its DAC calibration from calib/
+    calib = None
+    if len(sys.argv) >= 3:
+        calib = DACCalibrationStore().get(int(sys.argv[1]), int(sys.argv[2]))
+    cd = CommonData(TMS1mmSingle.TMS1mmReg(), calib)
     tms1mmConfig = TMS1mmConfig(cd, s)
 
     controlPanel = ControlPanelGUI(root, cd)
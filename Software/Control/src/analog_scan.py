@@ -5,34 +5,95 @@
 # This file is used to config topmetal sram and array scan modules.
 #
 # tm_sram_config() configs the start address of sram and data sent to sram.
+# TMSramUploader keeps the last uploaded image and resends only changed words.
 # data_to_sram is an array, which contains 45*216 elements, each element is a 4-# bit width data.
 # tm_array_scan() controls the topmetal array scan module.  
 
 from command import *
+import timing
 import ctypes
 import socket
 import time
+import numpy as np
+
+## Pack 4-bit pixel values into 32-bit sram words, 8 pixels per word
+# with the first pixel in the least significant nibble.
+#
+# @param[in] data_to_sram sequence of 4-bit pixel values.
+# @return numpy uint32 array of (len(data_to_sram)+7)/8 words.
+def tm_sram_pack(data_to_sram):
+    pix = np.asarray(data_to_sram).astype(np.uint32) & 0xf
+    pix = np.concatenate((pix, np.zeros(-len(pix) % 8, dtype=np.uint32)))
+    return np.bitwise_or.reduce(pix.reshape(-1, 8) << (4 * np.arange(8, dtype=np.uint32)), axis=1)
+
+## Upload topmetal sram images in bounded chunks.  The last uploaded
+# image is kept, so that a following upload to the same address only
+# sends the 32-bit words that changed.
+#
+class TMSramUploader(object):
+
+    ## @param[in] chunkWords maximum number of 32-bit words per command string.
+    # @param[in] maxGap unchanged words between two changed runs that are
+    #            resent rather than starting a new address (costs 2 words each).
+    def __init__(self, cmd=None, chunkWords=2048, maxGap=1):
+        if cmd is None:
+            cmd = CmdBatch()
+        self.cmd = cmd
+        self.chunkWords = chunkWords
+        self.maxGap = maxGap
+        self.invalidate()
+
+    ## Forget the last uploaded image, e.g. after the board was reset.
+    def invalidate(self):
+        self._addr = None
+        self._words = None
+
+    ## Find [begin, end) runs of words that differ from the last upload.
+    def changed_runs(self, addr, words):
+        if self._words is None or self._addr != addr or len(self._words) != len(words):
+            return [(0, len(words))]
+        idx = np.flatnonzero(words != self._words)
+        if len(idx) == 0:
+            return []
+        split = np.flatnonzero(np.diff(idx) > self.maxGap + 1)
+        begins = idx[np.concatenate(([0], split + 1))]
+        ends = idx[np.concatenate((split, [len(idx) - 1]))] + 1
+        return list(zip(begins.tolist(), ends.tolist()))
+
+    ## Command strings that bring the sram from the last uploaded image to words.
+    def encode(self, start_addr, words):
+        addr = start_addr & ((1<<32) -1)
+        ret = []
+        for begin, end in self.changed_runs(addr, words):
+            for i in range(begin, end, self.chunkWords):
+                ret.append(self.cmd.write_memory(addr + i, words[i:min(end, i + self.chunkWords)]))
+        return ret
+
+    ## @param[in] s Socket that is already open and connected to the FPGA board.
+    # @param[in] start_addr address of first data sent to sram.
+    # @param[in] data_to_sram 4-bit pixel values.
+    # @return number of 32-bit words sent.
+    def upload(self, s, start_addr, data_to_sram):
+        words = tm_sram_pack(data_to_sram)
+        nsent = 0
+        for cmdstr in self.encode(start_addr, words):
+            s.sendall(cmdstr)
+            nsent += (len(cmdstr) - 8) // 8
+        self._addr = start_addr & ((1<<32) -1)
+        self._words = words
+        return nsent
 
 ## topmetal sram config function.
 #
 # @param[in] s Socket that is already open and connected to the FPGA board.
 # @param[in] start_addr address of first data sent to sram.
 # @param[in] data sent to sram.
-def tm_sram_config(s, start_addr, data_to_sram):
-    nval = int((len(data_to_sram)+7)/8)
-    addr = start_addr & ((1<<32) -1)
-    aval = [0 for i in xrange(nval)]
-    for i in xrange(len(data_to_sram)):
-        j = i % 8
-        k = i / 8
-        aval[k] += data_to_sram[i] << (j*4) 
-    cmd = Cmd()
-    cmdstr = ""
-    #write_memory
-    cmdstr += cmd.write_memory(addr, aval)
-    print [hex(ord(w)) for w in cmdstr]
-    
-    s.sendall(cmdstr)
+# @param[in] uploader optional TMSramUploader, only words changed since its last upload are sent.
+# @return number of 32-bit words sent.
+def tm_sram_config(s, start_addr, data_to_sram, uploader=None):
+    if uploader is None:
+        uploader = TMSramUploader()
+    return uploader.upload(s, start_addr, data_to_sram)
 
 ## topmetal array scan config function.
 #
@@ -40,21 +101,24 @@ def tm_sram_config(s, start_addr, data_to_sram):
 # @param[in] clk_div clock frequency division factor when array is scanning
 # @param[in] wr_clk_div clock frequency division factor when writing data into p# ixel.
 # @param[in] stop_addr controls where scanning stop.
+# @param[in] regShadow optional ConfigRegShadow, only changed config_reg words are sent.
 
-def tm_array_scan(s, clk_div, wr_clk_div, stop_addr, trig_rate, trig_delay, stop_clk_s, keep_we):
+def tm_array_scan(s, clk_div, wr_clk_div, stop_addr, trig_rate, trig_delay, stop_clk_s, keep_we, regShadow=None):
     
-    cmd = Cmd()
-    cmdstr = ""
+    cmd = CmdBatch()
 
     #write_register
     config_reg = ((trig_delay & 0xffff) << 48)|((trig_rate & 0xffff) << 32)|((stop_addr & 0xffff) << 16)|((keep_we & 0x1) << 9)|((stop_clk_s & 0x1) << 8)|((wr_clk_div & 0xf) << 4)|(clk_div & 0xf)
-    for i in xrange(4):
-        cmdstr += cmd.write_register(i+11, (config_reg >> i*16) & 0xffff)
+    words = [(config_reg >> i*16) & 0xffff for i in xrange(4)]
+    if regShadow is None:
+        cmdstr = cmd.write_registers(11, words)
+    else:
+        cmdstr = regShadow.write_registers(11, words)
     
     #send_pulse
     cmdstr += cmd.send_pulse(0x04)
 
-    print [hex(ord(w)) for w in cmdstr]
+    timing.debug(2, timing.hexdump, cmdstr)
 
     s.sendall(cmdstr)
 
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package benchmark
+# CPU micro-benchmarks of the per-point work of a scan: register
+# packing, command encoding, read-back decoding, ADC conversion and
+# function generator waveform strings.
+#
+# Times are normalized by a fixed pure-Python reference loop, so that
+# the baseline stored in benchmark_baseline.json carries over between
+# machines of similar architecture.  A run fails (exit status 1) when a
+# benchmark is slower than its baseline by more than the threshold.
+#
+# The Python command encoders are also checked bit-for-bit against
+# golden vectors produced by command.c (command_golden.json), and
+# against the compiled library itself when Cmd.soname is present.
+#
+
+from __future__ import print_function
+import os
+import sys
+import json
+import timeit
+import random
+import argparse
+from command import *
+from TMS1mmReg import TMS1mmReg
+from shift_register import sr_readback_value, SweepFrames
+from TMS1mmProbeCard import ADS124S0X
+from fungen_ctrl import tail_pulse_command, tail_pulse_samples, dac_block_command
+
+here = os.path.dirname(os.path.abspath(__file__))
+baselineFile = os.path.join(here, "benchmark_baseline.json")
+goldenFile = os.path.join(here, "command_golden.json")
+
+## Reference workload the benchmarks are normalized by
+def _reference():
+    x = 0
+    for i in range(1000):
+        x += i * i
+    return x
+
+def _bench_config_vector():
+    reg = TMS1mmReg()
+    return reg.get_config_vector
+
+def _bench_cmd_ctypes():
+    cmd = Cmd()
+    words = list(range(9))
+    def run():
+        cmdstr = b""
+        for i in range(9):
+            cmdstr += cmd.write_register(i, words[i])
+        cmdstr += cmd.send_pulse(0x01)
+        return cmdstr
+    return run
+
+def _bench_cmdbatch():
+    cmd = CmdBatch()
+    words = list(range(9))
+    def run():
+        return cmd.write_registers(0, words) + cmd.send_pulse(0x01)
+    return run
+
+def _bench_readback_decode():
+    retw = np.array([0x0004, 0x75c3, 0x8444, 0x7bbb, 0x7375, 0x86d4, 0xe4b2, 0x1234, 0x5678],
+                    dtype=np.uint16)
+    return lambda: sr_readback_value(retw)
+
+## a dac_scan batch: 512 DAC codes into config vectors and frames
+def _bench_sweep_frames():
+    reg = TMS1mmReg()
+    codes = np.arange(512)
+    return lambda: SweepFrames(reg.sweep_words({"DAC2": codes}), 7)
+
+def _bench_adcvolt():
+    adc = ADS124S0X(CmdBatch())
+    return lambda: adc.adcvolt(0x812345)
+
+def _bench_adctemp():
+    adc = ADS124S0X(CmdBatch())
+    return lambda: adc.adctemp(0x0d3a1c)
+
+def _bench_tail_pulse():
+    return lambda: tail_pulse_command(16, 1024, 0.01)
+
+def _bench_tail_pulse_block():
+    return lambda: dac_block_command(tail_pulse_samples(16, 1024, 0.01))
+
+## @var benchmarks name -> function returning the callable to time
+benchmarks = [
+    ("TMS1mmReg.get_config_vector", _bench_config_vector),
+    ("Cmd.encode_sr_write (ctypes)", _bench_cmd_ctypes),
+    ("CmdBatch.encode_sr_write",     _bench_cmdbatch),
+    ("sr_readback_value",            _bench_readback_decode),
+    ("SweepFrames (512 points)",     _bench_sweep_frames),
+    ("ADS124S0X.adcvolt",            _bench_adcvolt),
+    ("ADS124S0X.adctemp",            _bench_adctemp),
+    ("tail_pulse_command",           _bench_tail_pulse),
+    ("dac_block_command (tail pulse)", _bench_tail_pulse_block),
+]
+
+## Best time per call in seconds, over repeat runs of enough calls to
+# take about tRun seconds each.
+def time_call(func, repeat=5, tRun=0.05):
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= tRun / 10.0 or number >= 1<<20:
+            break
+        number *= 10
+    number = max(1, int(number * tRun / max(t, 1e-9)))
+    return min(timer.repeat(repeat, number)) / number
+
+## Run the benchmarks.
+# @return (reference time per call, {name : normalized time}); benchmarks
+#         that cannot be set up here (e.g. no command.so) are left out.
+def run_benchmarks(names=None, repeat=5):
+    tRef = time_call(_reference, repeat)
+    times = {}
+    for name, setup in benchmarks:
+        if names is not None and name not in names:
+            continue
+        try:
+            func = setup()
+        except (OSError, ImportError) as e:
+            print("{0:<32s} skipped: {1}".format(name, e))
+            continue
+        times[name] = time_call(func, repeat)
+    # the reference is timed again afterwards, to catch clock changes
+    tRef = min(tRef, time_call(_reference, repeat))
+    return tRef, dict((k, v / tRef) for k, v in times.items())
+
+def _baseline_key():
+    return "python{0:d}".format(sys.version_info[0])
+
+def load_baseline():
+    if not os.path.exists(baselineFile):
+        return {}
+    with open(baselineFile) as fp:
+        return json.load(fp)
+
+def save_baseline(results):
+    baseline = load_baseline()
+    baseline.setdefault(_baseline_key(), {}).update((k, float("%.4g" % v)) for k, v in results.items())
+    with open(baselineFile, "w") as fp:
+        json.dump(baseline, fp, indent=2, sort_keys=True)
+        fp.write("\n")
+
+## Compare results with the stored baseline.
+# @return list of names slower than baseline * (1 + threshold)
+def compare(tRef, results, threshold):
+    base = load_baseline().get(_baseline_key(), {})
+    slower = []
+    print("{0:<32s} {1:>10s} {2:>10s} {3:>10s}".format("benchmark", "time[us]", "x ref", "vs base"))
+    for name, _ in benchmarks:
+        if name not in results:
+            continue
+        r = results[name]
+        b = base.get(name)
+        rel = "{0:9.2f}x".format(r / b) if b else "       new"
+        print("{0:<32s} {1:10.3f} {2:10.3f} {3:>10s}".format(name, r * tRef * 1e6, r, rel))
+        if b and r > b * (1.0 + threshold):
+            slower.append(name)
+    return slower
+
+## Encode one golden case with a command generator
+def _encode(cmd, method, args):
+    return getattr(cmd, method)(*args)
+
+## Deterministic set of encoder cases, covering edge values and
+# values wider than the command fields.
+def golden_cases(n=64, seed=1):
+    rng = random.Random(seed)
+    edge = [0, 1, 0x7fff, 0xffff, 0x10000, 0xffffffff]
+    cases = []
+    for v in edge:
+        cases += [("send_pulse", [v]), ("read_status", [v & 0xff]), ("read_register", [v & 0xff]),
+                  ("write_register", [v & 0x3f, v]), ("read_datafifo", [v & 0xffff]),
+                  ("read_memory", [v, 1 + (v & 0xff)])]
+    for i in range(n):
+        cases += [("send_pulse", [rng.getrandbits(16)]),
+                  ("read_status", [rng.randrange(11)]),
+                  ("read_register", [rng.randrange(32)]),
+                  ("write_register", [rng.randrange(32), rng.getrandbits(16)]),
+                  ("read_datafifo", [rng.getrandbits(16)]),
+                  ("read_memory", [rng.getrandbits(32), rng.randrange(1, 1<<16)]),
+                  ("write_memory", [rng.getrandbits(32),
+                                    [rng.getrandbits(32) for j in range(rng.randrange(1, 9))]])]
+    return cases
+
+## Write command_golden.json from the compiled command.c library
+def make_golden():
+    cmd = Cmd()
+    out = [[m, a, _hex(_encode(cmd, m, a))] for m, a in golden_cases()]
+    with open(goldenFile, "w") as fp:
+        # one case per line keeps the file diffable
+        fp.write('{"generator": "command.c",\n "cases": [\n')
+        fp.write(",\n".join(json.dumps(c) for c in out))
+        fp.write("\n]}\n")
+    return len(out)
+
+def _hex(b):
+    return "".join("{0:02x}".format(x) for x in bytearray(b))
+
+## Check CmdBatch against the golden vectors and, when the library
+# can be loaded, against Cmd on fresh random cases.
+# @return list of mismatch descriptions
+def check_encoders(nLive=2000):
+    errors = []
+    batch = CmdBatch()
+    with open(goldenFile) as fp:
+        golden = json.load(fp)["cases"]
+    for method, args, expect in golden:
+        got = _hex(_encode(batch, method, args))
+        if got != expect:
+            errors.append("golden {0}{1}: {2} != {3}".format(method, tuple(args), got, expect))
+    try:
+        cmd = Cmd()
+    except OSError as e:
+        print("live check against command.c skipped: {0}".format(e))
+        return errors
+    for method, args in golden_cases(nLive // 7, seed=None):
+        a = _encode(cmd, method, args)
+        b = _encode(batch, method, args)
+        if a != b:
+            errors.append("live {0}{1}: {2} != {3}".format(method, tuple(args), _hex(b), _hex(a)))
+    return errors
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--threshold", type=float, default=0.5, help="allowed slow-down relative to the baseline")
+    parser.add_argument("-r", "--repeat", type=int, default=7, help="timing repeats, the best one is kept")
+    parser.add_argument("-n", "--retries", type=int, default=2, help="times a benchmark over the threshold is re-timed")
+    parser.add_argument("-s", "--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("-g", "--make-golden", action="store_true", help="regenerate command_golden.json from command.so")
+    parser.add_argument("--soname", type=str, default=None, help="path of the compiled command.c library")
+    parser.add_argument("names", type=str, nargs="*", help="benchmarks to run, all by default")
+    args = parser.parse_args()
+    if args.soname:
+        Cmd.soname = args.soname
+
+    if args.make_golden:
+        print("wrote {0:d} golden cases".format(make_golden()))
+
+    errors = check_encoders()
+    for e in errors:
+        print(e)
+    print("encoder check: {0}".format("FAILED" if errors else "ok"))
+
+    tRef, results = run_benchmarks(args.names or None, args.repeat)
+    if args.save_baseline:
+        # the baseline is the best of a few runs
+        for i in range(2):
+            tRef2, again = run_benchmarks(args.names or None, args.repeat)
+            for k, v in again.items():
+                results[k] = min(results[k], v)
+        save_baseline(results)
+    base = load_baseline().get(_baseline_key(), {})
+    for i in range(args.retries):
+        # re-time the apparent regressions, to ride out a busy machine
+        slow = [k for k, v in results.items() if k in base and v > base[k] * (1.0 + args.threshold)]
+        if not slow:
+            break
+        tRef2, again = run_benchmarks(slow, args.repeat)
+        for k, v in again.items():
+            results[k] = min(results[k], v)
+    slower = compare(tRef, results, args.threshold)
+    for name in slower:
+        print("slower than baseline: {0}".format(name))
+
+    sys.exit(1 if errors or slower else 0)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package board_registry
+# Persistent connections to several KC705 boards, and running the same
+# per-chip routine on all of them at once from one process.
+#
+
+from __future__ import print_function
+import socket
+import threading
+import time
+import traceback
+from command import *
+
+## One KC705 board: a persistent control connection plus the per-board
+# command state (register shadow).
+#
+class Board(object):
+
+    ## @param[in] name tag used for results and log messages.
+    # @param[in] info free-form per-board settings, e.g. chip location.
+    def __init__(self, name, host, port=1024, info=None, timeout=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.info = info if info is not None else {}
+        self.timeout = timeout
+        self.cmd = CmdBatch()
+        self.regShadow = ConfigRegShadow(self.cmd)
+        ## @var lock serializes use of the socket between threads
+        self.lock = threading.RLock()
+        self.s = None
+
+    def connect(self):
+        if self.s is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.settimeout(self.timeout)
+            # commands are small and mostly wait for a reply
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.connect((self.host, self.port))
+            self.s = s
+            self.regShadow.invalidate()
+        return self
+
+    def close(self):
+        if self.s is not None:
+            self.s.close()
+            self.s = None
+
+    def reconnect(self):
+        self.close()
+        return self.connect()
+
+    def __repr__(self):
+        return "Board({0}, {1}:{2})".format(self.name, self.host, self.port)
+
+## Outcome of running a routine on one board
+#
+class BoardResult(object):
+
+    def __init__(self, board, value=None, error=None, tb=None, elapsed=0.0):
+        self.board = board
+        self.value = value
+        self.error = error
+        self.traceback = tb
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "<{0}: ok in {1:.3f}s>".format(self.board.name, self.elapsed)
+        return "<{0}: {1!r} after {2:.3f}s>".format(self.board.name, self.error, self.elapsed)
+
+def _connect(board):
+    board.connect()
+
+## Registry of boards, run routines on all of them in parallel
+#
+class BoardRegistry(object):
+
+    def __init__(self):
+        self._boards = []
+
+    ## @param[in] ipport "ipaddr:port" string, as given on command lines.
+    def add(self, name, ipport, info=None, timeout=None):
+        ip, port = ipport.split(':')
+        board = Board(name, ip, int(port), info, timeout)
+        self._boards.append(board)
+        return board
+
+    def __iter__(self):
+        return iter(self._boards)
+
+    def __len__(self):
+        return len(self._boards)
+
+    def __getitem__(self, name):
+        for b in self._boards:
+            if b.name == name:
+                return b
+        raise KeyError(name)
+
+    ## Connect all boards.
+    # @return dict name -> BoardResult; boards that fail stay unconnected.
+    def connect_all(self):
+        return self.run(_connect)
+
+    def close_all(self):
+        for b in self._boards:
+            b.close()
+
+    ## Run routine(board, *args, **kwargs) on every board, each in its own
+    # thread.  An exception only fails the board it was raised on.
+    # @param[in] boards subset of boards to run on, all boards by default.
+    # @return dict name -> BoardResult
+    def run(self, routine, *args, **kwargs):
+        boards = kwargs.pop('boards', None)
+        if boards is None:
+            boards = self._boards
+        results = {}
+
+        def worker(board):
+            t0 = time.time()
+            try:
+                with board.lock:
+                    value = routine(board, *args, **kwargs)
+                results[board.name] = BoardResult(board, value, elapsed=time.time() - t0)
+            except Exception as e:
+                results[board.name] = BoardResult(board, error=e, tb=traceback.format_exc(),
+                                                  elapsed=time.time() - t0)
+
+        threads = [threading.Thread(target=worker, args=(b,), name=b.name) for b in boards]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    ## Boards whose result is ok, for chaining the next stage
+    @staticmethod
+    def succeeded(results):
+        return [r.board for r in results.values() if r.ok]
+
+    @staticmethod
+    def report(results):
+        for name in sorted(results):
+            r = results[name]
+            print(r)
+            if not r.ok:
+                print(r.traceback)
@@ -1,5 +1,9 @@
 from __future__ import print_function
 from ctypes import *
+import struct
+import threading
+import numpy as np
+import timing
 
 class Cmd(object):
     soname = "./build/command.so"
@@ -58,8 +62,335 @@ class Cmd(object):
         n = cfun(byref(c_void_p(buf)), c_char_p(file_name))
         return self.buf.raw[0:n]
 
+## @var Opcodes understood by CmdBatch.encode().  Each one selects a
+# command word layout of command.c
+OP_READ_STATUS    = 0
+OP_SEND_PULSE     = 1
+OP_WRITE_REGISTER = 2
+OP_READ_REGISTER  = 3
+OP_READ_DATAFIFO  = 4
+OP_MEM_COUNT      = 5
+OP_MEM_ADDR_LSB   = 6
+OP_MEM_ADDR_MSB   = 7
+OP_MEM_DATA_LSB   = 8
+OP_MEM_DATA_MSB   = 9
+OP_MEM_READ       = 10
+
+## Pure NumPy command generator, byte-for-byte identical to command.c.
+# Holds no buffer of its own, so one instance can be shared between
+# threads, and does not need the compiled command.so.
+#
+class CmdBatch(object):
+    ## @var _opBase upper 16 bits of the command word, indexed by opcode
+    _opBase     = np.array([0x8000, 0x000b, 0x0020, 0x8020, 0x0019, 0x0010,
+                            0x0011, 0x0012, 0x0013, 0x0014, 0x8014], dtype=np.uint32)
+    ## @var _opAddrMask whether the address is added to _opBase
+    _opAddrMask = np.array([0xffff, 0, 0xffff, 0xffff, 0, 0,
+                            0, 0, 0, 0, 0], dtype=np.uint32)
+    ## @var _opValMask whether the value goes into the lower 16 bits
+    _opValMask  = np.array([0, 0xffff, 0xffff, 0, 0xffff, 0xffff,
+                            0xffff, 0xffff, 0xffff, 0xffff, 0], dtype=np.uint32)
+    ## @var shortList commands up to this many are encoded in pure Python,
+    # below the cost of the NumPy calls
+    shortList = 32
+    _opTable = list(zip(_opBase.tolist(), _opAddrMask.tolist(), _opValMask.tolist()))
+
+    ## Encode arrays of (opcode, address, value) into command words.
+    # Scalars are broadcast against arrays.
+    # @return numpy uint32 array in host byte order
+    def encode_words(self, op, addr=0, val=0):
+        op   = np.asarray(op, dtype=np.intp)
+        addr = np.asarray(addr).astype(np.uint32)
+        val  = np.asarray(val).astype(np.uint32)
+        return ((self._opBase[op] + (addr & self._opAddrMask[op])) << 16) | (val & self._opValMask[op])
+
+    ## Encode arrays of (opcode, address, value) into one network-endian
+    # command string.
+    def encode(self, op, addr=0, val=0):
+        if np.ndim(op) == 0:
+            cmdstr = self._encode_short(int(op), addr, val)
+            if cmdstr is not None:
+                return cmdstr
+        return np.ravel(self.encode_words(op, addr, val)).astype('>u4').tobytes()
+
+    ## encode() of one opcode over scalars or lists of equal length up to
+    # shortList commands
+    # @return None if the arguments are not such
+    def _encode_short(self, op, addr, val):
+        if isinstance(addr, np.ndarray):
+            addr = addr.tolist()
+        if isinstance(val, np.ndarray):
+            val = val.tolist()
+        aList = isinstance(addr, (list, tuple))
+        vList = isinstance(val, (list, tuple))
+        n = len(addr) if aList else len(val) if vList else 1
+        if n > self.shortList or (aList and vList and len(val) != n):
+            return None
+        if not aList:
+            addr = (addr,) * n
+        if not vList:
+            val = (val,) * n
+        base, addrMask, valMask = self._opTable[op]
+        words = [(((base + (a & addrMask)) << 16) | (v & valMask)) & 0xffffffff
+                 for a, v in zip(addr, val)]
+        return struct.pack(">{0:d}I".format(n), *words)
+
+    ## Encode consecutive config_reg writes starting at register addr0
+    # @param[in] vals sequence of 16-bit values
+    def write_registers(self, addr0, vals):
+        n = len(vals)
+        addrs = list(range(addr0, addr0 + n)) if n <= self.shortList else addr0 + np.arange(n)
+        return self.encode(OP_WRITE_REGISTER, addrs, vals)
+
+    ## Encode reads of the given status registers, in order
+    def read_statuses(self, addrs):
+        return self.encode(OP_READ_STATUS, addrs)
+
+    def send_pulse(self, mask):
+        return self.encode(OP_SEND_PULSE, 0, mask)
+
+    def read_status(self, addr):
+        return self.encode(OP_READ_STATUS, addr)
+
+    def write_memory(self, addr, aval):
+        aval = np.asarray(aval).astype(np.uint32)
+        words = np.empty(2*len(aval)+2, dtype=np.uint32)
+        words[0] = 0x00110000 | (0xffff & addr)         # address LSB
+        words[1] = 0x00120000 | (0xffff & (addr >> 16)) # address MSB
+        words[2::2] = 0x00130000 | (0xffff & aval)      # data LSB
+        words[3::2] = 0x00140000 | (aval >> 16)         # data MSB
+        return words.astype('>u4').tobytes()
+
+    def read_memory(self, addr, val):
+        return self.encode([OP_MEM_ADDR_LSB, OP_MEM_ADDR_MSB, OP_MEM_COUNT, OP_MEM_READ],
+                           0, [addr & 0xffff, (addr >> 16) & 0xffff, val, 0])
+
+    def write_register(self, addr, val):
+        return self.encode(OP_WRITE_REGISTER, addr, val)
+
+    def read_register(self, addr):
+        return self.encode(OP_READ_REGISTER, addr)
+
+    def read_datafifo(self, val):
+        return self.encode(OP_READ_DATAFIFO, 0, val)
+
+    ## Same file format as cmd_write_memory_file(): one hex word per
+    # 11-character record
+    def write_memory_file(self, file_name):
+        with open(file_name, "rb") as fp:
+            data = fp.read()
+        aval = [int(data[i:i+11].split()[0], 16) for i in range(0, len(data) - 10, 11)]
+        return self.write_memory(0, aval)
+
+## Receive exactly nbytes from socket s.
+# @return bytearray of length nbytes
+def recv_all(s, nbytes):
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    got = 0
+    while got < nbytes:
+        n = s.recv_into(view[got:], nbytes - got)
+        if n == 0:
+            raise IOError("connection closed after %d of %d reply bytes" % (got, nbytes))
+        got += n
+    return buf
+
+## Queue of commands that are sent with a single sendall().
+# Every queued read knows how many reply words it produces, so that
+# commit() can receive the exact reply size and split it back into
+# per-read results in queue order.
+#
+class CmdTransaction(object):
+
+    def __init__(self, cmd=None):
+        if cmd is None:
+            cmd = CmdBatch()
+        self.cmd = cmd
+        self.clear()
+
+    def clear(self):
+        self._chunks = []
+        self._ops = []
+        self._addrs = []
+        self._vals = []
+        ## @var _reads (number of reply words, 16-bit?, single value?) per read
+        self._reads = []
+
+    def _queue(self, op, addr, val):
+        self._ops.append(op)
+        self._addrs.append(addr)
+        self._vals.append(val)
+
+    def _flush_ops(self):
+        if self._ops:
+            self._chunks.append(self.cmd.encode(self._ops, self._addrs, self._vals))
+            self._ops, self._addrs, self._vals = [], [], []
+
+    def _add_read(self, nwords, is16, single):
+        self._reads.append((nwords, is16, single))
+        return len(self._reads) - 1
+
+    ## Queue an already encoded command string that expects nreply
+    # 32-bit reply words (0 for pure writes such as DAC8568.write_spi()).
+    # @return index of the result in commit()'s list, or None
+    def append(self, cmdstr, nreply=0):
+        self._flush_ops()
+        self._chunks.append(cmdstr)
+        if nreply > 0:
+            return self._add_read(nreply, False, False)
+
+    def write_register(self, addr, val):
+        self._queue(OP_WRITE_REGISTER, addr, val)
+
+    def write_registers(self, addr0, vals):
+        for i, val in enumerate(vals):
+            self._queue(OP_WRITE_REGISTER, addr0 + i, val)
+
+    def send_pulse(self, mask):
+        self._queue(OP_SEND_PULSE, 0, mask)
+
+    ## @return index of the 16-bit status value in commit()'s list
+    def read_status(self, addr):
+        self._queue(OP_READ_STATUS, addr, 0)
+        return self._add_read(1, True, True)
+
+    ## @return index of the array of 16-bit status values in commit()'s list
+    def read_statuses(self, addrs):
+        addrs = list(addrs)
+        for addr in addrs:
+            self._queue(OP_READ_STATUS, addr, 0)
+        return self._add_read(len(addrs), True, False)
+
+    def read_register(self, addr):
+        self._queue(OP_READ_REGISTER, addr, 0)
+        return self._add_read(1, True, True)
+
+    ## @return index of the array of n 32-bit memory words in commit()'s list
+    def read_memory(self, addr, n):
+        self._flush_ops()
+        self._chunks.append(self.cmd.read_memory(addr, n))
+        return self._add_read(n, False, False)
+
+    ## @return index of the array of n+1 32-bit data fifo words in commit()'s list
+    def read_datafifo(self, n):
+        self._queue(OP_READ_DATAFIFO, 0, n)
+        return self._add_read(n + 1, False, False)
+
+    ## Total number of reply bytes the queued reads will produce
+    def reply_nbytes(self):
+        return 4 * sum(r[0] for r in self._reads)
+
+    ## Encoded command string of everything queued so far
+    def cmdstr(self):
+        self._flush_ops()
+        return b"".join(self._chunks)
+
+    ## Send everything with one sendall() and collect the replies.
+    # The queue is cleared afterwards so the object can be reused.
+    # @param[in] s Socket that is already open and connected to the FPGA board.
+    # @return list with one entry per queued read, in queue order: an int
+    #         for read_status()/read_register(), a numpy array otherwise.
+    def commit(self, s):
+        prof = timing.profiler
+        cmdstr = self.cmdstr()
+        timing.debug(2, timing.hexdump, cmdstr)
+        with prof.timed("send"):
+            s.sendall(cmdstr)
+        nbytes = self.reply_nbytes()
+        ret = []
+        if nbytes > 0:
+            with prof.timed("recv"):
+                buf = recv_all(s, nbytes)
+            timing.debug(3, timing.hexdump, buf)
+            with prof.timed("decode"):
+                ret = self.decode(buf)
+        self.clear()
+        return ret
+
+    ## Split reply_nbytes() bytes of replies into per-read results,
+    # in the same form as commit() returns them.
+    def decode(self, buf):
+        words = np.frombuffer(buf, dtype='>u4')
+        ret = []
+        i = 0
+        for nwords, is16, single in self._reads:
+            w = words[i:i+nwords]
+            i += nwords
+            if is16:
+                w = (w & 0xffff).astype(np.uint16)
+            ret.append(int(w[0]) if single else w)
+        return ret
+
+## Host-side shadow of the 32 16-bit config_reg words of
+# control_interface.  Records the last value written to each address
+# so that only words that changed are sent.  Words whose value on the
+# board is unknown (None) are always sent.
+#
+class ConfigRegShadow(object):
+    ## @var nReg number of config_reg words
+    nReg = 32
+
+    def __init__(self, cmd=None):
+        if cmd is None:
+            cmd = CmdBatch()
+        self.cmd = cmd
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    ## Forget the board state, e.g. after the board was reset or another
+    # program talked to it.  The next write of every word is sent.
+    def invalidate(self, addrs=None):
+        with self._lock:
+            if addrs is None:
+                self._vals = [None] * self.nReg
+            else:
+                for addr in addrs:
+                    self._vals[addr] = None
+
+    ## Record a write made outside of the shadow, e.g. by
+    # DAC8568.write_spi(), which leaves val in config_reg[addr]
+    def record(self, addr, val):
+        with self._lock:
+            self._vals[addr] = val & 0xffff
+
+    def value(self, addr):
+        return self._vals[addr]
+
+    ## Encode writes of consecutive words starting at addr0, skipping
+    # words the board already holds.  The shadow is updated assuming
+    # the returned string will be sent.
+    # @param[in] force send every word regardless of the shadow
+    # @return command string, empty when nothing changed
+    def write_registers(self, addr0, vals, force=False):
+        addrs = []
+        changed = []
+        with self._lock:
+            for i, val in enumerate(vals):
+                val &= 0xffff
+                if force or self._vals[addr0 + i] != val:
+                    self._vals[addr0 + i] = val
+                    addrs.append(addr0 + i)
+                    changed.append(val)
+        if not addrs:
+            return b""
+        return self.cmd.encode(OP_WRITE_REGISTER, addrs, changed)
+
+    def write_register(self, addr, val, force=False):
+        return self.write_registers(addr, [val], force)
+
+    ## Read all config_reg words back from the board into the shadow
+    # @param[in] s Socket that is already open and connected to the FPGA board.
+    def resync(self, s):
+        trans = CmdTransaction(self.cmd)
+        idx = [trans.read_register(addr) for addr in range(self.nReg)]
+        ret = trans.commit(s)
+        with self._lock:
+            self._vals = [ret[i] for i in idx]
+
 if __name__ == "__main__":
     cmd = Cmd()
     ret = cmd.write_register(1, 0x5a5a)
     print([hex(ord(s)) for s in ret])
+    cmdBatch = CmdBatch()
+    print(ret == cmdBatch.write_register(1, 0x5a5a))
 
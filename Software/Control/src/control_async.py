@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## @package control_async
+# asyncio client for the control_interface TCP port.
+#
+# All requests go through a single writer queue.  Replies come back in
+# the order the requests were sent, so a reader task hands each reply
+# to the request at the head of the pending list.  Instrument I/O
+# (SMU, DMM, ADC) can run in the same event loop through
+# run_blocking(), overlapping with board I/O.
+#
+# Requires Python 3.7 or later.
+#
+
+import asyncio
+import functools
+import argparse
+import numpy as np
+from command import *
+
+## One request on the writer queue
+#
+class _Request(object):
+    __slots__ = ('cmdstr', 'nbytes', 'decode', 'future')
+
+    def __init__(self, cmdstr, nbytes, decode, future):
+        self.cmdstr = cmdstr
+        self.nbytes = nbytes
+        self.decode = decode
+        self.future = future
+
+## asyncio control_interface client
+#
+class AsyncControlClient(object):
+
+    ## @param[in] timeout default per-request timeout in seconds.
+    def __init__(self, host="192.168.2.3", port=1024, timeout=2.0, cmd=None):
+        if cmd is None:
+            cmd = CmdBatch()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.cmd = cmd
+        self._reader = None
+        self._writer = None
+        self._queue = None
+        self._pending = None
+        self._tasks = []
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._queue = asyncio.Queue()
+        self._pending = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._write_loop()),
+                       asyncio.ensure_future(self._read_loop())]
+        return self
+
+    async def close(self):
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending(ConnectionError("client closed"))
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _fail_pending(self, exc):
+        for q in (self._queue, self._pending):
+            while q is not None and not q.empty():
+                req = q.get_nowait()
+                if not req.future.done():
+                    req.future.set_exception(exc)
+
+    async def _write_loop(self):
+        while True:
+            req = await self._queue.get()
+            if req.future.cancelled():
+                continue
+            if req.nbytes > 0:
+                # registered before sending, the reply may arrive at once
+                self._pending.put_nowait(req)
+            self._writer.write(req.cmdstr)
+            await self._writer.drain()
+            if req.nbytes == 0 and not req.future.done():
+                req.future.set_result(None)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                req = await self._pending.get()
+                buf = await self._reader.readexactly(req.nbytes)
+                # a request that timed out still consumes its reply,
+                # which keeps the reply stream in step
+                if not req.future.done():
+                    req.future.set_result(req.decode(buf))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self._fail_pending(ConnectionError("connection lost: %s" % e))
+
+    ## Queue a command string and wait for its reply.
+    # @param[in] nbytes number of reply bytes.
+    # @param[in] decode function turning the reply bytes into the result.
+    async def request(self, cmdstr, nbytes=0, decode=None, timeout=None):
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Request(cmdstr, nbytes, decode, fut))
+        return await asyncio.wait_for(fut, self.timeout if timeout is None else timeout)
+
+    async def write_register(self, addr, val, timeout=None):
+        return await self.request(self.cmd.write_register(addr, val), timeout=timeout)
+
+    async def write_registers(self, addr0, vals, timeout=None):
+        return await self.request(self.cmd.write_registers(addr0, vals), timeout=timeout)
+
+    async def pulse(self, mask, timeout=None):
+        return await self.request(self.cmd.send_pulse(mask), timeout=timeout)
+
+    ## @return 16-bit status value
+    async def read_status(self, addr, timeout=None):
+        return await self.request(self.cmd.read_status(addr), 4,
+                                  lambda buf: int(np.frombuffer(buf, '>u4')[0] & 0xffff), timeout)
+
+    ## @return numpy array of 16-bit status values, in the order of addrs
+    async def read_statuses(self, addrs, timeout=None):
+        addrs = list(addrs)
+        return await self.request(self.cmd.read_statuses(addrs), 4 * len(addrs),
+                                  lambda buf: (np.frombuffer(buf, '>u4') & 0xffff).astype(np.uint16),
+                                  timeout)
+
+    ## @return numpy array of n 32-bit memory words
+    async def read_memory(self, addr, n, timeout=None):
+        return await self.request(self.cmd.read_memory(addr, n), 4 * n,
+                                  lambda buf: np.frombuffer(buf, '>u4'), timeout)
+
+    ## @return numpy array of n+1 32-bit data fifo words
+    async def read_datafifo(self, n, timeout=None):
+        return await self.request(self.cmd.read_datafifo(n), 4 * (n + 1),
+                                  lambda buf: np.frombuffer(buf, '>u4'), timeout)
+
+    ## Send a CmdTransaction as one request.
+    # @return list of results, as CmdTransaction.commit() returns them.
+    # trans is cleared once the reply is in and must not be changed before.
+    async def transaction(self, trans, timeout=None):
+        nbytes = trans.reply_nbytes()
+        try:
+            ret = await self.request(trans.cmdstr(), nbytes, trans.decode, timeout)
+        finally:
+            trans.clear()
+        return ret if nbytes > 0 else []
+
+## Run a blocking call (e.g. instrument I/O) in the default executor so
+# that it overlaps with board I/O in the event loop.
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--control-ip-port", type=str, default="192.168.2.3:1024", help="main control system ipaddr and port")
+    args = parser.parse_args()
+    ctrlipport = args.control_ip_port.split(':')
+
+    async def main():
+        async with AsyncControlClient(ctrlipport[0], int(ctrlipport[1])) as client:
+            statuses = await asyncio.gather(*[client.read_status(i) for i in range(11)])
+            print(["0x{0:04x}".format(v) for v in statuses])
+
+    asyncio.run(main())
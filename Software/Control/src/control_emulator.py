@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package control_emulator
+# Local TCP emulator of the control_interface firmware, for measuring
+# and regressing software throughput without a KC705 on the bench.
+#
+# Speaks the command.c word protocol and emulates:
+#   - 32 config_reg, 16 pulse_reg bits and 11 status_reg words,
+#   - the external shift register (pulse_reg(0)), read back through
+#     status_reg with the valid bit set 2**clk_div-scaled time later;
+#     a register wider than 144 bits shares status_reg(9..10) with the
+#     SPI din, which read whichever was captured last,
+#   - DAC8568 (pulse_reg(1)) and ADS124S0X (pulse_reg(2)) SPI words
+#     taken from config_reg(0), with synthetic ADC conversions,
+#   - the 32-bit memory interface (addresses 16-20),
+#   - the data fifo (address 25), filled with a pattern at a given rate.
+# Per-command latency and reply bandwidth can be injected.
+#
+# HP34401AEmulator stands in for the multimeter of dac_scan.py, as an
+# scpi transport.
+#
+
+from __future__ import print_function
+import threading
+import socket
+import struct
+import time
+import argparse
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+import numpy as np
+
+## State of one emulated board, shared by all connections to it
+#
+class BoardEmulator(object):
+    nConfig = 32
+    nStatus = 11
+    ## @var dinStatus first of the two status_reg words holding the SPI din
+    dinStatus = 9
+    ## @var clkFreq frequency the shift register clock is divided from
+    clkFreq = 100e6
+    ## @var dac_fit_a, dac_fit_b linear model of the chip's DAC code to volt
+    dac_fit_a = 4.35861E-5
+    dac_fit_b = 0.0349427
+
+    ## @param[in] srBits width of the external shift register (130 or 170).
+    # @param[in] fifoPattern 'counter', 'random' or a function(start, n)
+    #            returning n 32-bit words.
+    # @param[in] fifoRate data fifo fill rate in words per second, None for unlimited.
+    # @param[in] adcNoise rms noise in volts added to the synthetic ADC data.
+    # @param[in] memWords size of the emulated memory in 32-bit words.
+    def __init__(self, srBits=130, fifoPattern='counter', fifoRate=None, adcNoise=10e-6,
+                 memWords=1<<20, seed=0):
+        self.srBits = srBits
+        self.fifoPattern = fifoPattern
+        self.fifoRate = fifoRate
+        self.adcNoise = adcNoise
+        self.lock = threading.RLock()
+        self._rng = np.random.RandomState(seed)
+        self.memory = np.zeros(memWords, dtype=np.uint32)
+        self.reset()
+
+    ## Power-on state, as in the INIT state of control_interface
+    def reset(self):
+        with self.lock:
+            self.config = [0] * self.nConfig
+            self.status = [0] * self.nStatus
+            self.memAddr = 0
+            self.memCount = 1
+            self.memDinLsb = 0
+            self.nPulses = [0] * 16
+            # external shift register
+            self.srContent = 0
+            self.srDout = 0
+            self.srDoneTime = 0.0
+            ## @var srStatus read-back and valid bit as status_reg words
+            self.srStatus = []
+            # DAC8568
+            self.dacSpi = []
+            self.dacInput = [0] * 8
+            self.dacOutput = [0] * 8
+            self.dacRefOn = False
+            # ADS124S0X
+            self.adcSpi = []
+            self.adcRegs = [0] * 18
+            self.adcDin = 0
+            ## @var dinFromSr whether status_reg(9..10) last captured the SR
+            self.dinFromSr = False
+            self.adcRunning = False
+            # data fifo
+            self.fifoCount = 0
+            self.fifoT0 = time.time()
+
+    ## Chip DAC i voltage from the last shifted-in configuration
+    def chip_dac_volt(self, i):
+        code = (self.srContent >> (5 - i) * 16) & 0xffff
+        return code * self.dac_fit_a + self.dac_fit_b
+
+    ## Voltage seen by the ADC for the current mux / SYS_MON settings
+    def adc_input_volt(self):
+        sysmon = self.adcRegs[0x09]
+        if sysmon == 0x50:          # temperature sensor, 129mV @25C
+            v = 0.129
+        elif sysmon == 0x90:        # DVDD/4
+            v = 3.3 / 4.0
+        elif sysmon == 0x70:        # (AVDD-AVSS)/4
+            v = 3.3 / 4.0
+        else:
+            ch = (self.adcRegs[0x02] >> 4) & 0xf
+            if ch < 6:
+                v = self.chip_dac_volt(ch)
+            elif ch == 6:
+                v = 2.5
+            else:
+                v = 0.0
+        return v + self._rng.normal(0.0, self.adcNoise) if self.adcNoise > 0 else v
+
+    ## 24-bit ADC code in single-ended mode, vref 2.5V, gain 1
+    def adc_code(self):
+        adcint = int(round(self.adc_input_volt() * (1<<24) * 0.5 / 2.5))
+        adcint = max(-(1<<23), min((1<<23) - 1, adcint))
+        return adcint & 0xffffff
+
+    def _sr_status_update(self):
+        valid = 1 if time.time() >= self.srDoneTime else 0
+        val = (valid << self.srBits) | (self.srDout if valid else 0)
+        self.srStatus = [(val >> i*16) & 0xffff for i in range((self.srBits + 16) // 16)]
+        # the din words are left to _status_word()
+        for i in range(min(len(self.srStatus), self.dinStatus)):
+            self.status[i] = self.srStatus[i]
+
+    ## status_reg word at addr, from the SR read-back or the SPI din
+    def _status_word(self, addr):
+        self._sr_status_update()
+        if addr >= self.dinStatus and addr < len(self.srStatus) and self.dinFromSr:
+            return self.srStatus[addr]
+        return self.status[addr]
+
+    def _sr_start(self):
+        val = 0
+        for i in range((self.srBits + 6 + 15) // 16):
+            val |= self.config[i] << i*16
+        div = (val >> self.srBits) & 0x3f
+        data = val & ((1 << self.srBits) - 1)
+        # shifting the new value in shifts the old one out
+        self.srDout = self.srContent
+        self.srContent = data
+        self.dinFromSr = True
+        self.srDoneTime = time.time() + (self.srBits + 2) * (1 << div) / self.clkFreq
+
+    def _dac_word(self, word):
+        cmd = (word >> 24) & 0xf
+        ch = (word >> 20) & 0xf
+        code = (word >> 4) & 0xffff
+        if cmd == 0x8:
+            self.dacRefOn = bool(word & 0x1)
+            return
+        chs = range(8) if ch == 0xf else [ch & 0x7]
+        for c in chs:
+            if cmd in (0x0, 0x2, 0x3):
+                self.dacInput[c] = code
+            if cmd in (0x1, 0x3):
+                self.dacOutput[c] = self.dacInput[c]
+        if cmd == 0x2:
+            self.dacOutput = list(self.dacInput)
+
+    def _adc_word(self, word):
+        op = (word >> 24) & 0xff
+        din = 0
+        if op == 0x06:              # RESET
+            self.adcRegs = [0] * 18
+            self.adcRunning = False
+        elif op == 0x08:            # START
+            self.adcRunning = True
+        elif op == 0x0a:            # STOP
+            self.adcRunning = False
+        elif op == 0x12:            # RDATA
+            din = self.adc_code()
+        elif op & 0xe0 == 0x20:     # RREG
+            addr = op & 0x1f
+            n = ((word >> 16) & 0x1f) + 1
+            for i in range(min(n, 2)):
+                if addr + i < len(self.adcRegs):
+                    din |= self.adcRegs[addr + i] << (8 * (1 - i))
+        elif op & 0xe0 == 0x40:     # WREG
+            addr = op & 0x1f
+            n = ((word >> 16) & 0x1f) + 1
+            data = [(word >> 8) & 0xff, word & 0xff]
+            for i in range(min(n, 2)):
+                if addr + i < len(self.adcRegs):
+                    self.adcRegs[addr + i] = data[i]
+        self.adcDin = din
+        self.dinFromSr = False
+        self.status[self.dinStatus] = din & 0xffff
+        self.status[self.dinStatus + 1] = (din >> 16) & 0xffff
+
+    def _pulse(self, mask):
+        for i in range(16):
+            if mask & (1 << i):
+                self.nPulses[i] += 1
+        if mask & 0x1:
+            self._sr_start()
+        if mask & 0x2:
+            self.dacSpi.append(self.config[0])
+            if len(self.dacSpi) == 2:
+                self._dac_word(self.dacSpi[0] << 16 | self.dacSpi[1])
+                self.dacSpi = []
+        if mask & 0x4:
+            self.adcSpi.append(self.config[0])
+            if len(self.adcSpi) == 2:
+                self._adc_word(self.adcSpi[0] << 16 | self.adcSpi[1])
+                self.adcSpi = []
+
+    def _fifo_words(self, n):
+        if self.fifoRate is not None:
+            # wait until the fifo has been filled with enough words
+            tReady = self.fifoT0 + (self.fifoCount + n) / float(self.fifoRate)
+            dt = tReady - time.time()
+            if dt > 0:
+                time.sleep(dt)
+        start = self.fifoCount
+        self.fifoCount += n
+        if self.fifoPattern == 'counter':
+            return (np.arange(start, start + n) & 0xffffffff).astype('>u4')
+        if self.fifoPattern == 'random':
+            return self._rng.randint(0, 1<<32, size=n, dtype=np.uint64).astype('>u4')
+        return np.asarray(self.fifoPattern(start, n)).astype('>u4')
+
+    ## Execute one 32-bit command word
+    # @return reply bytes
+    def execute(self, word):
+        addr = (word >> 16) & 0xfff
+        data = word & 0xffff
+        if word & 0x80000000:
+            if 32 <= addr <= 63:
+                val = self.config[addr - 32]
+            elif 0 <= addr <= 10:
+                val = self._status_word(addr)
+            elif addr == 16:
+                val = self.memCount
+            elif addr == 17:
+                val = self.memAddr & 0xffff
+            elif addr == 18:
+                val = (self.memAddr >> 16) & 0xffff
+            elif addr == 20:
+                n = max(self.memCount, 1)
+                idx = (self.memAddr + np.arange(n)) % len(self.memory)
+                self.memAddr = (self.memAddr + n) & 0xffffffff
+                return self.memory[idx].astype('>u4').tobytes()
+            else:
+                val = 0xffff
+            return struct.pack('>I', val)
+        if 32 <= addr <= 63:
+            self.config[addr - 32] = data
+        elif addr == 11:
+            self._pulse(data)
+        elif addr == 16:
+            self.memCount = data
+        elif addr == 17:
+            self.memAddr = (self.memAddr & 0xffff0000) | data
+        elif addr == 18:
+            self.memAddr = (self.memAddr & 0xffff) | (data << 16)
+        elif addr == 19:
+            self.memDinLsb = data
+        elif addr == 20:
+            self.memory[self.memAddr % len(self.memory)] = (data << 16) | self.memDinLsb
+            self.memAddr = (self.memAddr + 1) & 0xffffffff
+        elif addr == 25:
+            return self._fifo_words(data + 1).tobytes()
+        return b""
+
+## One client connection
+#
+class _Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        # replies are small, do not let Nagle hold them back
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        srv = self.server
+        board = srv.board
+        pending = b""
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            if srv.latency > 0:
+                time.sleep(srv.latency)
+            pending += data
+            nw = len(pending) // 4
+            words = struct.unpack('>%dI' % nw, pending[:4*nw])
+            pending = pending[4*nw:]
+            replies = []
+            with board.lock:
+                for w in words:
+                    r = board.execute(w)
+                    if r:
+                        replies.append(r)
+            if replies:
+                reply = b"".join(replies)
+                if srv.bandwidth:
+                    time.sleep(len(reply) / float(srv.bandwidth))
+                self.request.sendall(reply)
+
+## Threaded TCP server around a BoardEmulator
+#
+class ControlEmulatorServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    ## @param[in] latency seconds added before each received batch of commands is executed.
+    # @param[in] bandwidth reply bandwidth limit in bytes per second, None for unlimited.
+    def __init__(self, addr=("127.0.0.1", 11024), board=None, latency=0.0, bandwidth=None):
+        socketserver.TCPServer.__init__(self, addr, _Handler)
+        self.board = board if board is not None else BoardEmulator()
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    ## Serve from a background thread
+    # @return (host, port) actually bound
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+## HP34401A multimeter answering the SCPI subset of dac_scan.HP34401A,
+# used as its transport.  A bus trigger starts a reading, which returns
+# what volt() gives at the end of the integration, nplc power line
+# cycles, twice that with auto zero on.  Triggers while a reading is
+# under way, or beyond TRIG:COUN, are ignored as by the instrument and
+# counted in nIgnored.
+#
+class HP34401AEmulator(object):
+
+    ## @param[in] volt function returning the input voltage.
+    # @param[in] timeScale factor on the reading times, to run faster than the instrument.
+    def __init__(self, volt, lineFreq=60.0, timeScale=1.0):
+        self.volt = volt
+        self.lineFreq = lineFreq
+        self.timeScale = timeScale
+        self.lock = threading.Lock()
+        self.nIgnored = 0
+        self._replies = []
+        self.reset()
+
+    def __repr__(self):
+        return "HP34401AEmulator()"
+
+    ## State after *RST
+    def reset(self):
+        with self.lock:
+            self.settings = {"VOLT:DC:NPLC" : "10", "SENS:ZERO:AUTO" : "ON", "TRIG:COUN" : "1"}
+            self.readings = []
+            self.nArmed = 0
+            self.busyUntil = 0.0
+
+    ## Seconds one reading takes
+    def reading_time(self):
+        t = float(self.settings["VOLT:DC:NPLC"]) / self.lineFreq
+        if self.settings["SENS:ZERO:AUTO"] == "ON":
+            t *= 2
+        return t * self.timeScale
+
+    def _trigger(self):
+        now = time.time()
+        if self.nArmed <= 0 or now < self.busyUntil:
+            self.nIgnored += 1
+            return
+        self.nArmed -= 1
+        self.busyUntil = now + self.reading_time()
+        timer = threading.Timer(self.reading_time(), self._take)
+        timer.daemon = True
+        timer.start()
+
+    def _take(self):
+        v = self.volt()
+        with self.lock:
+            self.readings.append(v)
+
+    def write(self, msg):
+        if isinstance(msg, bytes):
+            msg = msg.decode("ascii")
+        for c in msg.split(";"):
+            c = c.strip().lstrip(":")
+            header, _, value = c.partition(" ")
+            header = header.upper()
+            if header == "*RST":
+                self.reset()
+            elif header == "*OPC?":
+                self._replies.append("1")
+            elif header == "*IDN?":
+                self._replies.append("HEWLETT-PACKARD,34401A,0,emulated")
+            elif header == "INIT":
+                with self.lock:
+                    self.readings = []
+                    self.nArmed = int(self.settings["TRIG:COUN"])
+            elif header == "*TRG":
+                self._trigger()
+            elif header == "DATA:POIN?":
+                with self.lock:
+                    self._replies.append("{0:d}".format(len(self.readings)))
+            elif header == "FETC?":
+                # returns once the reading under way is taken
+                time.sleep(max(0.0, self.busyUntil - time.time()) + 0.01)
+                with self.lock:
+                    self._replies.append(",".join("{0:+.8E}".format(v) for v in self.readings))
+            elif value:
+                self.settings[header] = value.strip()
+
+    write_raw = write
+
+    def readline(self, timeout=None):
+        if not self._replies:
+            raise IOError("{0}: read timed out".format(self))
+        return self._replies.pop(0)
+
+    def close(self):
+        pass
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--address", type=str, default="127.0.0.1:11024", help="ipaddr and port to listen on")
+    parser.add_argument("-b", "--sr-bits", type=int, default=130, help="external shift register width")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="latency [s] added per received command batch")
+    parser.add_argument("-w", "--bandwidth", type=float, default=None, help="reply bandwidth limit [bytes/s]")
+    parser.add_argument("-f", "--fifo-pattern", type=str, default="counter", help="data fifo pattern: counter|random")
+    parser.add_argument("-r", "--fifo-rate", type=float, default=None, help="data fifo fill rate [words/s]")
+    args = parser.parse_args()
+
+    ipport = args.address.split(':')
+    board = BoardEmulator(args.sr_bits, args.fifo_pattern, args.fifo_rate)
+    server = ControlEmulatorServer((ipport[0], int(ipport[1])), board, args.latency, args.bandwidth)
+    print("Emulating control_interface on {0}:{1}".format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package dac_calib
+# Per-chip calibration of the on-chip DACs, built from measured DAC
+# transfer curves.
+#
+# Each DAC gets a lookup table of (code, volt) points taken from a scan
+# file: dacscan.dat of dac_scan.py, or a TMS1mmProbeCard data file, as
+# text or in the binary .scan format.
+# Conversions in both directions interpolate the table and take whole
+# NumPy arrays; DACs without a table fall back to the linear fit in
+# TMS1mmReg.
+#
+# DACCalibrationStore keeps the tables of many chips, keyed by chip
+# location, as small binary .npz files next to each other, so a table
+# is built from its scan file once and afterwards only loaded.
+#
+
+from __future__ import print_function
+import os
+import errno
+import threading
+import numpy as np
+from TMS1mmReg import TMS1mmReg
+from scan_file import read_scan
+
+## @var dacscanColumns DAC index -> column of dacscan.dat (dac_scan.py scans DAC2)
+dacscanColumns = {2 : 1}
+## @var dacscanMeasured column of the measured flag in an adaptive dacscan.dat
+dacscanMeasured = 2
+## @var probeColumns DAC index -> column of a TMS1mmProbeCard data file:
+# code, temperature, ADC channels 0..5 measuring DAC 0..5, channel 6
+probeColumns = dict((i, 2 + i) for i in range(TMS1mmReg.nDAC))
+
+## Rows of a scan file.  A TMS1mmProbeCard file may hold several
+# '# Chip x y' blocks; with chip=(x, y) only the last block of that chip
+# is read.
+# @return float array (n, ncol)
+def read_scan_file(fname, chip=None):
+    if fname.endswith(".scan"):
+        return _read_binary_scan(fname, chip)
+    rows = []
+    inChip = chip is None
+    with open(fname) as fp:
+        for line in fp:
+            f = line.split()
+            if not f:
+                continue
+            if f[0].startswith("#"):
+                if chip is not None and f[0] == "#" and len(f) == 4 and f[1] == "Chip":
+                    inChip = (int(f[2]), int(f[3])) == tuple(chip)
+                    if inChip:
+                        rows = []
+                continue
+            if inChip:
+                rows.append([float(x) for x in f])
+    return np.array(rows, dtype=float)
+
+## Rows of a binary scan file (see scan_file) in the text column layout.
+# A probe file holds one chip; with chip=(x, y) only its last run is read.
+def _read_binary_scan(fname, chip=None):
+    meta, rec = read_scan(fname)
+    if 'run' not in rec.dtype.names:
+        return np.column_stack([rec['code'], rec['volt'], rec['measured'], rec['nplc']]).astype(float)
+    if chip is not None and len(rec) > 0:
+        if meta.get('chip') is not None and tuple(meta['chip']) != tuple(chip):
+            rec = rec[:0]
+        else:
+            rec = rec[rec['run'] == rec['run'][-1]]
+    return np.column_stack([rec['code'], rec['volt']]).astype(float)
+
+## Calibration of the DACs of one chip
+#
+class DACCalibration(object):
+    nDAC = TMS1mmReg.nDAC
+    codeMax = 0xffff
+
+    ## @param[in] tables list of nDAC (codes, volts) pairs or None.
+    def __init__(self, tables=None):
+        self.fit_a = TMS1mmReg.dac_fit_a
+        self.fit_b = TMS1mmReg.dac_fit_b
+        self.tables = [None] * self.nDAC
+        for i, t in enumerate(tables or []):
+            if t is not None:
+                self.set_table(i, *t)
+
+    ## Set the table of DAC i from measured points.  Repeated codes are
+    # averaged; the volts are made non-decreasing so that the inverse
+    # is single valued.
+    def set_table(self, i, codes, volts):
+        codes = np.asarray(codes, dtype=float).ravel()
+        volts = np.asarray(volts, dtype=float).ravel()
+        ok = np.isfinite(codes) & np.isfinite(volts)
+        if not ok.any():
+            self.tables[i] = None
+            return
+        u, inv = np.unique(codes[ok], return_inverse=True)
+        v = np.bincount(inv, weights=volts[ok]) / np.bincount(inv)
+        self.tables[i] = (u.astype(np.uint16), np.maximum.accumulate(v).astype(np.float32))
+
+    def has_table(self, i):
+        return i < self.nDAC and self.tables[i] is not None
+
+    ## Volts of DAC i at the given codes, scalar or array
+    def code2volt(self, i, codes):
+        c = np.asarray(codes, dtype=float)
+        if self.has_table(i):
+            tc, tv = self.tables[i]
+            v = np.interp(c, tc, tv)
+        else:
+            v = c * self.fit_a + self.fit_b
+        return float(v) if v.ndim == 0 else v
+
+    ## Codes of DAC i giving the target volts, scalar or array.  Targets
+    # outside the table are clamped to its end points.
+    def volt2code(self, i, volts):
+        v = np.asarray(volts, dtype=float)
+        if self.has_table(i):
+            tc, tv = self.tables[i]
+            c = np.rint(np.interp(v, tv, tc))
+        else:
+            c = np.trunc((v - self.fit_b) / self.fit_a)
+        c = np.clip(c, 0, self.codeMax).astype(int)
+        return int(c) if c.ndim == 0 else c
+
+    ## Build from a scan file.
+    # @param[in] columns DAC index -> column of the file; by default
+    #            dacscanColumns for dacscan.dat files (up to 4 columns),
+    #            probeColumns otherwise.
+    # @param[in] chip (x, y) to pick from a multi-chip probe file.
+    @classmethod
+    def from_scan_file(cls, fname, columns=None, chip=None):
+        data = read_scan_file(fname, chip)
+        if data.size == 0:
+            return cls()
+        return cls.from_rows(data, columns)
+
+    ## Build from scan rows [code, volt columns...], e.g. those returned
+    # by TMS1mmProbeCard.dac_code_scan().  Of an adaptive dacscan.dat
+    # only the measured codes are used.
+    @classmethod
+    def from_rows(cls, rows, columns=None):
+        data = np.atleast_2d(np.asarray(rows, dtype=float))
+        if columns is None:
+            columns = dacscanColumns if data.shape[1] <= 4 else probeColumns
+        if columns is dacscanColumns and data.shape[1] > dacscanMeasured:
+            data = data[data[:, dacscanMeasured] != 0]
+        calib = cls()
+        for i, col in columns.items():
+            if col < data.shape[1]:
+                calib.set_table(i, data[:, 0], data[:, col])
+        return calib
+
+    def save(self, fname):
+        arrays = {}
+        for i, t in enumerate(self.tables):
+            if t is not None:
+                arrays["code{0:d}".format(i)], arrays["volt{0:d}".format(i)] = t
+        with open(fname, "wb") as fp:
+            np.savez(fp, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        calib = cls()
+        with np.load(fname) as f:
+            for i in range(cls.nDAC):
+                key = "code{0:d}".format(i)
+                if key in f.files:
+                    calib.tables[i] = (f[key], f["volt{0:d}".format(i)])
+        return calib
+
+## Calibrations of many chips, cached in memory and on disk
+#
+class DACCalibrationStore(object):
+
+    ## @param[in] directory where the binary tables are kept.
+    def __init__(self, directory="calib"):
+        self.directory = directory
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def path(self, x, y):
+        return os.path.join(self.directory, "dac_x{0:04d}y{1:04d}.npz".format(x, y))
+
+    ## Calibration of the chip at (x, y): from memory, then from disk,
+    # else the linear fit only.
+    def get(self, x, y):
+        with self._lock:
+            calib = self._cache.get((x, y))
+            if calib is None:
+                p = self.path(x, y)
+                calib = DACCalibration.load(p) if os.path.exists(p) else DACCalibration()
+                self._cache[(x, y)] = calib
+            return calib
+
+    def put(self, x, y, calib):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            # made meanwhile by another board's thread, or another process
+            if e.errno != errno.EEXIST or not os.path.isdir(self.directory):
+                raise
+        calib.save(self.path(x, y))
+        with self._lock:
+            self._cache[(x, y)] = calib
+
+    ## Calibration of the chip at (x, y) from a scan file, rebuilt only
+    # when the file is newer than the stored table.
+    def build(self, x, y, fname, columns=None, chip=None):
+        p = self.path(x, y)
+        if os.path.exists(p) and os.path.getmtime(p) >= os.path.getmtime(fname):
+            return self.get(x, y)
+        calib = DACCalibration.from_scan_file(fname, columns, chip)
+        self.put(x, y, calib)
+        return calib
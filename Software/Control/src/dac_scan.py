@@ -10,134 +10,358 @@ import socket
 import time
 import sys
 import serial
+import numpy as np
 from command import *
 from TMS1mmSingle import *
+from scan_file import ScanWriter, dacscan_dtype
+from scpi import SCPIInstrument, SerialTransport
+import timing
+from timing import profiler
 
 ## HP34401A multimeter control
-class HP34401A(object):
+class HP34401A(SCPIInstrument):
+
+    ## @var measurementSetup settings of setup_measurement(), after *RST
+    measurementSetup = [
+        ("SYST:BEEP:STAT", "OFF"),  # turn off beeper
+        ("CONF:VOLT:DC", "10, 1E-5"), # range, resolution
+        ("VOLT:DC:NPLC", 10),       # Integration time in # of power line cycles
+        ("INP:IMP:AUTO", "ON"),     # input impedance.  ON: >10G for 0.1,1,10V range, OFF: 10M
+        ("SENS:ZERO:AUTO", "ON"),   # auto zero. options are ON|OFF|ONCE
+    ]
 
     ## Initialization
-    # @param s An already open serial object to talk to the device.
+    # @param s An already open serial object to talk to the device, or
+    #          an scpi transport.
     def __init__(self, s):
-        self._s = s
+        if not hasattr(s, "write_raw"):
+            # a bare serial port
+            s = SerialTransport(s)
+        SCPIInstrument.__init__(self, s)
         # Enter remote mode.  RS-232 requires it.
-        self._s.write("SYSTem:REMote\n")
-        time.sleep(1)
+        self.write("SYSTem:REMote")
+        self.sync()
 
     ## @var numTaken number of data points taken
     _numTaken = 0
 
     ## @var numMax maximum number of data points allowed by the instrument
     _numMax = 512
+
+    ## @var numArmed number of triggers of the current measurement
+    _numArmed = _numMax
+
+    ## @var nplc integration time set by setup_measurement() or set_nplc()
+    nplc = 10
+
+    ## @var lineFreq [Hz] power line frequency the NPLC are counted in
+    lineFreq = 60.0
+
+    ## @var timeMargin [s] allowed beyond the expected reading times
+    timeMargin = 2.0
     
     def identify(self):
-        self._s.write("*IDN?\n")
-        ret = self._s.readline()
-        return ret[:-1]
+        return self.query("*IDN?")
 
+    ## Reset and configure for DC volts, skipped when the instrument is
+    # configured so already
     def setup_measurement(self):
-        self._s.write("*RST\n") # reset
-        time.sleep(1)
-        self._s.write("SYST:BEEP:STAT OFF\n") # turn off beeper
-        self._s.write("CONF:VOLT:DC 10, 1E-5\n") # range, resolution
-        self._s.write("VOLT:DC:NPLC 10\n") # Integration time in # of power line cycles
-        self._s.write("INP:IMP:AUTO ON\n") # input impedance.  ON: >10G for 0.1,1,10V range, OFF: 10M
-        self._s.write("SENS:ZERO:AUTO ON\n") # auto zero. options are ON|OFF|ONCE
-        # self._s.write("VOLT:DC:RANG?; :VOLT:DC:RES?; :VOLT:DC:NPLC?\n")
-        # ret = self._s.readline()[:-1]
-        # return "Range;Resolution;NPLC: " + ret
-
-    def set_trigger_then_arm(self):
-        self._s.write("*CLS\n") # clear status
-        self._s.write("TRIG:SOUR BUS\n") # options are BUS|IMM|EXT
-        self._s.write("TRIG:DEL:AUTO ON\n") # automatic trigger delay
-        self._s.write("TRIG:COUN %d\n" % self._numMax) # number of triggers the instrument will accept before returning to idle
-        self._s.write("SAMP:COUN 1\n") # 1 sample per trigger (up to 50000 allowed, but memory can only store 512)
-        # self._s.write("READ?\n") # enter wait-for-trigger state
-        self._s.write("INIT\n") # enter wait-for-trigger state
+        self.configure(self.measurementSetup, reset=True)
+        self.nplc = self._state["VOLT:DC:NPLC"]
+
+    ## Integration time in number of power line cycles: 0.02, 0.2, 1, 10 or 100
+    def set_nplc(self, nplc):
+        self.set("VOLT:DC:NPLC", nplc)
+        self.nplc = nplc
+
+    ## Arm for n bus triggers, the whole memory by default.  FETC? returns
+    # once all n points are taken.
+    def set_trigger_then_arm(self, n=None):
+        n = self._numMax if n is None else min(int(n), self._numMax)
+        with self.batch():
+            self.write("*CLS") # clear status
+            self.configure([
+                ("TRIG:SOUR", "BUS"),          # options are BUS|IMM|EXT
+                ("TRIG:DEL:AUTO", "ON"),       # automatic trigger delay
+                ("TRIG:COUN", n),              # number of triggers the instrument will accept before returning to idle
+                ("SAMP:COUN", 1),              # 1 sample per trigger (up to 50000 allowed, but memory can only store 512)
+            ])
+            # self.write("READ?") # enter wait-for-trigger state
+            self.write("INIT") # enter wait-for-trigger state
         self._numTaken = 0
+        self._numArmed = n
+
+    ## Expected seconds per reading: the integration, twice with auto zero on
+    def reading_time(self):
+        t = float(self.nplc) / self.lineFreq
+        if self._state.get("SENS:ZERO:AUTO", "ON") != "OFF":
+            t *= 2
+        return t
 
-    def measure_one_point(self):
-        if self._numTaken < self._numMax:
-            self._s.write("*TRG\n")
+    ## Trigger one reading.
+    # @param[in] wait return once the reading is taken, so the input can
+    #            be changed; triggers sent during a reading are ignored.
+    def measure_one_point(self, wait=True):
+        if self._numTaken < self._numArmed:
+            self.write("*TRG")
             self._numTaken += 1
+            if wait:
+                self.get_points_taken(self.reading_time() + self.timeMargin)
         else:
-            print("Maximum number of data points %d reached\n" % self._numMax)
+            print("Maximum number of data points %d reached\n" % self._numArmed)
 
-    def get_points_taken(self):
-        time.sleep(1)
-        self._s.write("DATA:POIN?\n")
-        ret = self._s.readline()
+    ## Wait until the points triggered are all taken
+    # @param[in] timeout [s], by default the expected time of all the
+    #            points armed plus timeMargin.
+    def get_points_taken(self, timeout=None):
+        n = self._numTaken
+        if timeout is None:
+            timeout = self._numArmed * self.reading_time() + self.timeMargin
+        ret = self.poll("DATA:POIN?", lambda r: int(r) >= n, timeout,
+                        min(0.02, self.reading_time()))
         return int(ret)
 
     def get_data(self):
-        self._s.write("FETC?\n")
-        ret = self._s.readline()
-        return [float(x) for x in ret[:-2].split(',')]
+        ret = self.query("FETC?")
+        return [float(x) for x in ret.split(',')]
+
+## Measure the DMM voltage at arbitrary DAC codes, in batches of the
+# DMM memory size, each point triggered once its vector is in the SR.
+# @param[in] tms1mmReg TMS1mmReg holding the other register settings.
+# @param[in] dac index of the scanned DAC.
+# @param[in] regShadow optional ConfigRegShadow, only changed config_reg words are sent.
+# @return volts array, one per code
+def measure_codes(sock, dmm, tms1mmReg, codes, div=7, dac=2, regShadow=None):
+    codes = np.asarray(codes)
+    volts = np.zeros(len(codes))
+    for i0 in xrange(0, len(codes), dmm._numMax):
+        batch = codes[i0:i0 + dmm._numMax]
+        with profiler.phase("batch"):
+            with profiler.timed("instrument"):
+                dmm.set_trigger_then_arm(len(batch))
+            with profiler.timed("encode"):
+                frames = SweepFrames(tms1mmReg.sweep_words({"DAC%d" % dac: batch}), div)
+
+            # trigger the DMM once each vector is in the SR, and keep the
+            # vector until the reading is taken
+            def measure(j, data_to_send):
+                timing.debug(1, "sample id = {0:d}, dacVal = {1:d}, 0x{1:04x}".format, j, int(batch[j]))
+                timing.debug(1, "Sent to SR: 0x{0:0x}".format, data_to_send)
+                with profiler.timed("instrument"):
+                    dmm.measure_one_point()
+
+            result = sr_sweep(sock, frames, div, measure, regShadow=regShadow)
+            if not result.ok:
+                print(result.report())
+            with profiler.timed("instrument"):
+                dmm.get_points_taken()
+                volts[i0:i0 + len(batch)] = dmm.get_data()
+        if profiler.enabled:
+            print("codes {0:d}..{1:d}:".format(int(batch[0]), int(batch[-1])))
+            print(profiler.summary())
+            profiler.reset()
+    return volts
+
+## Coarse-to-fine DAC transfer curve scan.
+#
+# A coarse pass is fitted with a straight line, whose slope sets the
+# LSB.  Intervals between measured codes are then subdivided by
+# refineFactor, level by level down to single codes, where they show
+# structure:
+#   - DNL: the step across the interval differs from the fitted one by
+#     more than dnlLsb,
+#   - residual: an end point is off the line through its neighbours by
+#     more than residualLsb,
+#   - a major carry: the interval contains a multiple of 2**majorBits.
+# Single-code points are integrated for fineNplc, the others for
+# coarseNplc.
+#
+class AdaptiveDacScan(object):
+
+    ## @param[in] measure function(codes, nplc) returning the volts.
+    def __init__(self, measure, codeMax=0xffff, coarseStep=256, refineFactor=8,
+                 dnlLsb=0.5, residualLsb=0.5, majorBits=12, coarseNplc=1, fineNplc=10):
+        self.measure = measure
+        self.codeMax = codeMax
+        self.coarseStep = coarseStep
+        self.refineFactor = refineFactor
+        self.dnlLsb = dnlLsb
+        self.residualLsb = residualLsb
+        self.majorBits = majorBits
+        self.coarseNplc = coarseNplc
+        self.fineNplc = fineNplc
+        ## @var points code -> (volt, nplc) of every measured code
+        self.points = {}
+        self.fit = None
+
+    def _measure(self, codes, nplc):
+        codes = [c for c in codes if c not in self.points]
+        if not codes:
+            return
+        volts = self.measure(np.array(codes), nplc)
+        for c, v in zip(codes, volts):
+            self.points[c] = (float(v), nplc)
+
+    def _sorted(self):
+        c = np.array(sorted(self.points))
+        v = np.array([self.points[k][0] for k in c])
+        return c, v
+
+    ## Intervals (lo, hi) that show structure
+    def flagged(self, intervals):
+        c, v = self._sorted()
+        lsb = self.fit[0]
+        # residual of each point from the line through its neighbours
+        res = np.zeros(len(c))
+        if len(c) > 2:
+            line = v[:-2] + (v[2:] - v[:-2]) * (c[1:-1] - c[:-2]) / (c[2:] - c[:-2]).astype(float)
+            res[1:-1] = np.abs(v[1:-1] - line) / lsb
+        res = dict(zip(c, res))
+        carry = 1 << self.majorBits
+        out = []
+        for lo, hi in intervals:
+            dnl = (self.points[hi][0] - self.points[lo][0]) / lsb - (hi - lo)
+            if (abs(dnl) > self.dnlLsb or
+                max(res[lo], res[hi]) > self.residualLsb or
+                (hi // carry) > (lo // carry)):
+                out.append((lo, hi))
+        return out
+
+    ## Run the scan
+    # @return (codes, volts) of the measured points, sorted by code
+    def run(self):
+        step = self.coarseStep
+        coarse = list(range(0, self.codeMax + 1, step))
+        if coarse[-1] != self.codeMax:
+            coarse.append(self.codeMax)
+        self._measure(coarse, self.coarseNplc)
+        c, v = self._sorted()
+        self.fit = np.polyfit(c, v, 1)
+        intervals = list(zip(coarse[:-1], coarse[1:]))
+        while intervals and step > 1:
+            intervals = self.flagged(intervals)
+            step = max(1, step // self.refineFactor)
+            refined = []
+            new = []
+            for lo, hi in intervals:
+                codes = list(range(lo, hi, step)) + [hi]
+                new += codes[1:-1]
+                refined += list(zip(codes[:-1], codes[1:]))
+            self._measure(new, self.fineNplc if step == 1 else self.coarseNplc)
+            intervals = [iv for iv in refined if iv[1] - iv[0] > 1]
+            timing.debug(1, "step {0:d}: {1:d} codes measured, {2:d} intervals to check".format,
+                         step, len(self.points), len(intervals))
+        return self._sorted()
+
+    ## Write a regular scan file: every code, with the volts of unmeasured
+    # codes interpolated.  Columns: code, volt, measured (1/0), NPLC of the
+    # measurement (0 if interpolated).
+    def write(self, fp):
+        c, v = self._sorted()
+        codes = np.arange(self.codeMax + 1)
+        measured = np.zeros(len(codes), dtype=int)
+        measured[c] = 1
+        nplc = np.zeros(len(codes))
+        nplc[c] = [self.points[k][1] for k in c]
+        fp.write("# step size 1\n")
+        fp.write("# adaptive scan: coarse step {0:d}, {1:d} of {2:d} codes measured\n".format(
+            self.coarseStep, len(c), len(codes)))
+        fp.write("# fit: volt = {0:.9E} * code + {1:.9E}\n".format(*self.fit))
+        fp.write("# code volt measured nplc\n")
+        np.savetxt(fp, np.column_stack([codes, np.interp(codes, c, v), measured, nplc]),
+                   fmt="%6d %24.16E %d %g")
+
+    ## The scan as dacscan_dtype() records, for a ScanWriter
+    def records(self):
+        c, v = self._sorted()
+        rec = np.zeros(self.codeMax + 1, dtype=dacscan_dtype())
+        rec['code'] = np.arange(len(rec))
+        rec['volt'] = np.interp(rec['code'], c, v)
+        rec['measured'][c] = 1
+        rec['nplc'][c] = [self.points[k][1] for k in c]
+        rec['time'] = np.nan
+        return rec
 
 if __name__ == "__main__":
 
-    ser = serial.Serial('/dev/tty.usbserial-FT0CWADV',
-                        9600, 8, serial.PARITY_NONE, serial.STOPBITS_TWO,
-                        timeout=10)
+    # -a: adaptive coarse-to-fine scan instead of every code
+    adaptive = "-a" in sys.argv[1:]
+    # -b: write dacscan.scan (see scan_file) instead of dacscan.dat
+    binary = "-b" in sys.argv[1:]
+    # -e: scan a control_emulator board with an emulated DMM, one batch,
+    #     and check that every reading belongs to its code
+    emulate = "-e" in sys.argv[1:]
+
+    if emulate:
+        from control_emulator import ControlEmulatorServer, BoardEmulator, HP34401AEmulator
+        board = BoardEmulator(adcNoise=0)
+        host, port = ControlEmulatorServer(("127.0.0.1", 0), board).start()
+        ser = HP34401AEmulator(lambda: board.chip_dac_volt(2), timeScale=0.02)
+    else:
+        ser = serial.Serial('/dev/tty.usbserial-FT0CWADV',
+                            9600, 8, serial.PARITY_NONE, serial.STOPBITS_TWO,
+                            timeout=10)
+        host = '192.168.2.3'
+        port = 1024
     print(ser)
     dmm = HP34401A(ser)
     print(dmm.identify())
     print(dmm.setup_measurement())
-
-    host = '192.168.2.3'
-    port = 1024
     sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    # the read-back polls are small, do not let Nagle delay them
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     sock.connect((host,port))
 
     x2gain = 1
     bufferTest = True
     tms1mmReg = TMS1mmReg()
-    tms1mmReg.set_power_down(0, 0)
-    tms1mmReg.set_power_down(3, 0)
-
-    if bufferTest:
-        tms1mmReg.set_k(0, 0) # 0 - K1 is open, disconnect CSA output
-        tms1mmReg.set_k(1, 1) # 1 - K2 is closed, allow BufferX2_testIN to inject signal
-        tms1mmReg.set_k(4, 0) # 0 - K5 is open, disconnect SDM loads
-        tms1mmReg.set_k(6, 1) # 1 - K7 is closed, BufferX2 output to AOUT_BufferX2
-    if x2gain == 2:
-        tms1mmReg.set_k(2, 1) # 1 - K3 is closed, K4 is open, setting gain to X2
-        tms1mmReg.set_k(3, 0)
-    else:
-        tms1mmReg.set_k(2, 0)
-        tms1mmReg.set_k(3, 1)
-
-    tms1mmReg.set_k(6, 1) # 1 - K7 is closed, BufferX2 output to AOUT_BufferX2
-    tms1mmReg.set_k(7, 1) # 1 - K8 is closed, connect CSA out to AOUT1_CSA
+    tms1mmReg.set_test_mode(bufferTest, x2gain)
+    tms1mmReg.apply_preset('aout') # K7, K8 closed, BufferX2 and CSA out to AOUT
     tms1mmReg.set_dac(0, 0x0000) # VBIASN
     tms1mmReg.set_dac(1, 0xffff) # VBIASP
 
     div = 7 # SR clock freq divisor 2**div
-    stepsize = 1 # DAC code step size
-    batches = 128 # total # of points taken is 512 * batches
-
-    dfp = open("dacscan.dat", "w")
-    dfp.write("# step size %d\n" % stepsize)
-
-    for i in xrange(batches):
-        dmm.set_trigger_then_arm()
-        for j in xrange(dmm._numMax):
-            dacVal = (i*dmm._numMax + j) * stepsize
-            print("sample id = %d, dacVal = %d, 0x%04x" % (j, dacVal, dacVal))
-            tms1mmReg.set_dac(2, dacVal)
-            data_to_send = tms1mmReg.get_config_vector()
-            print("Sent to SR: 0x%0x" % (data_to_send))
-            shift_register_rw(sock, (data_to_send), div)
-            dmm.measure_one_point()
-        dmm.get_points_taken()
-        dmmData = dmm.get_data()
-        j = 0
-        for x in dmmData:
-            dfp.write("%6d %24.16E\n" % ((i*dmm._numMax + j) * stepsize, x))
-            j += 1
-        dfp.flush()
 
+    # only the config_reg words of the scanned DAC change between points
+    regShadow = ConfigRegShadow()
+
+    if binary:
+        meta = {"register" : tms1mmReg.get_reg_map(), "div" : div, "dac" : 2, "adaptive" : adaptive}
+        dfp = ScanWriter("dacscan.scan", dacscan_dtype(), meta)
+    else:
+        dfp = open("dacscan.dat", "w")
+    if adaptive:
+        def measure(codes, nplc):
+            dmm.set_nplc(nplc)
+            return measure_codes(sock, dmm, tms1mmReg, codes, div, regShadow=regShadow)
+        scan = AdaptiveDacScan(measure)
+        scan.run()
+        if binary:
+            dfp.append_rows(scan.records())
+        else:
+            scan.write(dfp)
+    else:
+        stepsize = 1 # DAC code step size
+        batches = 1 if emulate else 128 # total # of points taken is 512 * batches
+        if not binary:
+            dfp.write("# step size %d\n" % stepsize)
+        for i in xrange(batches):
+            codes = (i*dmm._numMax + np.arange(dmm._numMax)) * stepsize
+            volts = measure_codes(sock, dmm, tms1mmReg, codes, div, regShadow=regShadow)
+            if emulate:
+                expect = codes * board.dac_fit_a + board.dac_fit_b
+                bad = np.flatnonzero(np.abs(volts - expect) > 0.5 * board.dac_fit_a)
+                print("emulated scan: {0:d} of {1:d} readings off their code, {2:d} triggers ignored".format(
+                    len(bad), len(codes), ser.nIgnored))
+            with profiler.timed("file write"):
+                if binary:
+                    t = time.time()
+                    for code, x in zip(codes, volts):
+                        dfp.append(code=code, volt=x, measured=1, nplc=dmm.nplc, time=t)
+                else:
+                    for code, x in zip(codes, volts):
+                        dfp.write("%6d %24.16E\n" % (code, x))
+                dfp.flush()
     dfp.close()
 
     sock.close()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package data_fifo
+# Streaming reader of the DATA_FIFO of control_interface (address 25).
+#
+# Several read_datafifo requests are kept in flight.  Replies are
+# received with recv_into() into a preallocated ring buffer and handed
+# out as zero-copy numpy views.
+#
+
+from __future__ import print_function
+import socket
+import time
+import argparse
+import numpy as np
+from command import *
+
+## Read the data fifo at rate
+#
+class DataFifoReader(object):
+
+    ## @param[in] s Socket that is already open and connected to the FPGA board.
+    # @param[in] nWords number of 32-bit words per request, 1 to 65536.
+    # @param[in] nInFlight number of requests sent ahead of the one being received.
+    # @param[in] nSlots number of request-sized slots in the ring buffer.
+    #            A yielded view stays valid for nSlots-1 further requests.
+    # @param[in] timeout seconds to wait for the words of a request
+    #            before it is counted as short.
+    def __init__(self, s, nWords=4096, nInFlight=4, nSlots=None, timeout=1.0, cmd=None):
+        if nWords < 1 or nWords > 65536:
+            raise ValueError("nWords must be in [1, 65536], got %d" % nWords)
+        if cmd is None:
+            cmd = CmdBatch()
+        if nSlots is None:
+            nSlots = 2 * nInFlight
+        self.s = s
+        self.nWords = nWords
+        self.nInFlight = nInFlight
+        self.nSlots = nSlots
+        self.timeout = timeout
+        # n+1 words are transferred for a request of n
+        self._cmdstr = cmd.read_datafifo(nWords - 1)
+        self._slotBytes = 4 * nWords
+        self._ring = bytearray(nSlots * self._slotBytes)
+        self._view = memoryview(self._ring)
+        ## @var nPending bytes of replies left on the socket by a stream
+        # that could not be drained in time; while not 0, the socket is
+        # out of step and has to be reconnected
+        self.nPending = 0
+        self.reset_stats()
+
+    ## Clear the statistics, done at the start of every stream()
+    def reset_stats(self):
+        ## @var nRequests number of requests received, including short ones
+        self.nRequests = 0
+        ## @var nShort number of requests that did not deliver all words in time
+        self.nShort = 0
+        ## @var nBytes number of bytes received
+        self.nBytes = 0
+        self._t0 = None
+        self._t1 = None
+
+    ## Elapsed streaming time in seconds
+    def elapsed(self):
+        if self._t0 is None:
+            return 0.0
+        t1 = self._t1 if self._t1 is not None else time.time()
+        return t1 - self._t0
+
+    ## Sustained throughput in MB/s
+    def rate(self):
+        t = self.elapsed()
+        return self.nBytes / t / 1e6 if t > 0 else 0.0
+
+    def summary(self):
+        return ("{0:d} requests ({1:d} short), {2:d} bytes in {3:.3f}s, {4:.3f} MB/s"
+                .format(self.nRequests, self.nShort, self.nBytes, self.elapsed(), self.rate()))
+
+    ## Fill the slot at byte offset off; progress is kept in self._got
+    # so that a timeout leaves the number of bytes that did arrive.
+    def _recv_slot(self, off):
+        self._got = 0
+        while self._got < self._slotBytes:
+            n = self.s.recv_into(self._view[off + self._got : off + self._slotBytes],
+                                 self._slotBytes - self._got)
+            if n == 0:
+                raise IOError("connection closed after %d of %d bytes" % (self._got, self._slotBytes))
+            self._got += n
+
+    ## Receive and drop the replies left in flight by a stream, so that
+    # the next command on the socket reads its own reply.
+    # @param[in] timeout seconds to wait for each part, self.timeout if None.
+    # @return nPending, bytes still not received
+    def drain(self, timeout=None):
+        if self.nPending <= 0:
+            return 0
+        oldTimeout = self.s.gettimeout()
+        self.s.settimeout(self.timeout if timeout is None else timeout)
+        scratch = bytearray(min(self.nPending, self._slotBytes))
+        try:
+            while self.nPending > 0:
+                n = self.s.recv_into(scratch, min(self.nPending, len(scratch)))
+                if n == 0:
+                    break
+                self.nPending -= n
+        except socket.timeout:
+            pass
+        finally:
+            self.s.settimeout(oldTimeout)
+        return self.nPending
+
+    ## Generator of received data.
+    # Each item is a numpy big-endian uint32 view into the ring buffer
+    # holding the words of one request.  A short request ends the
+    # stream after yielding the words that did arrive.  When the stream
+    # ends early, so, or by the consumer stopping, the replies still in
+    # flight are received and dropped, waiting up to timeout for each
+    # part; what does not arrive is left in nPending, see drain().
+    # @param[in] nRequests number of requests, None for no limit.
+    def stream(self, nRequests=None):
+        if self.drain() > 0:
+            raise IOError("{0:d} bytes of an earlier stream still pending, reconnect".format(self.nPending))
+        oldTimeout = self.s.gettimeout()
+        self.s.settimeout(self.timeout)
+        # the statistics are of this stream
+        self.reset_stats()
+        nSent = 0
+        nRecv = 0
+        partial = 0
+        slot = 0
+        self._t0 = time.time()
+        try:
+            while nSent < self.nInFlight and (nRequests is None or nSent < nRequests):
+                self.s.sendall(self._cmdstr)
+                nSent += 1
+            while nRequests is None or nRecv < nRequests:
+                off = slot * self._slotBytes
+                try:
+                    self._recv_slot(off)
+                except socket.timeout:
+                    partial = self._got
+                    self.nRequests += 1
+                    self.nShort += 1
+                    self.nBytes += self._got
+                    yield np.frombuffer(self._ring, dtype='>u4', count=self._got // 4, offset=off)
+                    return
+                nRecv += 1
+                self.nRequests += 1
+                self.nBytes += self._got
+                if nRequests is None or nSent < nRequests:
+                    self.s.sendall(self._cmdstr)
+                    nSent += 1
+                yield np.frombuffer(self._ring, dtype='>u4', count=self.nWords, offset=off)
+                slot = (slot + 1) % self.nSlots
+        finally:
+            self._t1 = time.time()
+            self.s.settimeout(oldTimeout)
+            self.nPending = (nSent - nRecv) * self._slotBytes - partial
+            self.drain()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--control-ip-port", type=str, default="192.168.2.3:1024", help="main control system ipaddr and port")
+    parser.add_argument("-w", "--words", type=int, default=4096, help="32-bit words per request")
+    parser.add_argument("-f", "--in-flight", type=int, default=4, help="requests kept in flight")
+    parser.add_argument("-n", "--requests", type=int, default=1000, help="total number of requests")
+    args = parser.parse_args()
+
+    ctrlipport = args.control_ip_port.split(':')
+    s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    s.connect((ctrlipport[0],int(ctrlipport[1])))
+
+    reader = DataFifoReader(s, args.words, args.in_flight)
+    for data in reader.stream(args.requests):
+        pass
+    print(reader.summary())
+
+    s.close()
@@ -6,78 +6,105 @@
 #
 
 from __future__ import print_function
-import time
 import os
 import sys
 import shutil
-import math
-# use either usbtmc or NI Visa
-try:
-    import usbtmc
-except:
-    import visa
+import hashlib
+import numpy
+from scpi import SCPIInstrument, open_visa
 
-## Rigol DG1022
-class DG1022(object):
+## @var dacMax full scale of the 14-bit arbitrary waveform DAC
+dacMax = 16383
+
+## Tail-pulse samples as DAC codes
+# @param xp number of samples before the edge
+# @param np total number of samples for the pulse
+# @param alpha exp-decay coefficient in exp(-alpha * (i - xp))
+# @return uint16 array of np codes
+def tail_pulse_samples(xp=16, np=1024, alpha=0.01):
+    i = numpy.arange(np, dtype=float)
+    vals = numpy.trunc(dacMax * (1.0 - numpy.exp(-(i - xp) * alpha)))
+    vals[:xp] = dacMax
+    return numpy.clip(vals, 0, dacMax).astype(numpy.uint16)
+
+## Tail-pulse samples as a DATA:DAC command string, in ASCII
+def tail_pulse_command(xp=16, np=1024, alpha=0.01):
+    return "DATA:DAC VOLATILE," + ",".join(map(str, tail_pulse_samples(xp, np, alpha).tolist()))
 
-    ## @var handle to instrument
-    _instr = None
+## DATA:DAC command of DAC codes as an IEEE 488.2 definite-length
+# binary block, 2 bytes per sample: a third of the ASCII size, and no
+# number parsing in the instrument.
+# @param byteOrder '<' or '>', see DG1022.byteOrder.
+def dac_block_command(vals, byteOrder='<'):
+    data = numpy.asarray(vals, dtype=byteOrder + 'u2').tobytes()
+    size = str(len(data)).encode("ascii")
+    return b"DATA:DAC VOLATILE,#" + str(len(size)).encode("ascii") + size + data
+
+## Rigol DG1022
+class DG1022(SCPIInstrument):
 
     ## Initialization
-    def __init__(self):
-        try:
-            rm = visa.ResourceManager()
-            rm.list_resources()                 # list available instruments
-            self._instr = rm.open_resource('USB0::0x1AB1::0x0588::DG1D131402088::INSTR')
-        except:
-            self._instr = usbtmc.Instrument(0x1ab1, 0x0588) # RIGOL TECHNOLOGIES,DG1022 ,DG1D131402088
-            self._instr.timeout = 10
-
-    ## Generate tail-pulse and write into instrument's memory
+    # @param transport scpi transport, the USB instrument (NI VISA or usbtmc) if None
+    def __init__(self, transport=None):
+        if transport is None:
+            # RIGOL TECHNOLOGIES,DG1022 ,DG1D131402088
+            transport = open_visa('USB0::0x1AB1::0x0588::DG1D131402088::INSTR', 0x1ab1, 0x0588)
+        SCPIInstrument.__init__(self, transport)
+
+    ## @var byteOrder of the samples in binary blocks
+    byteOrder = '<'
+
+    ## @var _waveformKey (xp, np, alpha, freq) of the last setup_tail_pulse()
+    _waveformKey = None
+    ## @var _waveformDigest SHA-1 of the samples in volatile memory
+    _waveformDigest = None
+
+    ## Forget what is in the instrument, e.g. after it was used from the
+    # front panel, so that the next setup uploads again.
+    def invalidate(self):
+        SCPIInstrument.invalidate(self)
+        self._waveformKey = None
+        self._waveformDigest = None
+
+    ## Generate tail-pulse and write into instrument's memory.
+    # The waveform is uploaded only when its samples differ from the ones
+    # uploaded last, so repeating a setup, e.g. in a charge-injection scan
+    # changing only the amplitude, sends nothing.
     # @param xp number of samples before the edge
     # @param np total number of samples for the pulse
     # @param alpha exp-decay coefficient in exp(-alpha * (i - xp))
+    # @return True if the waveform was uploaded
     def setup_tail_pulse(self, freq=100, xp=16, np=1024, alpha=0.01):
-        self._instr.write("FUNC USER")
-        time.sleep(0.5)
-        self._instr.write("FREQ %g" % freq)
-        time.sleep(0.5)
-
-        amax = 16383
-        vals=[0 for i in xrange(np)]
-        for i in xrange(np):
-            if i<xp:
-                vals[i] = amax
-            else:
-                vals[i] = int(amax*(1-math.exp(-(i-xp)*alpha)))
-        string = "DATA:DAC VOLATILE"
-        for i in xrange(np):
-            string += (",%d"% vals[i])
-        self._instr.write(string)
-        time.sleep(1.0)
-        self._instr.write("FUNC:USER VOLATILE")
-        time.sleep(0.5)
+        key = (xp, np, alpha, freq)
+        if key == self._waveformKey:
+            return False
+        block = dac_block_command(tail_pulse_samples(xp, np, alpha), self.byteOrder)
+        digest = hashlib.sha1(block).hexdigest()
+        uploaded = digest != self._waveformDigest
+        if uploaded:
+            self._waveformDigest = None
+            self.set("FUNC", "USER")
+            self.write_raw(block)
+            self.write("FUNC:USER VOLATILE")
+            self.sync()
+            self._waveformDigest = digest
+        self.set_frequency(freq)
+        self._waveformKey = key
+        return uploaded
 
     def set_frequency(self, freq=100.0):
-        self._instr.write("FREQ %g" % freq)
-        time.sleep(0.5)
+        if self.set("FREQ", freq):
+            self.sync()
+        if self._waveformKey is not None:
+            self._waveformKey = self._waveformKey[:3] + (freq,)
 
     def set_voltage(self, vLow=0.0, vHigh=1.0):
-        self._instr.write("VOLT:UNIT VPP")
-        time.sleep(0.5)
-        self._instr.write("VOLTage:LOW %g" % vLow)
-        time.sleep(0.5)
-        self._instr.write("VOLTage:HIGH %g" % vHigh)
-        time.sleep(0.5)
+        if self.configure([("VOLT:UNIT", "VPP"), ("VOLT:LOW", vLow), ("VOLT:HIGH", vHigh)]):
+            self.sync()
 
     def turn_on_output(self):
-        self._instr.write("OUTP:LOAD 50")
-        time.sleep(0.5)
-        self._instr.write("OUTP ON")
-        time.sleep(0.5)
-
-    def close(self):
-        self._instr.close()
+        if self.configure([("OUTP:LOAD", 50), ("OUTP", "ON")]):
+            self.sync()
 
 if __name__ == "__main__":
 
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package hdf5rawWaveformIo
+# Write raw waveform files in the layout of hdf5rawWaveformIo.c.
+#
+# Root attributes nEvents, nWfmPerChunk and nCh, a compound attribute
+# "Waveform Attributes", and datasets /C0, /C1, ... of shape
+# (nCh, nPt*nWfmPerChunk), each holding nWfmPerChunk events.
+#
+# The length of the per-channel arrays of "Waveform Attributes"
+# (SCOPE_NCH) and the sample type (SCOPE_DATA_TYPE) are compile-time
+# settings of common.h that differ between the programs, and a file
+# only reads back with the same ones: Analysis/src/common.h, which
+# pulserENC is built with, has 4 and int8, Control/src/common.h 8 and
+# int16.  The writer defaults to the layout of pulserENC (layouts
+# "analysis" and "control").  With int8 samples, waveforms must fit in
+# 8 bits.
+#
+
+from __future__ import print_function
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import numpy as np
+import h5py
+
+## @var layouts (SCOPE_NCH, SCOPE_DATA_TYPE) of the common.h of Analysis/src,
+# which pulserENC reads, and of Control/src
+layouts = {"analysis" : (4, np.int8), "control" : (8, np.int16)}
+
+## Memory layout of struct waveform_attribute
+# @param[in] scopeNch SCOPE_NCH, length of the per-channel arrays.
+def waveform_attribute_dtype(scopeNch):
+    return np.dtype([
+        ('wavAttr.chMask',  np.uint32),
+        ('wavAttr.nPt',     np.uint64),
+        ('wavAttr.nFrames', np.uint64),
+        ('wavAttr.dt',      np.float64),
+        ('wavAttr.t0',      np.float64),
+        ('wavAttr.ymult',   np.float64, (scopeNch,)),
+        ('wavAttr.yoff',    np.float64, (scopeNch,)),
+        ('wavAttr.yzero',   np.float64, (scopeNch,))], align=True)
+
+## Chunked waveform file writer.
+# Events are buffered into whole chunks, and chunks are written to disk
+# by a background thread so that acquisition does not block on I/O.
+#
+class WaveformWriter(object):
+
+    ## @param[in] fname output file name, overwritten if it exists.
+    # @param[in] nWfmPerChunk number of events grouped in one dataset.
+    # @param[in] nCh number of channels in each event.
+    # @param[in] nPt number of points in each waveform.
+    # @param[in] compress use shuffle+deflate on the datasets.
+    # @param[in] queueDepth number of chunks waiting for the writer thread
+    #            before write_event() blocks.
+    # @param[in] layout "analysis" or "control", see layouts; scopeNch and
+    #            dataType override its SCOPE_NCH and SCOPE_DATA_TYPE.
+    def __init__(self, fname, nWfmPerChunk, nCh, nPt, compress=False, compressLevel=4,
+                 queueDepth=8, layout="analysis", scopeNch=None, dataType=None):
+        self.scopeNch = layouts[layout][0] if scopeNch is None else scopeNch
+        self.dataType = np.dtype(layouts[layout][1] if dataType is None else dataType)
+        self.attributeDtype = waveform_attribute_dtype(self.scopeNch)
+        self.nWfmPerChunk = nWfmPerChunk
+        self.nCh = nCh
+        self.nPt = nPt
+        self.compress = compress
+        self.compressLevel = compressLevel
+        self.nEvents = 0
+        self._fp = h5py.File(fname, "w")
+        root = self._fp["/"]
+        root.attrs.create("nEvents", 0, dtype=np.uint64)
+        root.attrs.create("nWfmPerChunk", nWfmPerChunk, dtype=np.uint64)
+        root.attrs.create("nCh", nCh, dtype=np.uint64)
+        self._chunk = self._new_chunk()
+        self._inChunk = 0
+        self._error = None
+        self._queue = queue.Queue(queueDepth)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _new_chunk(self):
+        return np.zeros((self.nCh, self.nPt * self.nWfmPerChunk), dtype=self.dataType)
+
+    ## Write the "Waveform Attributes" header.  nPt is taken from the writer.
+    # @param[in] ymult, yoff, yzero per-channel sequences of up to scopeNch values.
+    def write_waveform_attribute(self, chMask, dt, t0=0.0, nFrames=0,
+                                 ymult=None, yoff=None, yzero=None):
+        attr = np.zeros((), dtype=self.attributeDtype)
+        attr['wavAttr.chMask'] = chMask
+        attr['wavAttr.nPt'] = self.nPt
+        attr['wavAttr.nFrames'] = nFrames
+        attr['wavAttr.dt'] = dt
+        attr['wavAttr.t0'] = t0
+        for name, val in (('ymult', ymult), ('yoff', yoff), ('yzero', yzero)):
+            if val is not None:
+                attr['wavAttr.' + name][:len(val)] = val
+        self._queue.put(('attr', attr))
+
+    ## Append one event.
+    # @param[in] wavBuf array of nCh*nPt values, ch1..ch2.. (row-major).
+    # @return event id
+    def write_event(self, wavBuf):
+        self._check_error()
+        wavBuf = np.asarray(wavBuf)
+        if wavBuf.dtype.itemsize > self.dataType.itemsize and wavBuf.size > 0:
+            info = np.iinfo(self.dataType)
+            if wavBuf.min() < info.min or wavBuf.max() > info.max:
+                raise ValueError("samples out of the {0} range of the file".format(self.dataType))
+        off = self._inChunk * self.nPt
+        self._chunk[:, off:off + self.nPt] = np.reshape(wavBuf, (self.nCh, self.nPt))
+        eventId = self.nEvents
+        self.nEvents += 1
+        self._inChunk += 1
+        if self._inChunk == self.nWfmPerChunk:
+            self._queue.put(('chunk', (eventId // self.nWfmPerChunk, self._chunk, self._inChunk)))
+            self._chunk = self._new_chunk()
+            self._inChunk = 0
+        return eventId
+
+    ## Write the partially filled chunk and nEvents, and wait until
+    # everything queued so far is on disk.
+    def flush(self):
+        if self._inChunk > 0:
+            self._queue.put(('chunk', (self.nEvents // self.nWfmPerChunk,
+                                       self._chunk.copy(), self._inChunk)))
+        self._queue.put(('flush', self.nEvents))
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+        self._fp.close()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _write_chunk(self, chunkId, data, nEvt):
+        name = "C%d" % chunkId
+        if name in self._fp:
+            ds = self._fp[name]
+        else:
+            kw = {}
+            if self.compress:
+                kw = dict(shuffle=True, compression="gzip", compression_opts=self.compressLevel)
+            ds = self._fp.create_dataset(name, shape=data.shape, dtype=self.dataType,
+                                         chunks=(1, self.nPt), **kw)
+        ds[:, :nEvt * self.nPt] = data[:, :nEvt * self.nPt]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is not None:
+                    continue
+                kind, arg = item
+                if kind == 'chunk':
+                    self._write_chunk(*arg)
+                elif kind == 'attr':
+                    self._fp["/"].attrs.create("Waveform Attributes", arg,
+                                               dtype=self.attributeDtype)
+                elif kind == 'flush':
+                    self._fp["/"].attrs.modify("nEvents", np.uint64(arg))
+                    self._fp.flush()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+if __name__ == "__main__":
+
+    nPt = 10000
+    wavBuf = np.zeros(2 * nPt, dtype=np.int8)
+    wavBuf[:20] = np.arange(1, 21)
+
+    wfw = WaveformWriter("test.h5", 4, 2, nPt)
+    wfw.write_waveform_attribute(0x0a, 1e-6, ymult=[1, 1, 1, 1])
+    for i in range(10):
+        wfw.write_event(wavBuf)
+    wfw.close()
+    print("wrote {0:d} events".format(wfw.nEvents))
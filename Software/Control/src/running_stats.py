@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package running_stats
+# Streaming mean, variance, min and max of several quantities at once,
+# without keeping the samples.
+#
+# Single samples are folded in with Welford's update, batches with
+# Chan's pairwise combination of (count, mean, M2), which is also what
+# merges two RunningStats.
+#
+
+from __future__ import print_function
+import numpy as np
+
+## Running statistics of n quantities, e.g. ADC channels
+#
+class RunningStats(object):
+
+    def __init__(self, n=1):
+        self.count = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n)
+        ## @var m2 sum of squared deviations from the mean
+        self.m2 = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+
+    def __len__(self):
+        return len(self.count)
+
+    ## Welford update with one sample of every quantity
+    # @param[in] x array of n samples.
+    def update(self, x):
+        x = np.asarray(x, dtype=float)
+        self.count += 1
+        d = x - self.mean
+        self.mean += d / self.count
+        self.m2 += d * (x - self.mean)
+        np.minimum(self.min, x, out=self.min)
+        np.maximum(self.max, x, out=self.max)
+
+    ## Fold a batch of samples of quantity i in
+    def add(self, i, x):
+        x = np.asarray(x, dtype=float).ravel()
+        if x.size == 0:
+            return
+        mean = x.mean()
+        self._combine(i, x.size, mean, ((x - mean)**2).sum(), x.min(), x.max())
+
+    ## Fold the statistics of another RunningStats of the same size in
+    def merge(self, other):
+        for i in range(len(self)):
+            if other.count[i] > 0:
+                self._combine(i, other.count[i], other.mean[i], other.m2[i],
+                              other.min[i], other.max[i])
+
+    def _combine(self, i, nb, meanb, m2b, minb, maxb):
+        na = self.count[i]
+        n = na + nb
+        d = meanb - self.mean[i]
+        self.mean[i] += d * nb / float(n)
+        self.m2[i] += m2b + d * d * na * nb / float(n)
+        self.count[i] = n
+        self.min[i] = min(self.min[i], minb)
+        self.max[i] = max(self.max[i], maxb)
+
+    ## Variance, nan where there are not more than ddof samples
+    def var(self, ddof=1):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > ddof, self.m2 / np.maximum(self.count - ddof, 1), np.nan)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.var(ddof))
+
+    ## Standard error of the mean
+    def sem(self, ddof=1):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.std(ddof) / np.sqrt(self.count)
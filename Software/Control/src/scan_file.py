@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package scan_file
+# Binary columnar scan files, memory-mappable into NumPy.
+#
+# Layout:
+#   magic "TMSSCAN\x01", uint32 (little endian) header length,
+#   JSON header padded with spaces to a multiple of 64 bytes,
+#   fixed-size little endian records back to back.
+#
+# The header holds the record dtype ("columns") and free-form metadata
+# (register state, instrument settings, chip location, ...).  Files
+# holding several runs of the same chip keep the metadata of run i in
+# meta["runs"][i].  The number of records follows from the file size,
+# so appending records never rewrites the header, and a record cut short
+# by a crash is dropped on reopening.
+#
+# Run as a script to convert text scan files:
+#   scan_file.py x0000y0006.dat [...]   writes x0000y0006.scan next to each
+#   scan_file.py -i file.scan           prints the header and record count
+#
+
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import struct
+import numpy as np
+
+MAGIC = b"TMSSCAN\x01"
+## @var headerAlign records start at a multiple of this many bytes
+headerAlign = 64
+
+## Record dtype of TMS1mmProbeCard scans.
+# @param[in] nCh number of ADC channels (ch=-1..6 by default).
+# @param[in] sigma add the per-channel standard deviations of oversampled points.
+def probe_dtype(nCh=8, sigma=False):
+    cols = [('run', '<u2'), ('code', '<u4'), ('volt', '<f8', (nCh,))]
+    if sigma:
+        cols.append(('sigma', '<f8', (nCh,)))
+    # readback_ok: 1 ok, 0 failed, -1 unknown (converted text files)
+    cols += [('time', '<f8'), ('readback_ok', 'i1')]
+    return np.dtype(cols)
+
+## Record dtype of dac_scan.py scans
+def dacscan_dtype():
+    return np.dtype([('code', '<u4'), ('volt', '<f8'), ('measured', 'u1'),
+                     ('nplc', '<f4'), ('time', '<f8')])
+
+def _dtype_to_json(dtype):
+    return [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)]
+            for name in dtype.names]
+
+def _dtype_from_json(cols):
+    return np.dtype([(str(n), str(t), tuple(s)) if s else (str(n), str(t)) for n, t, s in cols])
+
+## Magic, length and JSON header, padded so records are aligned
+# @param[in] size pad to this many bytes if the header fits.
+def _header_block(dtype, meta, size=0):
+    header = json.dumps({"columns" : _dtype_to_json(dtype), "meta" : meta},
+                        sort_keys=True).encode("utf-8")
+    hlen = len(header) + (-(len(MAGIC) + 4 + len(header)) % headerAlign)
+    hlen = max(hlen, size - len(MAGIC) - 4)
+    return MAGIC + struct.pack("<I", hlen) + header.ljust(hlen, b" ")
+
+## Header of a scan file
+# @return (metadata dict, record dtype, offset of the first record)
+def read_header(fname):
+    with open(fname, "rb") as fp:
+        head = fp.read(len(MAGIC) + 4)
+        if len(head) < len(MAGIC) + 4 or head[:len(MAGIC)] != MAGIC:
+            raise ValueError("{0}: not a scan file".format(fname))
+        hlen = struct.unpack("<I", head[len(MAGIC):])[0]
+        header = json.loads(fp.read(hlen).decode("utf-8"))
+    return header["meta"], _dtype_from_json(header["columns"]), len(MAGIC) + 4 + hlen
+
+## Open a scan file for analysis.
+# @param[in] mode 'r' read-only, 'r+' to modify records in place, 'c' copy-on-write.
+# @return (metadata dict, record array memory-mapped from the file)
+def read_scan(fname, mode='r'):
+    meta, dtype, offset = read_header(fname)
+    n = (os.path.getsize(fname) - offset) // dtype.itemsize
+    if n == 0:
+        return meta, np.zeros(0, dtype=dtype)
+    return meta, np.memmap(fname, dtype=dtype, mode=mode, offset=offset, shape=(n,))
+
+## Replace the metadata of a scan file.  The header is rewritten in place
+# when it still fits, otherwise the file is copied behind the larger
+# header and replaced as a whole.
+def write_meta(fname, meta):
+    meta0, dtype, offset = read_header(fname)
+    block = _header_block(dtype, meta, offset)
+    if len(block) == offset:
+        with open(fname, "r+b") as fp:
+            fp.write(block)
+        return
+    tmp = fname + ".tmp"
+    with open(fname, "rb") as src, open(tmp, "wb") as dst:
+        dst.write(block)
+        src.seek(offset)
+        shutil.copyfileobj(src, dst)
+    if not hasattr(os, "replace"):
+        os.remove(fname)
+    getattr(os, "replace", os.rename)(tmp, fname)
+
+## Name of a file records of dtype can be appended to: fname, unless it
+# holds records of another dtype, then the first of name_1.ext,
+# name_2.ext, ... that does not.
+def appendable_name(fname, dtype):
+    dtype = np.dtype(dtype)
+    root, ext = os.path.splitext(fname)
+    name, k = fname, 0
+    while os.path.exists(name) and os.path.getsize(name) > 0 and read_header(name)[1] != dtype:
+        k += 1
+        name = "{0:s}_{1:d}{2:s}".format(root, k, ext)
+    return name
+
+## Buffered writer of scan files.
+#
+class ScanWriter(object):
+
+    ## @param[in] dtype record dtype, e.g. probe_dtype().
+    # @param[in] meta JSON-serializable metadata stored in the header.
+    # @param[in] bufferRows records collected before they are written.
+    # @param[in] append add to an existing file of the same dtype; its
+    #            header, and so its metadata, is kept, see write_meta()
+    #            to change it.
+    def __init__(self, fname, dtype, meta=None, bufferRows=256, append=False):
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        if append and os.path.exists(fname) and os.path.getsize(fname) > 0:
+            meta0, dtype0, offset = read_header(fname)
+            if dtype0 != self.dtype:
+                raise ValueError("{0}: records are {1}, not {2}".format(fname, dtype0, self.dtype))
+            self.meta = meta0
+            self._fp = open(fname, "r+b")
+            n = (os.path.getsize(fname) - offset) // self.dtype.itemsize
+            # drop a partial record left by an interrupted write
+            self._fp.truncate(offset + n * self.dtype.itemsize)
+            self._fp.seek(0, os.SEEK_END)
+        else:
+            self.meta = meta if meta is not None else {}
+            self._fp = open(fname, "wb")
+            self._fp.write(_header_block(self.dtype, self.meta))
+        self._buf = np.zeros(bufferRows, dtype=self.dtype)
+        self._zero = np.zeros((), dtype=self.dtype)
+        self._n = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    ## Add one record, fields not given are zero.
+    def append(self, **fields):
+        self._buf[self._n] = self._zero
+        for name, val in fields.items():
+            self._buf[name][self._n] = val
+        self._n += 1
+        if self._n == len(self._buf):
+            self.flush()
+
+    ## Add a structured array of records
+    def append_rows(self, rows):
+        self.flush()
+        self._fp.write(np.asarray(rows, dtype=self.dtype).tobytes())
+
+    def flush(self):
+        if self._n > 0:
+            self._fp.write(self._buf[:self._n].tobytes())
+            self._n = 0
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self.flush()
+            self._fp.close()
+            self._fp = None
+
+## Convert a text scan file: a TMS1mmProbeCard x####y####.dat (one block
+# per '# Chip x y' run) or a dac_scan.py dacscan.dat.
+# @return name of the written file
+def convert_text(fname, out=None):
+    if out is None:
+        out = os.path.splitext(fname)[0] + ".scan"
+    rows = []
+    chips = []
+    meta = {"source" : os.path.abspath(fname)}
+    with open(fname) as fp:
+        for line in fp:
+            f = line.split()
+            if not f:
+                continue
+            if f[0] == "#":
+                if len(f) == 4 and f[1] == "Chip":
+                    chips.append([int(f[2]), int(f[3])])
+                elif len(f) >= 4 and f[1:3] == ["step", "size"]:
+                    meta["step"] = int(f[3])
+                continue
+            rows.append((len(chips) - 1, [float(x) for x in f]))
+    if not rows:
+        raise ValueError("{0}: no data rows".format(fname))
+    ncol = len(rows[0][1])
+    if chips or ncol > 4:
+        # code, ch=-1..6 volts, then the sigmas of oversampled scans
+        sigma = (ncol - 1) % 2 == 0 and ncol > 9
+        nCh = (ncol - 1) // 2 if sigma else ncol - 1
+        dtype = probe_dtype(nCh, sigma)
+        meta["chip"] = chips[0] if chips else None
+        meta["runs"] = [{"chip" : c} for c in chips]
+        data = np.zeros(len(rows), dtype=dtype)
+        vals = np.array([r[1] for r in rows])
+        data['run'] = [max(r[0], 0) for r in rows]
+        data['code'] = vals[:, 0]
+        data['volt'] = vals[:, 1:1 + nCh]
+        if sigma:
+            data['sigma'] = vals[:, 1 + nCh:]
+        data['time'] = np.nan
+        data['readback_ok'] = -1
+    else:
+        dtype = dacscan_dtype()
+        vals = np.array([r[1] for r in rows])
+        data = np.zeros(len(rows), dtype=dtype)
+        data['code'] = vals[:, 0]
+        data['volt'] = vals[:, 1]
+        data['measured'] = vals[:, 2] if ncol > 2 else 1
+        data['nplc'] = vals[:, 3] if ncol > 3 else 0
+        data['time'] = np.nan
+    with ScanWriter(out, dtype, meta) as w:
+        w.append_rows(data)
+    return out
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("usage: {0} [-i] file...".format(sys.argv[0]))
+        sys.exit(1)
+    if sys.argv[1] == "-i":
+        for fname in sys.argv[2:]:
+            meta, rec = read_scan(fname)
+            print("{0}: {1:d} records of {2}".format(fname, len(rec), rec.dtype))
+            print(json.dumps(meta, indent=2, sort_keys=True))
+    else:
+        for fname in sys.argv[1:]:
+            print("{0} -> {1}".format(fname, convert_text(fname)))
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package scpi
+# SCPI instrument control shared by the function generator, multimeter
+# and source meter classes.
+#
+# A transport moves lines of text to and from the instrument: an open
+# pyserial port (SerialTransport), a VISA or usbtmc instrument
+# (VisaTransport, see open_visa()) or a raw TCP socket
+# (SocketTransport).  SCPIInstrument builds on it:
+#   - commands written together, or inside a batch() block, go out as
+#     one semicolon-joined message,
+#   - sync() waits for *OPC? and poll() for a status query, instead of
+#     sleeping a fixed time,
+#   - set() and configure() remember the settings sent, so repeating
+#     them, or a whole *RST and configure sequence, sends nothing.
+#
+
+from __future__ import print_function
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+def _to_bytes(msg):
+    return msg if isinstance(msg, bytes) else msg.encode("ascii")
+
+def _to_str(line):
+    return line if isinstance(line, str) else line.decode("ascii", "replace")
+
+## Lines over an open pyserial port
+#
+class SerialTransport(object):
+
+    def __init__(self, ser):
+        self.ser = ser
+
+    def __repr__(self):
+        return "SerialTransport({0})".format(self.ser.port)
+
+    def write(self, msg):
+        self.ser.write(_to_bytes(msg) + b"\n")
+
+    write_raw = write
+
+    ## @param[in] timeout [s] for this read, the port's timeout if None.
+    def readline(self, timeout=None):
+        t = self.ser.timeout
+        if timeout is not None:
+            self.ser.timeout = timeout
+        try:
+            line = self.ser.readline()
+        finally:
+            self.ser.timeout = t
+        if not line.endswith(b"\n"):
+            raise IOError("{0}: read timed out".format(self))
+        return _to_str(line).strip()
+
+    def close(self):
+        self.ser.close()
+
+## Lines over a pyvisa resource or a usbtmc.Instrument
+#
+class VisaTransport(object):
+
+    ## @param[in] timeoutScale instrument timeout units per second: 1000
+    #            for pyvisa (ms), 1 for usbtmc (s).
+    def __init__(self, instr, timeoutScale=1000):
+        self.instr = instr
+        self.timeoutScale = timeoutScale
+
+    def __repr__(self):
+        return "VisaTransport({0!r})".format(self.instr)
+
+    def write(self, msg):
+        self.instr.write(_to_str(msg))
+
+    ## Send a message as it is, e.g. holding a binary block
+    def write_raw(self, msg):
+        self.instr.write_raw(_to_bytes(msg))
+
+    def readline(self, timeout=None):
+        t = self.instr.timeout
+        if timeout is not None:
+            self.instr.timeout = timeout * self.timeoutScale
+        try:
+            return _to_str(self.instr.read()).strip()
+        finally:
+            self.instr.timeout = t
+
+    def close(self):
+        self.instr.close()
+
+## Open a USB instrument with NI VISA, falling back to usbtmc.
+# @param[in] resource VISA resource name.
+# @param[in] idVendor, idProduct USB ids for usbtmc.
+def open_visa(resource, idVendor, idProduct, timeout=10.0):
+    try:
+        import visa
+        rm = visa.ResourceManager()
+        instr = rm.open_resource(resource)
+        instr.timeout = timeout * 1000
+        return VisaTransport(instr, 1000)
+    except Exception:
+        import usbtmc
+        instr = usbtmc.Instrument(idVendor, idProduct)
+        instr.timeout = timeout
+        return VisaTransport(instr, 1)
+
+## Lines over a raw TCP socket, e.g. port 5025 of LAN instruments
+#
+class SocketTransport(object):
+
+    def __init__(self, host, port, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._s = None
+        self._rbuf = b""
+
+    def __repr__(self):
+        return "SocketTransport({0}:{1})".format(self.host, self.port)
+
+    def connect(self):
+        if self._s is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.settimeout(self.timeout)
+            # short commands and queries, do not let Nagle delay them
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.connect((self.host, self.port))
+            self._s = s
+            self._rbuf = b""
+        return self
+
+    def write(self, msg):
+        self.connect()
+        self._s.sendall(_to_bytes(msg) + b"\n")
+
+    write_raw = write
+
+    def readline(self, timeout=None):
+        self.connect()
+        if timeout is not None:
+            self._s.settimeout(timeout)
+        try:
+            while b"\n" not in self._rbuf:
+                data = self._s.recv(65536)
+                if not data:
+                    raise IOError("{0}: connection closed".format(self))
+                self._rbuf += data
+        except socket.timeout:
+            raise IOError("{0}: read timed out".format(self))
+        finally:
+            if timeout is not None:
+                self._s.settimeout(self.timeout)
+        line, self._rbuf = self._rbuf.split(b"\n", 1)
+        return _to_str(line).strip()
+
+    def close(self):
+        if self._s is not None:
+            self._s.close()
+            self._s = None
+
+## SCPI instrument on a transport
+#
+class SCPIInstrument(object):
+
+    ## @var joinCommands whether the instrument takes semicolon-joined messages
+    joinCommands = True
+    ## @var maxMessage longest joined message, in characters
+    maxMessage = 512
+    ## @var syncTimeout [s] *OPC? waits at most this long by default
+    syncTimeout = 10.0
+
+    def __init__(self, transport):
+        self.transport = transport
+        ## @var lock serializes the session between threads sharing the instrument
+        self.lock = threading.RLock()
+        self._pending = None
+        self._state = {}
+        self._configured = None
+
+    def __repr__(self):
+        return "{0}({1!r})".format(type(self).__name__, self.transport)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.transport.close()
+
+    ## Send commands, joined into as few messages as possible.  Inside
+    # batch() they are held back until the block ends or a query.
+    def write(self, *cmds):
+        with self.lock:
+            if self._pending is not None:
+                self._pending.extend(cmds)
+            else:
+                self._send(cmds)
+
+    ## Send a message as it is, e.g. one with a binary block
+    def write_raw(self, msg):
+        with self.lock:
+            self.flush()
+            self.transport.write_raw(msg)
+
+    ## Send a query, after the commands pending, and return its reply
+    # @param[in] timeout [s] to wait for the reply, the transport's if None.
+    def query(self, cmd, timeout=None):
+        with self.lock:
+            cmds = (self._pending or []) + [cmd]
+            if self._pending is not None:
+                self._pending = []
+            self._send(cmds)
+            return self.transport.readline(timeout)
+
+    ## Hold back the commands written in the block, and send them as
+    # one message at its end
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            outer = self._pending is not None
+            if not outer:
+                self._pending = []
+            try:
+                yield self
+            finally:
+                if not outer:
+                    cmds, self._pending = self._pending, None
+                    self._send(cmds)
+
+    def flush(self):
+        with self.lock:
+            if self._pending:
+                cmds, self._pending = self._pending, []
+                self._send(cmds)
+
+    def _send(self, cmds):
+        if not self.joinCommands:
+            for c in cmds:
+                self.transport.write(c)
+            return
+        msg = ""
+        for c in cmds:
+            # commands after the first start from the root of the tree
+            if msg and c[:1] not in (":", "*"):
+                c = ":" + c
+            if msg and len(msg) + 1 + len(c) > self.maxMessage:
+                self.transport.write(msg)
+                msg = ""
+            msg = msg + ";" + c if msg else c
+        if msg:
+            self.transport.write(msg)
+
+    ## Wait until the commands sent so far are executed
+    # @return seconds waited
+    def sync(self, timeout=None):
+        t0 = time.time()
+        reply = self.query("*OPC?", self.syncTimeout if timeout is None else timeout)
+        if reply.strip() not in ("1", "+1"):
+            raise IOError("{0}: unexpected *OPC? reply {1!r}".format(self, reply))
+        return time.time() - t0
+
+    ## Repeat a query until done(reply) is true.
+    # @param[in] interval [s] between queries.
+    # @return the last reply
+    def poll(self, cmd, done, timeout=10.0, interval=0.02):
+        deadline = time.time() + timeout
+        while True:
+            reply = self.query(cmd)
+            if done(reply):
+                return reply
+            if time.time() >= deadline:
+                raise IOError("{0}: {1} timed out, last reply {2!r}".format(self, cmd, reply))
+            time.sleep(interval)
+
+    ## Send a setting unless the instrument already has it
+    # @param[in] header e.g. "VOLT:DC:NPLC".
+    # @return True if it was sent
+    def set(self, header, value):
+        with self.lock:
+            if header in self._state and self._state[header] == value:
+                return False
+            self.write(self.setting_command(header, value))
+            self._state[header] = value
+            return True
+
+    @staticmethod
+    def setting_command(header, value):
+        if isinstance(value, float):
+            return "{0} {1:g}".format(header, value)
+        return "{0} {1}".format(header, value)
+
+    ## Apply a sequence of (header, value) settings.
+    # @param[in] reset start from *RST, unless the instrument is known to
+    #            be in the state of the same reset and settings already.
+    # @return True if anything was sent
+    def configure(self, settings, reset=False):
+        settings = list(settings)
+        with self.lock:
+            if reset:
+                if self._configured == settings and \
+                   all(self._state.get(h) == v for h, v in settings):
+                    return False
+                self.invalidate()
+                with self.batch():
+                    self.write("*RST")
+                    for h, v in settings:
+                        self.set(h, v)
+                self.sync()
+                self._configured = settings
+                return True
+            with self.batch():
+                sent = [self.set(h, v) for h, v in settings]
+            return any(sent)
+
+    ## Forget the cached settings, e.g. when the instrument may have been
+    # changed from its front panel
+    def invalidate(self):
+        with self.lock:
+            self._state = {}
+            self._configured = None
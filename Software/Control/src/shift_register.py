@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package shift_register
+# Write and read back the external (on-chip) shift register through
+# control_interface.
+#
+# The value and clk_div go to config_reg(0..), pulse_reg(0) starts the
+# shift, and the previous SR contents come back in status_reg(0..) with
+# the valid bit right above them.  Instead of sleeping a fixed time,
+# the valid bit is polled: the first poll happens after the theoretical
+# shift time, later ones back off exponentially.
+#
+
+from __future__ import print_function
+import binascii
+import time
+import numpy as np
+from command import *
+import timing
+from timing import profiler
+
+## @var SR_CLK_FREQ clock the shift register clock is divided from
+SR_CLK_FREQ = 100e6
+
+## Time the shift of nbits takes at SR_CLK_FREQ/2**clk_div, in seconds
+def sr_shift_time(nbits, clk_div):
+    return (nbits + 2) * (1 << (clk_div & 0x3f)) / SR_CLK_FREQ
+
+## Number of config_reg words holding the value and the 6-bit clk_div
+def sr_config_words(nbits):
+    return (nbits + 6 + 15) // 16
+
+## status_reg addresses holding the value and the valid bit, most
+# significant word first
+def sr_status_addrs(nbits):
+    return list(range(nbits // 16, -1, -1))
+
+## Command string writing the value and clk_div and starting the shift.
+# @param[in] regShadow optional ConfigRegShadow, only changed config_reg words are sent.
+def sr_encode(cmd, data_to_send, clk_div, nbits=130, regShadow=None):
+    val = ((clk_div & 0x3f) << nbits) | (data_to_send & ((1 << nbits) - 1))
+    words = [(val >> i*16) & 0xffff for i in range(sr_config_words(nbits))]
+    if regShadow is None:
+        cmdstr = cmd.write_registers(0, words)
+    else:
+        cmdstr = regShadow.write_registers(0, words)
+    return cmdstr + cmd.send_pulse(0x01)
+
+## Assemble the SR read-back from status_reg words.
+# @param[in] retw 16-bit status words in sr_status_addrs() order.
+# @return (nbits-wide value, valid bit)
+def sr_readback_value(retw, nbits=130):
+    # one bulk conversion of the big-endian words into an integer
+    ret_all = int(binascii.hexlify(np.asarray(retw, dtype='>u2').tobytes()), 16)
+    return ret_all & ((1 << nbits) - 1), (ret_all >> nbits) & 1
+
+## Poll the status registers until the valid bit is set.
+# @param[in] timeout seconds after the first poll to give up.
+# @param[in] maxInterval upper limit of the backoff between polls.
+# @return (value, valid) of the last read-back; valid is 0 on timeout.
+def sr_wait_valid(s, nbits, clk_div, cmd=None, timeout=1.0, maxInterval=0.05):
+    if cmd is None:
+        cmd = CmdBatch()
+    trans = CmdTransaction(cmd)
+    addrs = sr_status_addrs(nbits)
+    delay = sr_shift_time(nbits, clk_div)
+    deadline = None
+    while True:
+        with profiler.timed("wait"):
+            time.sleep(delay)
+        trans.read_statuses(addrs)
+        retw = trans.commit(s)[0]
+        timing.debug(2, timing.hexwords, retw)
+        with profiler.timed("decode"):
+            ret, valid = sr_readback_value(retw, nbits)
+        if valid:
+            return ret, valid
+        now = time.time()
+        if deadline is None:
+            deadline = now + timeout
+        elif now >= deadline:
+            return ret, valid
+        delay = min(2 * delay, maxInterval, max(0.0, deadline - now))
+
+## Shift_register write and read function.
+#
+# @param[in] s Socket that is already open and connected to the FPGA board.
+# @param[in] data_to_send nbits-wide value to be sent to the external SR.
+# @param[in] clk_div Clock frequency division factor: (/2**clk_div).  6-bit wide.
+# @param[in] regShadow optional ConfigRegShadow, only changed config_reg words are sent.
+# @param[in] nbits width of the external SR, 130 for TMS1mm, 170 for TMIIa.
+# @return (value stored in the external SR that is read back,
+#          valid signal showing that the value was read back in time)
+def shift_register_rw(s, data_to_send, clk_div, regShadow=None, nbits=130, timeout=1.0, cmd=None):
+    if cmd is None:
+        cmd = CmdBatch()
+    with profiler.timed("encode"):
+        cmdstr = sr_encode(cmd, data_to_send, clk_div, nbits, regShadow)
+    timing.debug(2, timing.hexdump, cmdstr)
+    with profiler.timed("send"):
+        s.sendall(cmdstr)
+    ret, valid = sr_wait_valid(s, nbits, clk_div, cmd, timeout)
+    timing.debug(1, "Return: 0x{0:0x}, valid: {1:d}".format, ret, valid)
+    return ret, valid
+
+## Outcome of sr_sweep()
+#
+class SweepResult(object):
+
+    def __init__(self, vectors, nbits):
+        self.nbits = nbits
+        self.vectors = vectors
+        ## @var readback value read back for each vector, None if not read
+        self.readback = [None] * len(vectors)
+        ## @var valid whether the shift of each vector completed in time
+        self.valid = [0] * len(vectors)
+        self.elapsed = 0.0
+
+    ## @return list of (index, sent, read back) of the vectors that did
+    # not shift in, or did not read back unchanged
+    def mismatches(self):
+        mask = (1 << self.nbits) - 1
+        return [(i, v & mask, r) for i, (v, r, ok) in
+                enumerate(zip(self.vectors, self.readback, self.valid))
+                if not ok or r is None or r != v & mask]
+
+    @property
+    def ok(self):
+        return len(self.mismatches()) == 0
+
+    def report(self):
+        bad = self.mismatches()
+        lines = ["{0:d} vectors in {1:.3f}s, {2:d} mismatched".format(
+            len(self.vectors), self.elapsed, len(bad))]
+        for i, v, r in bad:
+            rs = "none" if r is None else "0x{0:0x}".format(r)
+            lines.append("  #{0:d}: sent 0x{1:0x}, read back {2:s}, valid {3:d}".format(
+                i, v, rs, self.valid[i]))
+        return "\n".join(lines)
+
+## Shift a sequence of vectors into the SR, one after the other.
+#
+# The read-back of each shift returns the vector shifted in before, so
+# vector i is checked by the read-back of shift i+1 and one extra shift
+# of the last vector checks the last one: N+1 shifts for N vectors
+# instead of writing every vector twice.  The comparison is deferred to
+# the end and reported in the SweepResult.
+#
+# @param[in] vectors sequence of nbits-wide config vectors, or a
+#            SweepFrames (its clk_div and nbits are used then).  Its
+#            delta frames are sent as they are only without a callback;
+#            after one, which may leave other words in config_reg, e.g.
+#            an SPI word in config_reg 0, each frame is written against
+#            regShadow, or in full without one.
+# @param[in] callback optional function(i, vector) run once vector i is
+#            in the SR, e.g. to trigger a measurement.  Writes it makes
+#            to config_reg are expected to be recorded in regShadow.
+# @return SweepResult
+def sr_sweep(s, vectors, clk_div, callback=None, nbits=130, regShadow=None, timeout=1.0, cmd=None):
+    if cmd is None:
+        cmd = CmdBatch()
+    frames = None
+    if isinstance(vectors, SweepFrames):
+        frames = vectors
+        clk_div, nbits = frames.clk_div, frames.nbits
+        vectors = frames.vectors()
+    else:
+        vectors = list(vectors)
+    res = SweepResult(vectors, nbits)
+    n = len(vectors)
+    t0 = time.time()
+    for i in range(n + 1 if n > 0 else 0):
+        v = vectors[min(i, n - 1)]
+        if frames is None:
+            with profiler.timed("encode"):
+                cmdstr = sr_encode(cmd, v, clk_div, nbits, regShadow)
+        elif regShadow is not None and (i == 0 or i == n or callback is not None):
+            # the shadow holds what the previous frame and callback left
+            cmdstr = frames.shadow_frame(regShadow, min(i, n - 1))
+        elif i == 0 or i == n or callback is not None:
+            cmdstr = frames.full_frame(min(i, n - 1))
+        else:
+            # config_reg holds frame i-1, untouched
+            cmdstr = frames.frame(i)
+            if regShadow is not None:
+                frames.record(regShadow, i)
+        with profiler.timed("send"):
+            s.sendall(cmdstr)
+        ret, valid = sr_wait_valid(s, nbits, clk_div, cmd, timeout)
+        if i > 0:
+            res.readback[i - 1] = ret
+        if i < n:
+            res.valid[i] = valid
+            if callback is not None:
+                callback(i, v)
+    res.elapsed = time.time() - t0
+    return res
+
+## Encoded shift register frames of a whole sweep, in one contiguous
+# buffer.  Frame i writes the config_reg words of vector i and clk_div
+# and starts the shift.  Frames after the first write only the words
+# that changed from frame i-1, e.g. a single DAC word, so frame(i) can
+# be sent as it is only while config_reg still holds frame i-1;
+# full_frame() and shadow_frame() do not assume so.
+#
+class SweepFrames(object):
+
+    ## @param[in] words uint16 array (N, ceil(nbits/16)) of the vectors'
+    #            16-bit words, least significant first, e.g. from
+    #            TMS1mmReg.sweep_words().
+    def __init__(self, words, clk_div, nbits=130, cmd=None):
+        if cmd is None:
+            cmd = CmdBatch()
+        words = np.atleast_2d(np.asarray(words, dtype=np.uint16))
+        n = words.shape[0]
+        nCfg = sr_config_words(nbits)
+        # config_reg words and the pulse mask of each frame
+        vals = np.ones((n, nCfg + 1), dtype=np.uint32)
+        cfg = vals[:, :nCfg]
+        cfg[:, :words.shape[1]] = words
+        cfg[:, words.shape[1]:] = 0
+        top, sh = divmod(nbits, 16)
+        # bits above nbits in the top word are replaced by clk_div
+        cfg[:, top] &= (1 << sh) - 1
+        cfg[:, top] |= ((clk_div & 0x3f) << sh) & 0xffff
+        if sh > 10:
+            cfg[:, top + 1] |= (clk_div & 0x3f) >> (16 - sh)
+        # command words of frame i: the config_reg writes where send[i] is
+        # set, in address order, then the pulse
+        send = np.ones((n, nCfg + 1), dtype=bool)
+        send[1:, :nCfg] = cfg[1:] != cfg[:-1]
+        ops = np.array([OP_WRITE_REGISTER] * nCfg + [OP_SEND_PULSE])
+        addrs = np.array(list(range(nCfg)) + [0])
+        self.cmd = cmd
+        self.nbits = nbits
+        self.clk_div = clk_div
+        ## @var words (N, nCfg) config_reg words of each frame, clk_div included
+        self.words = cfg.astype(np.uint16)
+        ## @var offsets byte offset of each frame in buf, and the end of buf
+        self.offsets = np.concatenate([[0], 4 * np.cumsum(send.sum(axis=1))]).tolist()
+        ## @var buf all frames back to back
+        self.buf = cmd.encode_words(ops, addrs, vals)[send].astype('>u4').tobytes()
+        self._view = memoryview(self.buf)
+
+    def __len__(self):
+        return self.words.shape[0]
+
+    ## Command string of frame i, a zero-copy slice of buf
+    def frame(self, i):
+        return self._view[self.offsets[i] : self.offsets[i + 1]]
+
+    ## Command string of frame i writing all of its words
+    def full_frame(self, i):
+        return self.cmd.write_registers(0, self.words[i].tolist()) + self.cmd.send_pulse(0x01)
+
+    ## Command string of frame i writing only the words the
+    # ConfigRegShadow does not show on the board already
+    def shadow_frame(self, regShadow, i):
+        return regShadow.write_registers(0, self.words[i].tolist()) + self.cmd.send_pulse(0x01)
+
+    ## Config vector i as an integer, clk_div excluded
+    def vector(self, i):
+        return sr_readback_value(self.words[i, ::-1], self.nbits)[0]
+
+    ## All config vectors as integers
+    def vectors(self):
+        return [self.vector(i) for i in range(len(self))]
+
+    ## Record the words of frame i as sent into a ConfigRegShadow
+    def record(self, regShadow, i):
+        for addr, val in enumerate(self.words[i]):
+            regShadow.record(addr, int(val))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package timing
+# Opt-in latency instrumentation of the control and instrument layers.
+#
+# Operations (encode, send, wait, recv, decode, instrument I/O, file
+# write, ...) are timed with profiler.timed(op) and accumulated into
+# log-binned latency histograms, grouped by the phase the calling
+# thread is in.  When the profiler is disabled timed() hands back a
+# shared no-op context, so instrumented code pays almost nothing.
+#
+# Debug output that is expensive to format is passed to debug() as a
+# function and its arguments, and only formatted when the verbosity
+# level asks for it.
+#
+# Scripts without command line options can be instrumented by setting
+# the environment variables TMS_TIMING=1 and TMS_VERBOSE=<level>.
+#
+
+from __future__ import print_function
+import os
+import threading
+import time
+import math
+
+## @var clock highest resolution wall clock available
+clock = getattr(time, 'perf_counter', time.time)
+
+## Log-binned latency histogram, from 1us to 100s
+#
+class LatencyHistogram(object):
+    tMin = 1e-6
+    binsPerDecade = 5
+    nBins = 8 * binsPerDecade + 2   # underflow, 8 decades, overflow
+
+    def __init__(self):
+        self.counts = [0] * self.nBins
+        self.n = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def add(self, dt):
+        if dt < self.tMin:
+            i = 0
+        else:
+            i = min(self.nBins - 1, 1 + int(math.log10(dt / self.tMin) * self.binsPerDecade))
+        self.counts[i] += 1
+        self.n += 1
+        self.total += dt
+        if dt < self.min: self.min = dt
+        if dt > self.max: self.max = dt
+
+    def mean(self):
+        return self.total / self.n if self.n > 0 else 0.0
+
+    ## Upper edge of the bin holding the q-quantile, clipped to [min, max]
+    def quantile(self, q):
+        if self.n == 0:
+            return 0.0
+        target = q * self.n
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= target:
+                break
+        edge = self.tMin * 10.0 ** (float(i) / self.binsPerDecade)
+        return max(self.min, min(self.max, edge))
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_nullTimer = _NullTimer()
+
+class _Timer(object):
+    __slots__ = ('_prof', '_op', '_t0')
+
+    def __init__(self, prof, op):
+        self._prof = prof
+        self._op = op
+
+    def __enter__(self):
+        self._t0 = clock()
+        return self
+
+    def __exit__(self, *exc):
+        self._prof.add(self._op, clock() - self._t0)
+        return False
+
+## Phase time excludes the time spent in phases nested inside it
+class _Phase(object):
+
+    def __init__(self, prof, name):
+        self._prof = prof
+        self._name = name
+
+    def __enter__(self):
+        local = self._prof._local
+        self._prev = getattr(local, 'phase', None)
+        self._prevObj = getattr(local, 'phaseObj', None)
+        self._nested = 0.0
+        self._t0 = clock()
+        local.phase = self._name
+        local.phaseObj = self
+        return self
+
+    def __exit__(self, *exc):
+        dt = clock() - self._t0
+        self._prof.add_phase_time(self._name, dt - self._nested)
+        if self._prevObj is not None:
+            self._prevObj._nested += dt
+        self._prof._local.phase = self._prev
+        self._prof._local.phaseObj = self._prevObj
+        return False
+
+## Per-phase, per-operation latency statistics
+#
+class Profiler(object):
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {}
+        self._phaseTime = {}
+
+    ## Context manager making name the current phase of the calling thread.
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def current_phase(self):
+        return getattr(self._local, 'phase', None) or "-"
+
+    ## Context manager timing one operation in the current phase.
+    def timed(self, op):
+        if not self.enabled:
+            return _nullTimer
+        return _Timer(self, op)
+
+    ## Record dt seconds spent on op.
+    def add(self, op, dt, phase=None):
+        if not self.enabled:
+            return
+        key = (phase or self.current_phase(), op)
+        with self._lock:
+            h = self._stats.get(key)
+            if h is None:
+                h = self._stats[key] = LatencyHistogram()
+            h.add(dt)
+
+    def add_phase_time(self, name, dt):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._phaseTime[name] = self._phaseTime.get(name, 0.0) + dt
+
+    ## Forget the statistics of the given phases, or of all phases.
+    def reset(self, phases=None):
+        with self._lock:
+            for key in list(self._stats):
+                if phases is None or key[0] in phases:
+                    del self._stats[key]
+            for name in list(self._phaseTime):
+                if phases is None or name in phases:
+                    del self._phaseTime[name]
+
+    ## @return {(phase, op) : LatencyHistogram}
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    ## Table of the statistics, one block per phase.
+    # @param[in] phases phases to include, all phases by default.
+    def summary(self, phases=None):
+        with self._lock:
+            stats = dict(self._stats)
+            phaseTime = dict(self._phaseTime)
+        lines = []
+        for phase in sorted(set(k[0] for k in stats)):
+            if phases is not None and phase not in phases:
+                continue
+            tPhase = phaseTime.get(phase)
+            hdr = "phase {0:s}".format(phase)
+            if tPhase is not None:
+                hdr += ": {0:.3f}s".format(tPhase)
+            lines.append(hdr)
+            lines.append("  {0:<16s} {1:>8s} {2:>10s} {3:>10s} {4:>10s} {5:>10s} {6:>10s}"
+                         .format("op", "n", "total[s]", "mean[ms]", "p50[ms]", "p90[ms]", "max[ms]"))
+            ops = [(h.total, op, h) for (p, op), h in stats.items() if p == phase]
+            for total, op, h in sorted(ops, reverse=True):
+                lines.append("  {0:<16s} {1:8d} {2:10.4f} {3:10.4f} {4:10.4f} {5:10.4f} {6:10.4f}"
+                             .format(op, h.n, h.total, h.mean()*1e3, h.quantile(0.5)*1e3,
+                                     h.quantile(0.9)*1e3, h.max*1e3))
+        return "\n".join(lines)
+
+## @var profiler default Profiler, disabled unless enable() is called or TMS_TIMING is set
+profiler = Profiler(os.environ.get("TMS_TIMING", "0") not in ("", "0"))
+
+## @var verbosity debug output level, messages with level <= verbosity are printed
+verbosity = int(os.environ.get("TMS_VERBOSE", "1"))
+
+def enable(on=True):
+    profiler.enabled = on
+
+def set_verbosity(level):
+    global verbosity
+    verbosity = level
+
+## Print func(*args) if level is within the verbosity.  func is not
+# called otherwise, so expensive formatting is skipped entirely.
+def debug(level, func, *args):
+    if level <= verbosity:
+        print(func(*args))
+
+## Hex dump of a command or reply buffer
+def hexdump(buf):
+    return " ".join("{0:02x}".format(b) for b in bytearray(buf))
+
+## Hex dump of a sequence of 16-bit words, e.g. status_reg read-backs
+def hexwords(words):
+    return " ".join("{0:04x}".format(int(w)) for w in words)
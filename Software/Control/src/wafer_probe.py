@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## @package wafer_probe
+# Probe all chip sites of a wafer in one run.
+#
+# The sites come from a wafer map and are probed one touchdown at a
+# time.  Each board's probes sit at a fixed (dx, dy) offset, in chip
+# sites, from the probe card position (x, y) the prober is stepped to,
+# usually that of the first board at (0, 0), so a touchdown puts board k
+# on (x + dx_k, y + dy_k); boards whose site is not on the map, or done
+# already, stay idle.  The board connections
+# and SMU sessions stay open for the whole run; per touchdown the
+# stages are
+#   move      the prober to the next sites, with the chips powered off,
+#   power up  the SMUs and wait until the supply current settles,
+#   acquire   the DAC code scan of every chip, boards in parallel,
+#   power down,
+#   write     the data, SMU traces and calibrations (TMS1mmProbeCard.save_chip),
+# where the write stage runs in a background thread, so the results of
+# one touchdown are written while the prober moves and the next chips
+# are powered up and scanned.
+#
+# Every site written, or failed, is recorded in a JSON checkpoint file;
+# a run started again with the same checkpoint skips those sites and so
+# resumes at the next untested one.
+#
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from board_registry import *
+import timing
+from timing import Profiler, profiler
+from TMS1mmProbeCard import *
+
+## Read a wafer map.  Either one "x y" site per line, or a grid of
+# characters, one row per y starting at 0, where any of siteChars
+# marks a site.  Lines starting with '#' are comments.
+# @return list of (x, y) in file order
+def read_wafer_map(fname, siteChars="1Xx*+"):
+    with open(fname) as fp:
+        lines = [l.rstrip("\r\n") for l in fp if not l.startswith("#") and l.strip()]
+    try:
+        sites = []
+        for l in lines:
+            x, y = l.split()
+            sites.append((int(x), int(y)))
+        return sites
+    except ValueError:
+        return [(x, y) for y, l in enumerate(lines) for x, c in enumerate(l) if c in siteChars]
+
+## Progress of a wafer run, kept in a JSON file
+#
+class WaferCheckpoint(object):
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = threading.Lock()
+        ## @var sites "x,y" -> record of the site
+        self.sites = {}
+        if os.path.exists(fname):
+            with open(fname) as fp:
+                self.sites = json.load(fp).get("sites", {})
+
+    @staticmethod
+    def key(site):
+        return "{0:d},{1:d}".format(*site)
+
+    ## Whether the site needs no probing: written, or failed unless retryFailed
+    def done(self, site, retryFailed=False):
+        rec = self.sites.get(self.key(site))
+        return rec is not None and (rec["status"] == "ok" or not retryFailed)
+
+    ## Record a site and write the file.  It is replaced as a whole, so
+    # an interruption leaves the previous version.
+    # @param[in] status "ok" or "error".
+    def record(self, site, status, **info):
+        with self._lock:
+            info.update(status=status, time=time.time())
+            self.sites[self.key(site)] = info
+            tmp = self.fname + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump({"sites" : self.sites}, fp, indent=1, sort_keys=True)
+            if os.path.exists(self.fname) and not hasattr(os, "replace"):
+                os.remove(self.fname)
+            getattr(os, "replace", os.rename)(tmp, self.fname)
+
+## Prober operated by hand: prints the sites and waits for Enter
+#
+class ManualProber(object):
+
+    ## @param[in] ref probe card position, the site of a board at offset (0, 0).
+    # @param[in] sites sites to be probed in this touchdown.
+    def move_to(self, ref, sites):
+        print("Move the probe card to x{0:d} y{1:d} (probing {2:s}), then press Enter".format(
+            ref[0], ref[1], ", ".join("x{0:d} y{1:d}".format(*s) for s in sites)))
+        sys.stdin.readline()
+
+## Prober stepped by an external command, e.g. a prober control script
+#
+class CommandProber(object):
+
+    ## @param[in] command shell command, {x} and {y} are replaced by the
+    #            probe card position, the site of a board at offset (0, 0).
+    def __init__(self, command):
+        self.command = command
+
+    def move_to(self, ref, sites):
+        x, y = ref
+        subprocess.check_call(self.command.format(x=x, y=y), shell=True)
+
+## Wafer run over a BoardRegistry.  Each board's info holds, as for
+# TMS1mmProbeCard.probe_chip(), the data file prefix and optionally the
+# 'smu', 'calib' and 'binary' settings, and the 'offset' (dx, dy) of its
+# probes from the probe card position, (0, 0) by default; 'x' and 'y'
+# are set per site.
+#
+class WaferRun(object):
+
+    ## @param[in] prober object with move_to(ref, sites), see ManualProber.
+    # @param[in] checkpoint WaferCheckpoint.
+    # @param[in] settleTolerance SMU current spread [A] taken as settled.
+    # @param[in] boards subset of the registry's boards to use, e.g. the
+    #            connected ones.
+    def __init__(self, registry, sites, prober, checkpoint, codes, div=7, nSamples=1,
+                 settleTolerance=1e-3, retryFailed=False, boards=None):
+        self.registry = registry
+        self.boards = list(boards if boards is not None else registry)
+        self.prober = prober
+        self.checkpoint = checkpoint
+        self.codes = list(codes)
+        self.div = div
+        self.nSamples = nSamples
+        self.settleTolerance = settleTolerance
+        self.todo = [s for s in sites if not checkpoint.done(s, retryFailed)]
+        self.skipped = len(sites) - len(self.todo)
+        ## @var stages per-stage timing, always on
+        self.stages = Profiler(True)
+        self.nOk = 0
+        self.nFailed = 0
+        self.elapsed = 0.0
+        self._queue = queue.Queue(maxsize=2)
+        self._writer = None
+
+    ## SMUs powering the boards' chips, each once
+    def smus(self):
+        smus = []
+        for b in self.boards:
+            smu = b.info.get('smu')
+            if smu is not None and smu not in smus:
+                smus.append(smu)
+        return smus
+
+    def _stage(self, name, func, *args):
+        t0 = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.stages.add(name, time.time() - t0, "wafer")
+
+    @staticmethod
+    def offset(board):
+        dx, dy = board.info.get('offset', (0, 0))
+        return int(dx), int(dy)
+
+    ## Sites to do under each board with the probe card at ref
+    def _assign(self, ref, left):
+        assign = []
+        for b in self.boards:
+            dx, dy = self.offset(b)
+            site = (ref[0] + dx, ref[1] + dy)
+            if site in left:
+                assign.append((b, site))
+        return assign
+
+    ## Touchdowns covering the sites to do, in map order: the first site
+    # not covered yet goes under the board whose position there covers
+    # the most sites to do, the first such board on a tie.
+    # @return list of (ref, [(board, site), ...]), ref being the probe
+    #         card position, the site of a board at offset (0, 0)
+    def touchdowns(self):
+        left = set(self.todo)
+        tds = []
+        for x, y in self.todo:
+            if (x, y) not in left:
+                continue
+            best = None
+            for b in self.boards:
+                dx, dy = self.offset(b)
+                ref = (x - dx, y - dy)
+                assign = self._assign(ref, left)
+                if best is None or len(assign) > len(best[1]):
+                    best = (ref, assign)
+            for b, site in best[1]:
+                left.remove(site)
+            tds.append(best)
+        return tds
+
+    def _power_up(self):
+        for smu in self.smus():
+            smu.volt_on()
+        for smu in self.smus():
+            settled, dt, current = smu.wait_until_settled(tolerance=self.settleTolerance)
+            print("{0} {1:s} after {2:.2f}s at {3:.6f}A".format(
+                smu, "settled" if settled else "NOT settled", dt, current))
+
+    def _power_down(self):
+        for smu in self.smus():
+            smu.volt_off()
+
+    def _acquire(self, assign):
+        boards = [b for b, site in assign]
+        for b, (x, y) in assign:
+            b.info['x'], b.info['y'] = x, y
+        return boards, self.registry.run(acquire_chip, self.codes, self.div, self.nSamples, boards=boards)
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                board, site, result = item
+                t0 = time.time()
+                if result.ok:
+                    try:
+                        save_chip(board, result.value)
+                        self.checkpoint.record(site, "ok", board=board.name, elapsed=result.elapsed)
+                        self.nOk += 1
+                    except Exception as e:
+                        print("{0:s}: writing chip x{1:d} y{2:d} failed: {3!r}".format(board.name, site[0], site[1], e))
+                        self.checkpoint.record(site, "error", board=board.name, error=repr(e))
+                        self.nFailed += 1
+                else:
+                    print("{0:s}: chip x{1:d} y{2:d} failed".format(board.name, *site))
+                    print(result.traceback)
+                    self.checkpoint.record(site, "error", board=board.name, error=repr(result.error))
+                    self.nFailed += 1
+                self.stages.add("write", time.time() - t0, "wafer")
+            finally:
+                self._queue.task_done()
+
+    ## Probe all sites not done yet
+    def run(self):
+        t0 = time.time()
+        self._writer = threading.Thread(target=self._write, name="writer")
+        self._writer.daemon = True
+        self._writer.start()
+        tds = self.touchdowns()
+        try:
+            for k, (ref, assign) in enumerate(tds):
+                sites = [site for b, site in assign]
+                print("touchdown {0:d}/{1:d}: {2:s}".format(k + 1, len(tds),
+                      " ".join("{0:s}:x{1:d}y{2:d}".format(b.name, *site) for b, site in assign)))
+                self._stage("move", self.prober.move_to, ref, sites)
+                self._stage("power up", self._power_up)
+                try:
+                    boards, results = self._stage("acquire", self._acquire, assign)
+                finally:
+                    self._stage("power down", self._power_down)
+                # blocks only when the writer is a whole touchdown behind
+                t1 = time.time()
+                for b, site in assign:
+                    self._queue.put((b, site, results[b.name]))
+                self.stages.add("queue wait", time.time() - t1, "wafer")
+        finally:
+            self._queue.put(None)
+            self._writer.join()
+            self.elapsed = time.time() - t0
+
+    ## Chips written per hour of the run
+    def chips_per_hour(self):
+        return 3600.0 * self.nOk / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        lines = ["{0:d} chips ok, {1:d} failed, {2:d} skipped as done, in {3:.1f}s: {4:.1f} chips/h".format(
+            self.nOk, self.nFailed, self.skipped, self.elapsed, self.chips_per_hour())]
+        lines.append(self.stages.summary())
+        return "\n".join(lines)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Probe all chip sites of a wafer map")
+    parser.add_argument("-m", "--smu-ip-port", type=str, action="append", help="SMU 2450 ipaddr and port, one per board or one shared [192.168.2.100:5025]")
+    parser.add_argument("-c", "--control-ip-port", type=str, action="append", help="main control system ipaddr and port, repeat for each board [192.168.2.3:1024]")
+    parser.add_argument("-l", "--code-lower", type=int, default=0, help="Code scan lower limit")
+    parser.add_argument("-u", "--code-upper", type=int, default=58000, help="Code scan upper limit")
+    parser.add_argument("-s", "--code-step", type=int, default=2000, help="Code scan step size")
+    parser.add_argument("-p", "--prefix", type=str, default="data/", help="Data file prefix, can be used to put files under directories")
+    parser.add_argument("-n", "--samples", type=int, default=1, help="ADC conversions averaged per channel, mean and sigma are recorded when > 1")
+    parser.add_argument("-e", "--settle-tolerance", type=float, default=1e-3, help="SMU current spread [A] taken as settled after power-on")
+    parser.add_argument("-b", "--binary", action="store_true", help="Write binary .scan files (see scan_file) instead of text .dat files")
+    parser.add_argument("-d", "--calib-dir", type=str, default=None, help="Store the per-chip DAC calibration tables under this directory")
+    parser.add_argument("-k", "--checkpoint", type=str, default=None, help="Checkpoint file [<prefix>wafer_checkpoint.json]")
+    parser.add_argument("-r", "--retry-failed", action="store_true", help="Probe the sites that failed before again")
+    parser.add_argument("-o", "--site-offset", type=str, action="append", help="dx,dy in chip sites of a board's probes from the probe card position the prober steps, one per board in -c order [0,0]")
+    parser.add_argument("-x", "--prober-command", type=str, default=None, help="Shell command moving the prober to site {x} {y}; prompt for manual moves if not given")
+    parser.add_argument("-t", "--timing", action="store_true", help="Print per-operation latency statistics after each chip")
+    parser.add_argument("-v", "--verbose", action="count", default=1, help="Verbosity: -v adds command hex dumps")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print errors and the summary")
+    parser.add_argument("wafermap", type=str, help="Wafer map file, 'x y' per line or a grid of sites")
+
+    args = parser.parse_args()
+    ctrlipports = args.control_ip_port or ["192.168.2.3:1024"]
+    smuipports = args.smu_ip_port or ["192.168.2.100:5025"]
+    if len(smuipports) not in (1, len(ctrlipports)):
+        parser.error("need one SMU, or one SMU per board")
+    offsets = [tuple(int(v) for v in o.split(',')) for o in (args.site_offset or ["0,0"])]
+    if len(offsets) != len(ctrlipports) or any(len(o) != 2 for o in offsets):
+        parser.error("need one site offset dx,dy per board")
+    timing.enable(args.timing)
+    timing.set_verbosity(0 if args.quiet else args.verbose)
+
+    sites = read_wafer_map(args.wafermap)
+    checkpoint = WaferCheckpoint(args.checkpoint or args.prefix + "wafer_checkpoint.json")
+    prober = CommandProber(args.prober_command) if args.prober_command else ManualProber()
+
+    smus = []
+    for smuipport in smuipports:
+        smuipport = smuipport.split(':')
+        smus.append(SMU2450(smuipport[0], int(smuipport[1])))
+    calib = DACCalibrationStore(args.calib_dir) if args.calib_dir else None
+    boards = BoardRegistry()
+    for i, ctrlipport in enumerate(ctrlipports):
+        boards.add("board{0:d}".format(i), ctrlipport,
+                   {'prefix' : args.prefix, 'calib' : calib, 'smu' : smus[i % len(smus)],
+                    'binary' : args.binary, 'offset' : offsets[i]})
+    results = boards.connect_all()
+    BoardRegistry.report(results)
+    connected = BoardRegistry.succeeded(results)
+    if not connected:
+        sys.exit(1)
+
+    run = WaferRun(boards, sites, prober, checkpoint,
+                   xrange(args.code_lower, args.code_upper+1, args.code_step),
+                   nSamples=args.samples, settleTolerance=args.settle_tolerance,
+                   retryFailed=args.retry_failed, boards=connected)
+    print("{0:d} sites, {1:d} done before, {2:d} to probe".format(len(sites), run.skipped, len(run.todo)))
+    try:
+        run.run()
+    except KeyboardInterrupt:
+        print("interrupted, rerun with the same checkpoint to resume")
+    finally:
+        boards.close_all()
+        for smu in smus:
+            smu.volt_off()
+            smu.close()
+        print(run.summary())
+        if profiler.enabled:
+            print(profiler.summary())